@@ -0,0 +1,63 @@
+"""
+Run the benchmark suite and report calls per second and allocations.
+
+Usage: python -m benchmarks [match] [settings] [envs]
+                            [--filter TEXT] [--save FILE] [--compare FILE]
+
+Results saved with ``--save`` can be passed to ``--compare`` in a later run,
+which adds the speedup with respect to the saved results, so that
+regressions show up as values below 1.
+"""
+import argparse
+import json
+from benchmarks import bench_match, bench_settings, bench_envs
+from benchmarks.common import measure
+
+SUITES = {
+    'match': bench_match,
+    'settings': bench_settings,
+    'envs': bench_envs,
+}
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument('suites', nargs='*',
+                        help=f"suites to run, all by default: {list(SUITES)}")
+    parser.add_argument('--filter', default='',
+                        help="only run benchmarks whose name contains this")
+    parser.add_argument('--save', help="save the results as JSON")
+    parser.add_argument('--compare', help="JSON results to compare against")
+    args = parser.parse_args(args)
+    for suite in args.suites:
+        if suite not in SUITES:
+            parser.error(f"unknown suite {suite}")
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = {}
+    print(f"{'benchmark':<40} {'params':<14} {'calls/s':>12} "
+          f"{'alloc (KiB)':>12} {'speedup':>8}")
+    for suite in args.suites or list(SUITES):
+        for name, params, func in SUITES[suite].benchmarks():
+            if args.filter not in name:
+                continue
+            per_second, allocated = measure(func)
+            key = f'{name} {params}'
+            results[key] = {'per_second': per_second, 'allocated': allocated}
+            speedup = ''
+            if key in baseline:
+                speedup = f"{per_second/baseline[key]['per_second']:.2f}"
+            print(f"{name:<40} {params:<14} {per_second:>12.0f} "
+                  f"{allocated/1024:>12.1f} {speedup:>8}", flush=True)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
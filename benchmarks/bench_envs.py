@@ -0,0 +1,64 @@
+"""
+Benchmarks of the training environments for various numbers of agents.
+
+Usage: python -m benchmarks envs
+"""
+import numpy as np
+from dmarket.agents import GymRLAgent
+from dmarket.environments import (
+    SingleAgentTrainingEnv, MultiAgentTrainingEnv, SingleAgentVecEnv
+)
+from dmarket.info_settings import OfferInformationSetting
+from benchmarks.common import make_agents
+
+
+def benchmarks():
+    """Yield the name, parameters and function of each benchmark."""
+    rng = np.random.default_rng(0)
+    for n_agents in [10, 100, 1000]:
+        params = f'agents={n_agents}'
+        fixed_agents = make_agents(n_agents // 2, n_agents - n_agents // 2 - 1,
+                                   rng)
+        setting = OfferInformationSetting()
+
+        rl_agent = GymRLAgent('seller', 90, name='rl')
+        env = SingleAgentTrainingEnv(rl_agent, fixed_agents, setting)
+        env.seed(0)
+        env.reset()
+        yield 'SingleAgentTrainingEnv.reset', params, env.reset
+
+        def single_step(env=env):
+            _, _, done, _ = env.step(5)
+            if done:
+                env.reset()
+        yield 'SingleAgentTrainingEnv.step', params, single_step
+
+        rl_agents = [
+            GymRLAgent('buyer', 100, name='rl_buyer'),
+            GymRLAgent('seller', 90, name='rl_seller'),
+        ]
+        env = MultiAgentTrainingEnv(rl_agents, fixed_agents[1:], setting)
+        env.seed(0)
+        env.reset()
+
+        def multi_step(env=env):
+            active = [
+                agent_id for agent_id in env.rl_agents
+                if not env.market.done_mask[env.market.slots[agent_id]]
+            ]
+            _, _, done, _ = env.step(dict.fromkeys(active, 5))
+            if done['__all__']:
+                env.reset()
+        yield 'MultiAgentTrainingEnv.step', params, multi_step
+
+        n_envs = 16
+        env = SingleAgentVecEnv(rl_agent, fixed_agents, setting, n_envs)
+        env.reset()
+        actions = np.full(n_envs, 5)
+        yield (f'SingleAgentVecEnv.step/{n_envs}', params,
+               lambda env=env: env.step(actions))
+
+
+if __name__ == '__main__':
+    from benchmarks.__main__ import main
+    main(['envs'])
@@ -0,0 +1,106 @@
+"""
+Benchmarks of the matchers and of ``MarketEngine.step`` on order books of
+various sizes, and of whole games played with ``MarketEngine.run_episode``.
+
+Usage: python -m benchmarks match
+"""
+import numpy as np
+from dmarket.agents import AgentPopulation, UniformRandomAgent
+from dmarket.engine import MarketEngine, OrderBookMarketEngine, MATCHERS
+from benchmarks.common import make_book, random_offers
+
+
+def benchmarks():
+    """Yield the name, parameters and function of each benchmark."""
+    rng = np.random.default_rng(0)
+    for n_offers in [10, 100, 1000, 10000, 100000]:
+        bids, asks = make_book(n_offers, rng)
+        for name, matcher in MATCHERS.items():
+            yield (f'match[{name}]', f'offers={n_offers}',
+                   lambda matcher=matcher, bids=bids, asks=asks:
+                       matcher(bids, asks))
+
+        # The original matcher, which sorts (offer, agent_id) tuples
+        if n_offers <= 10000:
+            bid_list = list(zip(bids.tolist(), range(len(bids))))
+            ask_list = list(zip(asks.tolist(), range(len(bids), n_offers)))
+            yield ('MarketEngine.match', f'offers={n_offers}',
+                   lambda bid_list=bid_list, ask_list=ask_list:
+                       MarketEngine.match(list(bid_list), list(ask_list)))
+
+    for n_agents in [10, 100, 1000]:
+        n_buyers = n_agents // 2
+        market = MarketEngine(range(n_buyers), range(n_buyers, n_agents),
+                              history_length=1)
+        offers = random_offers(market, rng)
+        array = market.offers_to_array(offers)
+        for name, step_offers in [('dict', offers), ('array', array)]:
+            def step(market=market, step_offers=step_offers):
+                if market.done_mask.all():
+                    market.reset()
+                market.step(step_offers)
+            yield f'MarketEngine.step[{name}]', f'agents={n_agents}', step
+
+        # A persistent book in which only a few agents change their offer
+        book = OrderBookMarketEngine(range(n_buyers),
+                                     range(n_buyers, n_agents),
+                                     max_steps=10**9, history_length=1)
+        book.step(dict(zip(book.agent_ids, np.r_[
+            rng.uniform(50, 90, size=n_buyers),
+            rng.uniform(110, 150, size=n_agents - n_buyers)
+        ].tolist())))
+        def book_step(book=book, n_buyers=n_buyers):
+            slots = rng.integers(book.n_agents, size=5)
+            changes = np.full(book.n_agents, np.nan)
+            changes[slots] = np.where(slots < n_buyers, 80.0, 120.0)
+            book.step(changes)
+        yield ('OrderBookMarketEngine.step[5 changes]', f'agents={n_agents}',
+               book_step)
+
+    # Whole games of dict offers, in which agents stop offering once done
+    for n_agents in [300, 2000]:
+        n_buyers = n_agents // 2
+        market = MarketEngine(range(n_buyers), range(n_buyers, n_agents))
+        rounds = [random_offers(market, rng) for _ in range(market.max_steps)]
+        def dict_game(market=market, rounds=rounds):
+            market.reset()
+            for offers in rounds:
+                done = market.done
+                if len(done) == market.n_agents:
+                    break
+                market.step({agent_id: offer
+                             for agent_id, offer in offers.items()
+                             if agent_id not in done})
+        yield 'MarketEngine game[dict]', f'agents={n_agents}', dict_game
+
+    # The games of the example notebooks: 5 sellers and 6 buyers
+    agents = [
+        UniformRandomAgent('seller', 90, name=f'seller_{i}', rng=rng)
+        for i in range(5)
+    ] + [
+        UniformRandomAgent('buyer', 110, name=f'buyer_{i}', rng=rng)
+        for i in range(6)
+    ]
+    market = MarketEngine([agent.name for agent in agents[5:]],
+                          [agent.name for agent in agents[0:5]])
+    agent_ids = set(market.agent_ids)
+
+    # A game played the way the notebooks do, round by round with dicts
+    def dict_loop(market=market, agents=agents, agent_ids=agent_ids):
+        market.reset()
+        while market.done != agent_ids:
+            market.step({
+                agent.name: agent.get_offer(None)
+                for agent in agents if agent.name not in market.done
+            })
+    yield 'dict loop', 'agents=11', dict_loop
+
+    population = AgentPopulation(agents, rng=rng)
+    yield ('MarketEngine.run_episode', 'agents=11',
+           lambda market=market, population=population:
+               market.run_episode(population))
+
+
+if __name__ == '__main__':
+    from benchmarks.__main__ import main
+    main(['match'])
@@ -0,0 +1,45 @@
+"""
+Benchmarks of the observations of every information setting.
+
+Usage: python -m benchmarks settings
+"""
+import numpy as np
+from dmarket.engine import MarketEngine
+from dmarket.info_settings import (
+    BlackBoxSetting, OfferInformationSetting, DealInformationSetting,
+    TimeInformationWrapper
+)
+from benchmarks.common import random_offers
+
+
+def settings():
+    return {
+        'BlackBox': BlackBoxSetting(),
+        'Offer': OfferInformationSetting(),
+        'Deal': DealInformationSetting(),
+        'Time(Offer)': TimeInformationWrapper(OfferInformationSetting()),
+    }
+
+
+def benchmarks():
+    """Yield the name, parameters and function of each benchmark."""
+    rng = np.random.default_rng(0)
+    for n_agents in [10, 100, 1000]:
+        n_buyers = n_agents // 2
+        market = MarketEngine(range(n_buyers), range(n_buyers, n_agents),
+                              history_length=1)
+        market.step(random_offers(market, rng))
+        agent_ids = market.agent_ids
+        slots = list(range(n_agents))
+        for name, setting in settings().items():
+            yield (f'{name}.get_states', f'agents={n_agents}',
+                   lambda setting=setting, market=market, ids=agent_ids:
+                       setting.get_states(ids, market))
+            yield (f'{name}.get_states_array', f'agents={n_agents}',
+                   lambda setting=setting, market=market, slots=slots:
+                       setting.get_states_array(slots, market))
+
+
+if __name__ == '__main__':
+    from benchmarks.__main__ import main
+    main(['settings'])
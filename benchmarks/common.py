@@ -0,0 +1,71 @@
+"""
+Timing and allocation measurements shared by the benchmarks.
+"""
+import timeit
+import tracemalloc
+from dmarket.agents import UniformRandomAgent
+
+
+def measure(func, repeat=5):
+    """
+    Measure the speed and memory use of calling ``func`` without arguments.
+
+    The function is called once first, so that caches are filled and compiled
+    kernels are built before timing.
+
+    Parameters
+    ----------
+    func: callable
+        The function to measure.
+    repeat: int, optional (default=5)
+        Number of timing runs, of which the fastest is reported.
+
+    Returns
+    -------
+    per_second: float
+        Number of calls per second.
+    allocated: int
+        Peak number of bytes allocated by a single call, as traced by
+        ``tracemalloc``.
+    """
+    func()
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    per_second = number/min(timer.repeat(repeat=repeat, number=number))
+
+    # Tracing only during the call makes the peak that of the call, without
+    # tracemalloc.reset_peak, which needs Python 3.9
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return per_second, peak
+
+
+def make_book(n_offers, rng):
+    """Random book with half bids and half asks that barely overlap."""
+    n = n_offers // 2
+    bids = rng.uniform(50, 101, size=n)
+    asks = rng.uniform(99, 150, size=n_offers - n)
+    return bids, asks
+
+
+def make_agents(n_buyers, n_sellers, rng):
+    """Uniform random fixed agents with overlapping price ranges."""
+    buyers = [
+        UniformRandomAgent('buyer', res, name=f'buyer_{i}', rng=rng)
+        for i, res in enumerate(rng.uniform(90, 110, size=n_buyers))
+    ]
+    sellers = [
+        UniformRandomAgent('seller', res, name=f'seller_{i}', rng=rng)
+        for i, res in enumerate(rng.uniform(80, 100, size=n_sellers))
+    ]
+    return buyers + sellers
+
+
+def random_offers(market, rng):
+    """Random offers of all agents of a market as a dict."""
+    return dict(zip(market.agent_ids,
+                    rng.uniform(80, 120, size=market.n_agents).tolist()))
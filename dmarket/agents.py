@@ -1,5 +1,103 @@
 import numpy as np
 
+
+def seed_sequence(seed):
+    """Turn ``None``, an int or a SeedSequence into a SeedSequence."""
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    return np.random.SeedSequence(seed)
+
+
+def spawn_generators(seed, n):
+    """
+    Create independent random generators from a single seed.
+
+    Parameters
+    ----------
+    seed: None, int or SeedSequence
+        The seed to derive the generators from. If ``None``, fresh entropy is
+        drawn from the operating system.
+
+    n: int
+        Number of generators to create.
+
+    Returns
+    -------
+    generators: list
+        A list of ``n`` independent ``numpy.random.Generator`` objects.
+
+    seed_sequence: SeedSequence
+        The seed sequence the generators were spawned from.
+    """
+    seed = seed_sequence(seed)
+    return [np.random.default_rng(child) for child in seed.spawn(n)], seed
+
+
+def normalize_observations(observations, reservation_prices, signs):
+    """
+    Vectorized ``GymRLAgent.normalize`` for the observations of many agents.
+
+    Parameters
+    ----------
+    observations: ndarray of shape (n_agents, ...)
+        The observation of each agent along the first axis.
+
+    reservation_prices: ndarray of shape (n_agents,)
+        The reservation price of each agent.
+
+    signs: ndarray of shape (n_agents,)
+        The sign of each agent, +1 for sellers and -1 for buyers.
+
+    Returns
+    -------
+    normalized_observations: ndarray of shape (n_agents, ...)
+        The scaled observation of each agent.
+    """
+    observations = np.asarray(observations, dtype=float)
+    shape = (-1,) + (1,)*(observations.ndim - 1)
+    r = np.reshape(reservation_prices, shape)
+    s = np.reshape(signs, shape)
+    return np.heaviside(observations, 0) * s * (observations - r)/r
+
+
+def actions_to_prices(actions, lower, upper, signs, discretizations):
+    """
+    Vectorized ``GymRLAgent.action_to_price`` for the actions of many agents.
+
+    Parameters
+    ----------
+    actions: ndarray of shape (n_agents,)
+        The action of each agent.
+
+    lower: ndarray of shape (n_agents,)
+        The lowest price each agent can offer, ``_a`` of the agent.
+
+    upper: ndarray of shape (n_agents,)
+        The highest price each agent can offer, ``_b`` of the agent.
+
+    signs: ndarray of shape (n_agents,)
+        The sign of each agent, +1 for sellers and -1 for buyers.
+
+    discretizations: ndarray of shape (n_agents,)
+        The discretization of each agent.
+
+    Returns
+    -------
+    prices: ndarray of shape (n_agents,)
+        The price corresponding to the action of each agent.
+    """
+    m = np.asarray(discretizations)/2
+    l = np.asarray(actions) - m
+    return ((m - l*signs)*lower + (m + l*signs)*upper)/discretizations
+
+
+def batch_size(observations):
+    """Number of observations in a batch, see ``MarketAgent.get_offers``."""
+    if isinstance(observations, tuple):
+        return len(observations[-1])
+    return len(observations)
+
+
 class MarketAgent:
     """
     Market agent implementation to be used in market environments.
@@ -13,8 +111,13 @@ class MarketAgent:
     name: str, optional (default=None)
         Name of the market agent. If not given, a random one will be generated.
         Note: this will usually not be the agent id used in the market engine.
+
+    rng: numpy.random.Generator, optional (default=None)
+        Random number generator used for the name and random offers. If not
+        given, the global ``numpy.random`` state is used. This can be replaced
+        later by assigning to the ``rng`` attribute.
     """
-    def __init__(self, role, reservation_price, name=None):
+    def __init__(self, role, reservation_price, name=None, rng=None):
         if not role in ['buyer', 'seller']:
             raise ValueError("Role must be either buyer or seller")
         if reservation_price <= 0:
@@ -22,14 +125,31 @@ class MarketAgent:
 
         self.role = role
         self.reservation_price = reservation_price
+        self.rng = np.random if rng is None else rng
         if not name:
-            randstring = "%04x" % np.random.randint(16**4)
+            if isinstance(self.rng, np.random.Generator):
+                randstring = "%04x" % self.rng.integers(16**4)
+            else:
+                randstring = "%04x" % self.rng.randint(16**4)
             cls = type(self).__name__[0:4]
             letter = role[0].upper()
             name = f"{cls}_{letter}{reservation_price}_{randstring}"
 
         self.name = name
 
+    def __getstate__(self):
+        # The global numpy.random module can't be pickled, it is restored
+        # when unpickling, e.g. in another process
+        state = self.__dict__.copy()
+        if state.get('rng') is np.random:
+            state['rng'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.rng is None:
+            self.rng = np.random
+
     def get_offer(self, observation):
         """
         Returns offer given an observations.
@@ -47,12 +167,39 @@ class MarketAgent:
         """
         raise NotImplementedError
 
+    def get_offers(self, observations):
+        """
+        Returns offers for a batch of observations, e.g., one per market.
+
+        The default implementation calls ``get_offer`` for each observation.
+        Subclasses can override this with a vectorized version.
+
+        Parameters
+        ----------
+        observations: array_like or tuple
+            A batch of observations along the first axis. For tuple
+            observation spaces, this is a tuple of batches instead.
+
+        Returns
+        -------
+        offers: ndarray of shape (batch_size,)
+            Offers to be made to the markets.
+        """
+        if isinstance(observations, tuple):
+            observations = list(zip(*observations))
+        return np.array([self.get_offer(obs) for obs in observations],
+                        dtype=float)
+
 
 class ConstantAgent(MarketAgent):
     """Agent that always offers its reservation price."""
     def get_offer(self, observation):
         return self.reservation_price
 
+    def get_offers(self, observations):
+        return np.full(batch_size(observations), self.reservation_price,
+                       dtype=float)
+
 
 class FactorAgent(MarketAgent):
     """
@@ -83,9 +230,10 @@ class FactorAgent(MarketAgent):
         Upper bound of the offer range.
     """
 
-    def __init__(self, role, reservation_price, name=None, max_factor=0.5):
+    def __init__(self, role, reservation_price, name=None, max_factor=0.5,
+                 rng=None):
         self.max_factor = max_factor
-        super().__init__(role, reservation_price, name)
+        super().__init__(role, reservation_price, name, rng)
 
         r = reservation_price
         self._s = (-1 if role == 'buyer' else 1)
@@ -111,7 +259,11 @@ class UniformRandomAgent(FactorAgent):
     """
 
     def get_offer(self, observation):
-        return np.random.uniform(self._a, self._b)
+        return self.rng.uniform(self._a, self._b)
+
+    def get_offers(self, observations):
+        return self.rng.uniform(self._a, self._b,
+                                size=batch_size(observations))
 
 
 class TimeDependentAgent(FactorAgent):
@@ -125,9 +277,15 @@ class TimeDependentAgent(FactorAgent):
         time = observation[1]
         return self.compute_offer(obs, time)
 
+    def get_offers(self, observations):
+        return np.asarray(self.get_offer(observations), dtype=float)
+
     def compute_offer(self, observation, time):
         """
         Compute the offer based on observation and time.
+
+        Both arguments may also be batches, in which case an array of offers
+        should be returned.
         """
         raise NotImplementedError
 
@@ -151,15 +309,15 @@ class TimeLinearAgent(TimeDependentAgent):
     """
 
     def __init__(self, role, reservation_price, name=None, max_factor=0.5,
-                 noise=1.0, max_steps=20):
-        super().__init__(role, reservation_price, name, max_factor)
+                 noise=1.0, max_steps=20, rng=None):
+        super().__init__(role, reservation_price, name, max_factor, rng)
         self.max_steps = max_steps
         self.noise = noise
         self._slope = -self._s * (self._b - self._a)/self.max_steps
 
     def compute_offer(self, observation, time):
-        t = min(time,  self.max_steps)
-        noise = np.random.normal(scale=self.noise)
+        t = np.minimum(time,  self.max_steps)
+        noise = self.rng.normal(scale=self.noise, size=np.shape(t) or None)
         return self._c*self.reservation_price + t*self._slope + noise
 
 
@@ -191,11 +349,11 @@ class GymRLAgent(FactorAgent):
         the agent can offer. See ``UniformRandomAgent``.
     """
     def __init__(self, role, reservation_price, name=None, model=None,
-                 discretization=20, max_factor=0.5):
+                 discretization=20, max_factor=0.5, rng=None):
         self.model = model
         self.discretization = discretization
         self._N = discretization
-        super().__init__(role, reservation_price, name, max_factor)
+        super().__init__(role, reservation_price, name, max_factor, rng)
 
     def get_offer(self, observation):
         if not self.model:
@@ -203,6 +361,12 @@ class GymRLAgent(FactorAgent):
         action = self.model.predict(self.normalize(observation))[0]
         return self.action_to_price(action)
 
+    def get_offers(self, observations):
+        if not self.model:
+            raise RuntimeError("Current agent does not have a model")
+        actions = self.model.predict(self.normalize(observations))[0]
+        return self.action_to_price(np.asarray(actions))
+
     def normalize(self, observation):
         """
         Normalize the prices in observations according to reservation price.
@@ -252,3 +416,318 @@ class GymRLAgent(FactorAgent):
         l = action - self._N/2
         m = self._N/2
         return ((m - l*self._s)*self._a + (m + l*self._s)*self._b)/self._N
+
+
+class AgentPopulation:
+    """
+    A group of fixed agents whose offers are computed together.
+
+    Agents of the classes ``ConstantAgent``, ``UniformRandomAgent`` and
+    ``TimeLinearAgent`` are grouped per class. The parameters of each group
+    are stacked into arrays, so that the offers of the whole group are
+    computed with a single array expression and a single random draw.
+    ``UniformRandomAgent`` and ``TimeLinearAgent`` objects with a generator of
+    their own, other than the global ``numpy.random`` state and ``rng``, are
+    not grouped but draw from their generator individually. All other agents,
+    which may depend on their observations, are stored in
+    ``other_agents``. Among those, ``GymRLAgent`` objects that share the same
+    model are grouped as well: their normalized observations are stacked so
+    that ``model.predict`` is called only once per model. The remaining agents
+    are asked for their offers individually.
+
+    Parameters
+    ----------
+    agents: list
+        A list of market agents.
+
+    rng: numpy.random.Generator, optional (default=None)
+        Random number generator used for the grouped agents. If not given,
+        the global ``numpy.random`` state is used. The agents in
+        ``other_agents`` and agents with their own generator use those.
+
+    pregenerate: int, optional (default=None)
+        If given, ``reset`` draws the random numbers of the grouped agents for
+        this many market steps at once, and ``get_offers`` only looks them up
+        by market time. This should be the ``max_steps`` of the market.
+
+    Attributes
+    ----------
+    agents: list
+        The agents in the population. Offers are returned in this order.
+
+    other_agents: list
+        The agents that are not grouped and need observations.
+    """
+    def __init__(self, agents, rng=None, pregenerate=None):
+        self.agents = list(agents)
+        self.rng = np.random if rng is None else rng
+        self.pregenerate = pregenerate
+        self._uniform_block = None
+        self._normal_block = None
+        groups = {ConstantAgent: [], UniformRandomAgent: [],
+                  TimeLinearAgent: []}
+        other = []
+        self._own_rng = []
+        for i, agent in enumerate(self.agents):
+            if type(agent) in (UniformRandomAgent, TimeLinearAgent) \
+               and agent.rng is not np.random and agent.rng is not self.rng:
+                self._own_rng.append(i)
+                continue
+            # Subclasses may change the offers, so only group exact classes
+            groups.get(type(agent), other).append(i)
+        self.other_agents = [self.agents[i] for i in other]
+        self._other = np.array(other, dtype=int)
+
+        # Group RL agents by model, storing their positions in other_agents
+        models = {}
+        self._individual = []
+        for j, agent in enumerate(self.other_agents):
+            if type(agent) is GymRLAgent and agent.model:
+                models.setdefault(id(agent.model), []).append(j)
+            else:
+                self._individual.append(j)
+        self._model_groups = [
+            (np.array(members, dtype=int),
+             GymRLAgentGroup(self.other_agents[j] for j in members))
+            for members in models.values()
+        ]
+
+        def params(group, name):
+            return np.array([getattr(self.agents[i], name) for i in group],
+                            dtype=float)
+
+        self._constant = np.array(groups[ConstantAgent], dtype=int)
+        self._constant_offers = params(groups[ConstantAgent],
+                                       'reservation_price')
+
+        self._uniform = np.array(groups[UniformRandomAgent], dtype=int)
+        self._uniform_a = params(groups[UniformRandomAgent], '_a')
+        self._uniform_b = params(groups[UniformRandomAgent], '_b')
+        self._uniform_width = self._uniform_b - self._uniform_a
+
+        linear = groups[TimeLinearAgent]
+        self._linear = np.array(linear, dtype=int)
+        self._linear_start = params(linear, '_c') \
+                           * params(linear, 'reservation_price')
+        self._linear_slope = params(linear, '_slope')
+        self._linear_steps = params(linear, 'max_steps')
+        self._linear_noise = params(linear, 'noise')
+
+    def __len__(self):
+        return len(self.agents)
+
+    def seed(self, seed=None):
+        """
+        Give the population, each of ``other_agents`` and each agent with its
+        own generator an independent random generator derived from ``seed``.
+
+        Returns
+        -------
+        seed_sequence: SeedSequence
+            The seed sequence the generators were spawned from.
+        """
+        agents = self.other_agents + [self.agents[i] for i in self._own_rng]
+        generators, seed = spawn_generators(seed, len(agents) + 1)
+        self.rng = generators[0]
+        for agent, rng in zip(agents, generators[1:]):
+            agent.rng = rng
+        return seed
+
+    def reset(self, batch_size=None, markets=None):
+        """
+        Draw the random numbers of a new game if ``pregenerate`` is set.
+
+        Parameters
+        ----------
+        batch_size: int, optional (default=None)
+            Number of markets if offers are computed for a batch of markets.
+
+        markets: array_like, optional (default=None)
+            Boolean mask or indices of the markets in the batch to draw new
+            numbers for. If not given, numbers are drawn for all markets.
+        """
+        if self.pregenerate is None:
+            return
+        shape = (self.pregenerate,) + ((batch_size,) if batch_size else ())
+        uniform_shape = shape + self._uniform_a.shape
+        normal_shape = shape + self._linear_noise.shape
+        if markets is None or self._uniform_block is None \
+           or self._uniform_block.shape != uniform_shape:
+            self._uniform_block = self.rng.uniform(size=uniform_shape)
+            self._normal_block = self.rng.normal(size=normal_shape)
+            return
+        markets = np.arange(batch_size)[markets]
+        self._uniform_block[:, markets] = self.rng.uniform(
+            size=(self.pregenerate, len(markets)) + self._uniform_a.shape
+        )
+        self._normal_block[:, markets] = self.rng.normal(
+            size=(self.pregenerate, len(markets)) + self._linear_noise.shape
+        )
+
+    def _random(self, time, shape):
+        """Uniform and standard normal numbers of the grouped agents."""
+        block = self._uniform_block
+        # Numbers drawn for a single market can be looked up for any times
+        if block is not None and (block.ndim == 2
+                                  or shape == block.shape[1:-1]) \
+           and np.all(time < self.pregenerate):
+            if block.ndim == 2:
+                return block[time], self._normal_block[time]
+            markets = np.arange(len(time))
+            return block[time, markets], self._normal_block[time, markets]
+        # Empty groups draw nothing, which leaves the generator unchanged
+        uniform = normal = None
+        if len(self._uniform):
+            uniform = self.rng.uniform(size=shape + (len(self._uniform),))
+        if len(self._linear):
+            normal = self.rng.normal(size=shape + (len(self._linear),))
+        return uniform, normal
+
+    def get_offers(self, time, observations=()):
+        """
+        Compute the offers of all agents in the population.
+
+        Parameters
+        ----------
+        time: int or ndarray of shape (batch_size,)
+            The current market time, or the times of a batch of markets. If
+            ``reset`` pregenerated the numbers of a single market, an array
+            gives the offers of that market in several rounds instead.
+
+        observations: list, optional (default=())
+            The observations of ``other_agents`` in the same order. If
+            ``time`` is a batch, each entry should be a batch of observations
+            as used by ``MarketAgent.get_offers``. Agents with observation
+            ``None``, or without observation, make no offer.
+
+        Returns
+        -------
+        offers: ndarray of shape (n_agents,) or (batch_size, n_agents)
+            The offers of the agents, ``NaN`` for no offer.
+        """
+        # Market times are ints, so avoid the slower np.shape in that case
+        shape = () if isinstance(time, int) else np.shape(time)
+        batched = len(shape) > 0
+        offers = np.empty(shape + (len(self.agents),))
+
+        uniform, normal = self._random(time, shape)
+
+        if len(self._constant):
+            offers[..., self._constant] = self._constant_offers
+
+        if len(self._uniform):
+            offers[..., self._uniform] = self._uniform_a \
+                                       + self._uniform_width*uniform
+
+        if len(self._linear):
+            t = np.minimum(np.expand_dims(time, -1), self._linear_steps)
+            offers[..., self._linear] = self._linear_start \
+                                      + t*self._linear_slope \
+                                      + self._linear_noise*normal
+
+        for i in self._own_rng:
+            agent = self.agents[i]
+            if batched:
+                offers[..., i] = agent.get_offers((None, time))
+            else:
+                offers[..., i] = agent.get_offer((None, time))
+
+        if len(self._other):
+            offers[..., self._other] = np.nan
+        observations = list(observations)
+        for j in self._individual:
+            agent = self.other_agents[j]
+            obs = observations[j] if j < len(observations) else None
+            if obs is None:
+                continue
+            elif batched:
+                offers[..., self._other[j]] = agent.get_offers(obs)
+            else:
+                offers[..., self._other[j]] = agent.get_offer(obs)
+
+        for members, group in self._model_groups:
+            index = [k for k, j in enumerate(members)
+                     if j < len(observations) and observations[j] is not None]
+            if not index:
+                continue
+            obs = group.normalize(
+                np.stack([observations[j] for j in members[index]]), index
+            )
+            # Batches of markets are flattened into one batch for the model
+            actions = group.agents[0].model.predict(
+                obs.reshape((-1,) + obs.shape[1 + batched:])
+            )[0]
+            actions = np.reshape(actions, obs.shape[0:1 + batched])
+            offers[..., self._other[members[index]]] = \
+                group.action_to_price(actions.T, index)
+        return offers
+
+
+class GymRLAgentGroup:
+    """
+    Stacked parameters of several ``GymRLAgent`` objects.
+
+    This allows normalizing the observations and converting the actions of
+    all agents in the group with a single array expression, see
+    ``normalize_observations`` and ``actions_to_prices``.
+
+    Parameters
+    ----------
+    agents: list
+        A list of ``GymRLAgent`` objects.
+
+    Attributes
+    ----------
+    agents: list
+        The agents in the group. Arrays are ordered accordingly.
+    reservation_prices, signs, lower, upper, discretizations: ndarray
+        The reservation price, sign, ``_a``, ``_b`` and discretization of each
+        agent.
+    """
+    def __init__(self, agents):
+        self.agents = list(agents)
+
+        def params(name):
+            return np.array([getattr(agent, name) for agent in self.agents],
+                            dtype=float)
+
+        self.reservation_prices = params('reservation_price')
+        self.signs = params('_s')
+        self.lower = params('_a')
+        self.upper = params('_b')
+        self.discretizations = params('discretization')
+
+    def __len__(self):
+        return len(self.agents)
+
+    def normalize(self, observations, index=slice(None)):
+        """
+        Normalize the stacked observations of (a subset of) the agents.
+
+        Parameters
+        ----------
+        observations: ndarray of shape (n_agents, ...)
+            The observation of each agent along the first axis.
+        index: array_like, optional
+            Positions of the agents in the group the observations belong to.
+            Defaults to all agents.
+        """
+        return normalize_observations(observations,
+                                      self.reservation_prices[index],
+                                      self.signs[index])
+
+    def action_to_price(self, actions, index=slice(None)):
+        """
+        Convert the actions of (a subset of) the agents to market prices.
+
+        Parameters
+        ----------
+        actions: ndarray of shape (n_agents,)
+            The action of each agent.
+        index: array_like, optional
+            Positions of the agents in the group the actions belong to.
+            Defaults to all agents.
+        """
+        return actions_to_prices(actions, self.lower[index],
+                                 self.upper[index], self.signs[index],
+                                 self.discretizations[index])
@@ -1,9 +1,546 @@
+import heapq
 import numpy as np
+from collections.abc import Sequence
+
+def _sorted_ids(agent_ids):
+    """Sort agent ids if possible, otherwise keep them in the given order."""
+    agent_ids = list(dict.fromkeys(agent_ids))
+    try:
+        return sorted(agent_ids)
+    except TypeError:
+        return agent_ids
+
+
+def _sortable(agent_ids):
+    """Whether agent ids can be compared with each other."""
+    try:
+        sorted(agent_ids)
+    except TypeError:
+        return False
+    return True
+
+
+def _bid_order(bids, keys=None):
+    """Slots of the placed bids sorted from highest to lowest bid."""
+    if keys is not None:
+        slots = np.flatnonzero(~np.isnan(bids))
+        return slots[np.lexsort((keys[slots], -bids[slots]))]
+    # Reversing the slots makes the stable sort put equal bids in descending
+    # slot order, just like sorting ``(bid, agent_id)`` tuples in reverse.
+    slots = np.flatnonzero(~np.isnan(bids))[::-1]
+    return slots[np.argsort(-bids[slots], kind='stable')]
+
+
+def _ask_order(asks, keys=None):
+    """Slots of the placed asks sorted from lowest to highest ask."""
+    slots = np.flatnonzero(~np.isnan(asks))
+    if keys is not None:
+        return slots[np.lexsort((keys[slots], asks[slots]))]
+    return slots[np.argsort(asks[slots], kind='stable')]
+
+
+def match_sort(bids, asks, bid_keys=None, ask_keys=None):
+    """
+    Match arrays of bids and asks by fully sorting both sides.
+
+    By default, this gives the same deals as ``MarketEngine.match`` with the
+    array index of each offer as its agent id.
+
+    Parameters
+    ----------
+    bids: ndarray
+        Bid of each buyer, ``NaN`` for no bid.
+
+    asks: ndarray
+        Ask of each seller, ``NaN`` for no ask.
+
+    bid_keys, ask_keys: ndarray, optional (default=None)
+        Numeric tie-breaking key of each buyer and seller. Among equal offers,
+        the one with the lowest key is matched first. By default, the buyer
+        with the highest and the seller with the lowest index go first.
+
+    Returns
+    -------
+    buyers: ndarray
+        Indices of the matched buyers, in matching order.
+
+    sellers: ndarray
+        Indices of the matched sellers, in matching order. The ``i``-th
+        seller is matched with the ``i``-th buyer.
+    """
+    bid_order = _bid_order(bids, bid_keys)
+    ask_order = _ask_order(asks, ask_keys)
+    n = min(len(bid_order), len(ask_order))
+    crossed = bids[bid_order[0:n]] >= asks[ask_order[0:n]]
+    n_deals = n if crossed.all() else np.argmin(crossed)
+    return bid_order[0:n_deals], ask_order[0:n_deals]
+
+
+def _best_offers(values, ties, k):
+    """Positions of the ``k`` lowest values in order, ties by lowest key."""
+    if k < len(values):
+        threshold = np.partition(values, k - 1)[k - 1]
+        candidates = np.flatnonzero(values <= threshold)
+    else:
+        candidates = np.arange(len(values))
+    order = np.lexsort((ties[candidates], values[candidates]))
+    return candidates[order[0:k]]
+
+
+def match_partial(bids, asks, bid_keys=None, ask_keys=None, k=8):
+    """
+    Match arrays of bids and asks using partial selection.
+
+    Instead of sorting both sides completely, offers that cannot cross are
+    dropped in a single pass, and only the best ``k`` of the remaining bids
+    and asks are selected and sorted. If all of them cross, ``k`` is doubled
+    and the selection repeated, until a bid lower than its ask is found. The
+    cost therefore grows linearly with the size of the order book and only
+    logarithmically with the number of deals. The result is identical to
+    ``match_sort``.
+
+    Parameters
+    ----------
+    bids: ndarray
+        Bid of each buyer, ``NaN`` for no bid.
+
+    asks: ndarray
+        Ask of each seller, ``NaN`` for no ask.
+
+    bid_keys, ask_keys: ndarray, optional (default=None)
+        Tie-breaking keys, see ``match_sort``.
+
+    k: int, optional (default=8)
+        Number of offers per side to select initially.
+
+    Returns
+    -------
+    buyers: ndarray
+        Indices of the matched buyers, in matching order.
+
+    sellers: ndarray
+        Indices of the matched sellers, in matching order.
+    """
+    buyers = np.flatnonzero(~np.isnan(bids))
+    sellers = np.flatnonzero(~np.isnan(asks))
+    if len(buyers) == 0 or len(sellers) == 0:
+        return buyers[0:0], sellers[0:0]
+
+    # Only bids above the lowest ask and asks below the highest bid can match
+    buyers = buyers[bids[buyers] >= asks[sellers].min()]
+    sellers = sellers[asks[sellers] <= bids[buyers].max(initial=-np.inf)]
+    n = min(len(buyers), len(sellers))
+    if n == 0:
+        return buyers[0:0], sellers[0:0]
+
+    # Ties are broken like in match_sort: highest buyer and lowest seller first
+    # unless keys are given
+    bid_values = -bids[buyers]
+    bid_ties = -buyers if bid_keys is None else bid_keys[buyers]
+    ask_values = asks[sellers]
+    ask_ties = sellers if ask_keys is None else ask_keys[sellers]
+    k = min(k, n)
+    while True:
+        best_bids = buyers[_best_offers(bid_values, bid_ties, k)]
+        best_asks = sellers[_best_offers(ask_values, ask_ties, k)]
+        crossed = bids[best_bids] >= asks[best_asks]
+        if not crossed.all():
+            n_deals = np.argmin(crossed)
+            return best_bids[0:n_deals], best_asks[0:n_deals]
+        if k == n:
+            return best_bids, best_asks
+        k = min(2*k, n)
+
+
+def _radix_argsort(values):
+    """
+    Stable argsort of float64 values by a least significant digit radix sort.
+
+    The bits of the values are mapped to unsigned integers of the same order
+    and sorted one byte at a time, skipping bytes that are equal for all
+    values. In a compiled kernel this is a few times faster than a merge sort
+    for large books.
+    """
+    n = len(values)
+    # Adding zero turns -0.0 into 0.0, which compare equal
+    bits = (values + 0.0).view(np.uint64)
+    sign = np.uint64(1) << np.uint64(63)
+    bits = np.where(bits & sign, ~bits, bits | sign)
+    # Count the digits of all bytes in a single pass
+    counts = np.zeros((8, 256), dtype=np.int64)
+    for i in range(n):
+        value = bits[i]
+        for byte in range(8):
+            counts[byte, value & np.uint64(255)] += 1
+            value >>= np.uint64(8)
+    order = np.arange(n)
+    buffer = np.empty_like(order)
+    for byte in range(8):
+        if counts[byte].max() == n:
+            continue
+        total = 0
+        for digit in range(256):
+            count = counts[byte, digit]
+            counts[byte, digit] = total
+            total += count
+        shift = np.uint64(8*byte)
+        for i in range(n):
+            digit = (bits[order[i]] >> shift) & np.uint64(255)
+            buffer[counts[byte, digit]] = order[i]
+            counts[byte, digit] += 1
+        order, buffer = buffer, order
+    return order
+
+
+def _order_offers(slots, prices, keys):
+    """
+    Sort ``slots`` by price and then by key.
+
+    Only the prices are sorted in full, with a radix sort for large books.
+    Runs of equal prices, which are rare for continuous prices, are then
+    sorted by key. Both sorts are stable, which gives the same order as the
+    lexsort in ``match_sort``.
+    """
+    values = prices[slots]
+    if len(slots) < 256:
+        order = slots[np.argsort(values, kind='mergesort')]
+    else:
+        order = slots[_radix_argsort(values)]
+    values = prices[order]
+    start = 0
+    for i in range(1, len(order) + 1):
+        if i == len(order) or values[i] != values[start]:
+            if i - start > 1:
+                run = order[start:i]
+                order[start:i] = run[np.argsort(keys[run], kind='mergesort')]
+            start = i
+    return order
+
+
+def _match_kernel(bids, asks, bid_keys, ask_keys):
+    """
+    Matching loop of ``match_numba``, written so that Numba can compile it.
+
+    Like in ``match_partial``, offers that cannot cross are dropped first.
+    The remaining offers are sorted by price and key, see ``_order_offers``,
+    and the crossing offers counted in a single loop.
+    """
+    placed_bids = bids[~np.isnan(bids)]
+    placed_asks = asks[~np.isnan(asks)]
+    if len(placed_bids) == 0 or len(placed_asks) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+    # Comparisons with NaN are false, so this also drops missing offers
+    buyers = np.flatnonzero(bids >= placed_asks.min())
+    sellers = np.flatnonzero(asks <= placed_bids.max())
+    buyers = _order_offers(buyers, -bids, bid_keys)
+    sellers = _order_offers(sellers, asks, ask_keys)
+    n = min(len(buyers), len(sellers))
+    n_deals = 0
+    while n_deals < n and bids[buyers[n_deals]] >= asks[sellers[n_deals]]:
+        n_deals += 1
+    return buyers[0:n_deals], sellers[0:n_deals]
+
+
+# Compiled on the first call of match_numba, so only its users import Numba
+_compiled_match_kernel = None
+_numba_tried = False
+
+
+def _compile_match_kernel():
+    """Compile ``_match_kernel`` with Numba, None if Numba is unusable."""
+    global _radix_argsort, _order_offers, _compiled_match_kernel, _numba_tried
+    if not _numba_tried:
+        _numba_tried = True
+        try:
+            from numba import njit
+        except Exception:
+            # Missing, or broken e.g. by an incompatible NumPy version
+            return None
+        # The kernel calls the compiled sorts, even when it is run uncompiled
+        _radix_argsort = njit(cache=True)(_radix_argsort)
+        _order_offers = njit(cache=True)(_order_offers)
+        _compiled_match_kernel = njit(cache=True)(_match_kernel)
+    return _compiled_match_kernel
+
+
+def match_numba(bids, asks, bid_keys=None, ask_keys=None):
+    """
+    Match arrays of bids and asks with a compiled kernel.
+
+    Numba is imported and the kernel compiled on first use. It drops the
+    offers that cannot cross and sorts the rest once by price and tie-breaking
+    key. If Numba is not installed or fails to import, this falls back to
+    ``match_sort``. Either way the
+    result is identical to ``match_sort``.
+
+    Parameters
+    ----------
+    bids: ndarray
+        Bid of each buyer, ``NaN`` for no bid.
+
+    asks: ndarray
+        Ask of each seller, ``NaN`` for no ask.
+
+    bid_keys, ask_keys: ndarray, optional (default=None)
+        Tie-breaking keys, see ``match_sort``.
+
+    Returns
+    -------
+    buyers: ndarray
+        Indices of the matched buyers, in matching order.
+
+    sellers: ndarray
+        Indices of the matched sellers, in matching order.
+    """
+    kernel = _compiled_match_kernel or _compile_match_kernel()
+    if kernel is None:
+        return match_sort(bids, asks, bid_keys, ask_keys)
+    if bid_keys is None:
+        bid_keys = -np.arange(len(bids))
+    if ask_keys is None:
+        ask_keys = np.arange(len(asks))
+    return kernel(np.asarray(bids, dtype=np.float64),
+                  np.asarray(asks, dtype=np.float64),
+                  np.asarray(bid_keys, dtype=np.float64),
+                  np.asarray(ask_keys, dtype=np.float64))
+
+
+def match_quantities(bids, asks, bid_quantities, ask_quantities,
+                     bid_keys=None, ask_keys=None):
+    """
+    Match arrays of bids and asks for several units per offer.
+
+    Offers are sorted like in ``match_sort``. The units offered are then
+    lined up in this order on both sides and the ``k``-th unit bought is
+    matched with the ``k``-th unit sold, as long as the bid for it is not
+    lower than the ask. Consecutive units of the same buyer and seller form a
+    single fill, so an offer can be filled partially or by several offers
+    of the other side. With a single unit per offer, this gives the same
+    deals as ``match_sort``.
+
+    Parameters
+    ----------
+    bids: ndarray
+        Bid of each buyer, ``NaN`` for no bid.
+
+    asks: ndarray
+        Ask of each seller, ``NaN`` for no ask.
+
+    bid_quantities, ask_quantities: ndarray
+        Number of units offered by each buyer and seller.
+
+    bid_keys, ask_keys: ndarray, optional (default=None)
+        Tie-breaking keys, see ``match_sort``.
+
+    Returns
+    -------
+    buyers: ndarray
+        Indices of the buyers of each fill, in matching order.
+
+    sellers: ndarray
+        Indices of the sellers of each fill, in matching order.
+
+    volumes: ndarray
+        Number of units of each fill.
+    """
+    bid_order = _bid_order(bids, bid_keys)
+    ask_order = _ask_order(asks, ask_keys)
+    bid_order = bid_order[bid_quantities[bid_order] > 0]
+    ask_order = ask_order[ask_quantities[ask_order] > 0]
+    if len(bid_order) == 0 or len(ask_order) == 0:
+        return bid_order[0:0], ask_order[0:0], np.zeros(0)
+
+    # Each unit interval (start, end] lies within one bid and one ask
+    bid_ends = np.cumsum(bid_quantities[bid_order])
+    ask_ends = np.cumsum(ask_quantities[ask_order])
+    ends = np.union1d(bid_ends, ask_ends)
+    ends = ends[ends <= min(bid_ends[-1], ask_ends[-1])]
+    volumes = np.diff(ends, prepend=0)
+    buyers = bid_order[np.searchsorted(bid_ends, ends)]
+    sellers = ask_order[np.searchsorted(ask_ends, ends)]
+
+    crossed = bids[buyers] >= asks[sellers]
+    n_fills = len(crossed) if crossed.all() else np.argmin(crossed)
+    return buyers[0:n_fills], sellers[0:n_fills], volumes[0:n_fills]
+
+
+MATCHERS = {
+    'sort': match_sort,
+    'partial': match_partial,
+    'numba': match_numba,
+}
+
+TIE_BREAKS = ('slot', 'arrival', 'random')
+
+# Up to this number of agents, ``MarketEngine`` matches arrays of offers on
+# Python lists, above it NumPy is faster
+LIST_STEP_AGENTS = 64
+
+# ``MarketEngine.run_episode`` computes the offers of agents without
+# observations for this many rounds at once
+EPISODE_ROUNDS = 16
+
+
+class LazyList(Sequence):
+    """
+    Read-only list whose entries are computed on access.
+
+    Parameters
+    ----------
+    length: int
+        Number of entries.
+
+    getter: callable
+        Function computing the entry for a nonnegative index.
+    """
+    def __init__(self, length, getter):
+        self._length = length
+        self._getter = getter
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._length))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("list index out of range")
+        return self._getter(index)
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class MarketHistory:
+    """
+    Columnar store of the offers and deals of a market game.
+
+    The arrays are preallocated and reused when the history is cleared, so
+    recording a step only writes into existing memory. How many steps are
+    kept is determined by ``retention``: either all steps, in which case the
+    arrays are grown if more than ``capacity`` steps are recorded, or only
+    the last ``retention`` steps in a ring buffer.
+
+    Parameters
+    ----------
+    n_agents: int
+        Number of agent slots.
+
+    capacity: int
+        Number of steps to preallocate when keeping the full history.
+
+    retention: int, optional (default=None)
+        Number of most recent steps to keep. If ``None``, all steps are kept.
+        If 0, no steps are kept, but the last step can still be read through
+        ``last_offers``, ``last_deals`` and ``last_ranks``.
+
+    Attributes
+    ----------
+    offers: ndarray of shape (rows, n_agents)
+        The offer of each slot per step, ``NaN`` if no offer was made.
+
+    deals: ndarray of shape (rows, n_agents)
+        The deal price of each slot per step, ``NaN`` if not matched.
+
+    ranks: ndarray of shape (rows, n_agents)
+        The position of the deal of each slot in the matching order of that
+        step, -1 if not matched. The buyer and seller of a deal share a rank.
+
+    n_steps: int
+        Number of steps recorded since the last ``clear``, including the ones
+        that are no longer retained.
+    """
+    def __init__(self, n_agents, capacity, retention=None):
+        self.retention = retention
+        rows = max(capacity if retention is None else retention, 1)
+        self.offers = np.full((rows, n_agents), np.nan)
+        self.deals = np.full((rows, n_agents), np.nan)
+        self.ranks = np.full((rows, n_agents), -1)
+        self.clear()
+
+    def __len__(self):
+        if self.retention is None:
+            return self.n_steps
+        return min(self.n_steps, self.retention)
+
+    def clear(self):
+        """Forget all recorded steps, keeping the allocated arrays."""
+        self.n_steps = 0
+        self._last = 0
+
+    def row(self, index):
+        """Array row of the ``index``-th retained step, oldest first."""
+        step = self.n_steps - len(self) + index
+        return step % len(self.offers)
+
+    def rows(self):
+        """Array rows of all retained steps, oldest first."""
+        return [self.row(index) for index in range(len(self))]
+
+    def next_row(self):
+        """Claim the row to record the next step in, growing if needed."""
+        if self.retention is None and self.n_steps == len(self.offers):
+            self.offers = np.concatenate([self.offers,
+                                          np.full_like(self.offers, np.nan)])
+            self.deals = np.concatenate([self.deals,
+                                         np.full_like(self.deals, np.nan)])
+            self.ranks = np.concatenate([self.ranks,
+                                         np.full_like(self.ranks, -1)])
+        self._last = self.n_steps % len(self.offers)
+        self.n_steps += 1
+        return self._last
+
+    @property
+    def matched(self):
+        """Boolean mask of the matched slots per retained step."""
+        return self.ranks[self.rows()] >= 0
+
+    @property
+    def last_offers(self):
+        """View of the offers of the last recorded step."""
+        return self.offers[self._last]
+
+    @property
+    def last_deals(self):
+        """View of the deal prices of the last recorded step."""
+        return self.deals[self._last]
+
+    @property
+    def last_ranks(self):
+        """View of the deal ranks of the last recorded step."""
+        return self.ranks[self._last]
+
 
 class MarketEngine:
     """
     Core double auction, single unit market matching enigne
 
+    Agents trade a single unit by default. With ``quantities``, agents can
+    trade several units, which are matched with ``match_quantities`` and may
+    be filled partially over several steps.
+
+    Agent ids are mapped once to dense integer slots: buyers occupy slots
+    ``0, ..., n_buyers - 1`` and sellers the remaining ones. Ids are sorted
+    within each side when possible, so that equal offers are resolved the
+    same way as in ``match``. The ``step`` function accepts either a dict of
+    offers indexed by agent id or an array of offers indexed by slot.
+
+    With the default ``matcher`` and ``tie_break``, offers are matched on
+    Python lists where that is faster than NumPy. A dict of offers is matched
+    with ``match`` as ``(offer, agent_id)`` tuples, whose cost only depends
+    on the agents that made an offer, and the slot arrays ``done_mask``,
+    ``last_offers`` and ``history`` are only filled in when they are read.
+    Arrays of offers for up to ``LIST_STEP_AGENTS`` agents are matched on
+    lists of ``(offer, slot)`` tuples.
+
     Parameters
     ----------
     buyers : array_like
@@ -15,34 +552,146 @@ class MarketEngine:
     max_steps: int (optional, default=30)
         Number of maximum market rounds.
 
+    history_length: int (optional, default=None)
+        Number of most recent steps to keep in the history. ``None`` keeps
+        the full history, 0 keeps none. Information settings state how much
+        history they need in their ``history_length`` attribute.
+
+    matcher: str (optional, default='sort')
+        Matching algorithm used in ``step``, one of the keys of ``MATCHERS``.
+        ``'sort'`` sorts all offers, ``'partial'`` only selects as many of the
+        best offers as needed, see ``match_partial``, and ``'numba'`` uses a
+        compiled kernel, see ``match_numba``. All give the same deals.
+
+    tie_break: str (optional, default='slot')
+        How equal offers on the same side are ordered, one of ``TIE_BREAKS``.
+        ``'slot'`` orders them like the ``(offer, agent_id)`` tuples in
+        ``match``: the buyer with the highest and the seller with the lowest
+        slot goes first. ``'arrival'`` matches the offer that comes first in
+        the offers dict first, or the lowest slot for array offers.
+        ``'random'`` draws a new random order in every step.
+
+    rng: Generator or RandomState (optional, default=None)
+        Random number generator for ``tie_break='random'``. Defaults to the
+        global ``np.random``.
+
+    quantities: dict (optional, default=None)
+        Number of units each agent trades in a game, indexed by agent id.
+        Agents that are left out trade a single unit. An agent is done once
+        all of its units are traded. If given, ``matcher`` is not used.
+
+    book_stats: bool (optional, default=True)
+        Whether ``stats`` tracks the number of bids and asks and the spread.
+        They come for free when offers are matched on lists, but take an
+        extra pass over the offers for larger books, other matchers and
+        ``quantities``.
 
     Attributes
     -------
     time: int
         The current time step the market is in. Starts at 0.
 
+    agent_ids: list
+        The agent id of each slot.
+
+    slots: dict
+        The slot of each agent, indexed by agent id.
+
+    done_mask: ndarray of shape (n_agents,)
+        Boolean mask of the slots that are done for this game.
+
+    last_offers: ndarray of shape (n_agents,)
+        The offer of each slot in the last round, ``NaN`` if the agent made
+        no offer or if no round was played yet. This is kept up to date
+        regardless of ``history_length``.
+
     done: set
         The set of agent ids that are done for this game. If ``max_steps`` is
-        reached, this will contain all agent ids.
+        reached, this will contain all agent ids. Agents are added as they
+        become done, so it always agrees with ``done_mask``.
+
+    history: MarketHistory object
+        Columnar record of the offers and deals of the retained steps. It is
+        allocated once and reused across resets.
 
     offer_history: list
-        This is a list of all offers up until the current step. Each entry of
-        this list is a tuple of the form ``(bids, asks)`` which represent the
-        set of bids and asks respectively for that time step. Both ``bids`` and
-        ``asks`` are in the form used by the matcher, i.e., they are lists of
-        tuples of the form ``[(offer1, agent_id1), (offer2, agent_id2), ...]``.
+        This is a list of all retained offers up until the current step. Each
+        entry of this list is a tuple of the form ``(bids, asks)`` which
+        represent the set of bids and asks respectively for that time step.
+        Both ``bids`` and ``asks`` are in the form used by the matcher, i.e.,
+        they are lists of tuples of the form
+        ``[(offer1, agent_id1), (offer2, agent_id2), ...]``. Entries are
+        computed lazily from ``history`` when accessed.
 
     deal_history: list
-        A list of all deals up until the current time step. Each entry contains
-        a dict of the form ``{agent_id1: deal_price1, ...}`` for all agents
-        that were matched in that round.
+        A list of all retained deals up until the current time step. Each
+        entry contains a dict of the form ``{agent_id1: deal_price1, ...}``
+        for all agents that were matched in that round. Entries are computed
+        lazily from ``history`` when accessed.
+
+    counters: dict
+        Running totals over all steps since creation or ``reset_stats``, kept
+        regardless of ``history_length``. See ``stats`` for a summary.
+
+    gauges: dict
+        Measurements of the last step, see ``stats``.
+
+    quantities: ndarray of shape (n_agents,) or None
+        Number of units of each slot per game, ``None`` for single units.
+
+    remaining: ndarray of shape (n_agents,) or None
+        Number of units each slot has left to trade in this game.
+
+    filled: ndarray of shape (n_agents,) or None
+        Number of units each slot traded in the last step.
     """
 
-    def __init__(self, buyers, sellers, max_steps=30):
+    def __init__(self, buyers, sellers, max_steps=30, history_length=None,
+                 matcher='sort', tie_break='slot', rng=None, quantities=None,
+                 book_stats=True):
+        if matcher not in MATCHERS:
+            raise ValueError(f"Unknown matcher {matcher}")
+        if tie_break not in TIE_BREAKS:
+            raise ValueError(f"Unknown tie-breaking policy {tie_break}")
         self.buyers = set(buyers)
         self.sellers = set(sellers)
         self.agents = self.buyers.union(self.sellers)
         self.max_steps = max_steps
+        self.matcher = matcher
+        self._match = MATCHERS[matcher]
+        self.tie_break = tie_break
+        self.rng = np.random if rng is None else rng
+        self.book_stats = book_stats
+
+        self.agent_ids = _sorted_ids(buyers) + _sorted_ids(sellers)
+        self.slots = {
+            agent_id: slot for slot, agent_id in enumerate(self.agent_ids)
+        }
+        self.n_buyers = len(self.buyers)
+        self.n_sellers = len(self.sellers)
+        self.n_agents = len(self.agent_ids)
+        self._history = MarketHistory(self.n_agents, max_steps, history_length)
+        self._last_offers = np.full(self.n_agents, np.nan)
+        self._done_mask = np.zeros(self.n_agents, dtype=bool)
+        self._pending = []
+        self.quantities = None
+        self.remaining = None
+        self.filled = None
+        if quantities is not None:
+            self.quantities = np.array([
+                quantities.get(agent_id, 1) for agent_id in self.agent_ids
+            ])
+            self.remaining = self.quantities.copy()
+            self.filled = np.zeros_like(self.quantities)
+
+        # Sorting (offer, agent_id) tuples breaks ties by slot as long as the
+        # ids of each side are sortable
+        lists = matcher == 'sort' and tie_break == 'slot' \
+            and quantities is None
+        self._list_step = lists and self.n_agents <= LIST_STEP_AGENTS
+        self._tuple_step = lists and _sortable(self.buyers) \
+            and _sortable(self.sellers)
+        self.reset_stats()
         self.reset()
 
 
@@ -50,16 +699,203 @@ class MarketEngine:
         """Reset the market to its initial unmatched state."""
         self.time = 0
         self.done = set()
-        self.offer_history = list()
-        self.deal_history = list()
+        self._n_done = 0
+        self._history.clear()
+        self._pending.clear()
+        # The arrays are cleared on their next access
+        self._cleared = True
+        self._stale = True
+        if self.quantities is not None:
+            self.remaining[:] = self.quantities
+            self.filled[:] = 0
 
 
-    def step(self, offers):
+    def reset_stats(self):
+        """Reset the counters and gauges of ``stats``."""
+        self.counters = dict.fromkeys([
+            'steps', 'episodes', 'episode_steps', 'deals', 'bids', 'asks',
+            'spread_steps', 'spread_sum',
+        ], 0)
+        self.gauges = {'deals': 0, 'bids': 0, 'asks': 0, 'spread': np.nan}
+
+
+    def stats(self):
         """
-        Compute the next market state given a set of offers.
+        Snapshot of the market metrics.
+
+        The counters are updated in every ``step``, so no history is needed
+        to compute them. Counting steps and deals costs constant work. The
+        depth and spread of the book are only tracked with ``book_stats``,
+        which costs a pass over the offers unless they are matched on lists.
+
+        Returns
+        -------
+        stats: dict
+            A dictionary with the following entries:
+
+            - ``steps``, ``episodes``, ``deals``: total number of steps,
+              finished games and deals.
+            - ``deals_per_step``, ``mean_bid_depth``, ``mean_ask_depth``:
+              average number of deals, bids and asks per step.
+            - ``mean_spread``: average difference between the best ask and the
+              best bid, over the steps that had both.
+            - ``mean_episode_length``: average number of steps of the
+              finished games.
+            - ``last_deals``, ``last_bid_depth``, ``last_ask_depth``,
+              ``last_spread``: the same quantities in the last step.
+            - ``time``, ``done_fraction``: the current time step and the
+              fraction of agents that are done in the current game.
+
+            Averages without any data, and the depths and spreads without
+            ``book_stats``, are ``NaN``.
+        """
+        counters, gauges = self.counters, self.gauges
+
+        def ratio(a, b):
+            return a/b if b else np.nan
+
+        steps = counters['steps']
+        book = self.book_stats
+        return {
+            'steps': steps,
+            'episodes': counters['episodes'],
+            'deals': counters['deals'],
+            'deals_per_step': ratio(counters['deals'], steps),
+            'mean_bid_depth': ratio(counters['bids'], steps if book else 0),
+            'mean_ask_depth': ratio(counters['asks'], steps if book else 0),
+            'mean_spread': ratio(counters['spread_sum'],
+                                 counters['spread_steps']),
+            'mean_episode_length': ratio(counters['episode_steps'],
+                                         counters['episodes']),
+            'last_deals': gauges['deals'],
+            'last_bid_depth': gauges['bids'] if book else np.nan,
+            'last_ask_depth': gauges['asks'] if book else np.nan,
+            'last_spread': gauges['spread'],
+            'time': self.time,
+            'done_fraction': ratio(self._n_done, self.n_agents),
+        }
+
+
+    @property
+    def done_mask(self):
+        if self._stale:
+            self._sync()
+        return self._done_mask
+
+
+    @property
+    def last_offers(self):
+        if self._stale:
+            self._sync()
+        return self._last_offers
+
+
+    @property
+    def history(self):
+        if self._stale:
+            self._sync()
+        return self._history
+
+
+    def _sync(self):
+        """
+        Bring ``done_mask``, ``last_offers`` and ``history`` up to date.
+
+        Steps with dicts of offers on small books only keep the tuples they
+        matched, which are written into the arrays here once the arrays are
+        read. Clearing the arrays in ``reset`` is deferred the same way.
+        """
+        self._stale = False
+        done_mask = self._done_mask
+        if self._cleared:
+            self._cleared = False
+            done_mask.fill(False)
+            self._last_offers.fill(np.nan)
+        pending = self._pending
+        if not pending:
+            return
+
+        history = self._history
+        slots = self.slots
+        n_agents = self.n_agents
+        # Rows that were overwritten in the ring buffer are not written
+        first = len(pending) - len(history.offers)
+        for i, (row, bids, asks, deals) in enumerate(pending):
+            for agent_id in deals:
+                done_mask[slots[agent_id]] = True
+            if i < first:
+                continue
+            offers = [np.nan]*n_agents
+            for offer, agent_id in bids:
+                offers[slots[agent_id]] = offer
+            for offer, agent_id in asks:
+                offers[slots[agent_id]] = offer
+            # Deals alternate between buyer and seller in matching order
+            prices = [np.nan]*n_agents
+            ranks = [-1]*n_agents
+            for k, (agent_id, price) in enumerate(deals.items()):
+                prices[slots[agent_id]] = price
+                ranks[slots[agent_id]] = k//2
+            history.offers[row] = offers
+            history.deals[row] = prices
+            history.ranks[row] = ranks
+
+        self._last_offers[:] = history.offers[pending[-1][0]]
+        if self._n_done == self.n_agents:
+            done_mask.fill(True)
+        pending.clear()
+
+
+    @property
+    def offer_history(self):
+        return LazyList(len(self.history), self._offer_lists)
+
+
+    @property
+    def deal_history(self):
+        return LazyList(len(self.history), self._deal_dict)
 
-        This function will update each of the class attributes ``time``,
-        ``done``, ``offer_history`` and ``deal_history``.
+
+    def _offer_lists(self, index):
+        """Sorted bids and asks of a retained step as lists of tuples."""
+        offers = self.history.offers[self.history.row(index)]
+        n_buyers = self.n_buyers
+        ids = self.agent_ids
+        values = offers.tolist()
+        bid_slots = _bid_order(offers[:n_buyers]).tolist()
+        ask_slots = (_ask_order(offers[n_buyers:]) + n_buyers).tolist()
+        return ([(values[slot], ids[slot]) for slot in bid_slots],
+                [(values[slot], ids[slot]) for slot in ask_slots])
+
+
+    def _deal_dict(self, index):
+        """Deals of a retained step as a dict in matching order."""
+        return self._row_deals(self.history.row(index))
+
+
+    def _row_deals(self, row):
+        """Deals of a history row as a dict, ordered by rank, buyer first."""
+        ranks = self.history.ranks[row]
+        deals = self.history.deals[row].tolist()
+        ids = self.agent_ids
+        slots = np.flatnonzero(ranks >= 0)
+        slots = slots[np.lexsort((slots >= self.n_buyers, ranks[slots]))]
+        return {ids[slot]: deals[slot] for slot in slots.tolist()}
+
+
+    def _pairs_to_dict(self, buyer_slots, seller_slots, prices):
+        """Deals as a dict ``{buyer_id: price, seller_id: price, ...}``."""
+        ids = self.agent_ids
+        result = dict()
+        for buyer, seller in zip(buyer_slots.tolist(), seller_slots.tolist()):
+            result[ids[buyer]] = prices[buyer]
+            result[ids[seller]] = prices[seller]
+        return result
+
+
+    def offers_to_array(self, offers):
+        """
+        Convert a dict of offers indexed by agent id to an array of offers.
 
         Parameters
         ----------
@@ -68,37 +904,439 @@ class MarketEngine:
 
         Returns
         -------
-        deals: dict
-            A dictionary indexed by agent_id containing the deal price of each
-            succesfully matched market agent.
+        offers: ndarray of shape (n_agents,)
+            The offer of each slot, ``NaN`` if the agent made no offer.
+        """
+        slots = self.slots
+        try:
+            index = [slots[agent_id] for agent_id in offers]
+        except KeyError as error:
+            raise RuntimeError(
+                f"Received offer from unkown agent {error.args[0]}"
+            ) from None
+        result = np.full(self.n_agents, np.nan)
+        result[index] = list(offers.values())
+        return result
+
+
+    def _tie_keys(self, offers):
+        """Tie-breaking keys of the buyers and sellers for ``tie_break``."""
+        if self.tie_break == 'slot':
+            return None, None
+        if self.tie_break == 'random':
+            keys = self.rng.permutation(self.n_agents)
+        elif isinstance(offers, dict):
+            # Agents without offer keep the last key, they are not matched
+            keys = np.full(self.n_agents, self.n_agents)
+            keys[[self.slots[agent_id] for agent_id in offers]] = \
+                np.arange(len(offers))
+        else:
+            keys = np.arange(self.n_agents)
+        return keys[:self.n_buyers], keys[self.n_buyers:]
+
+
+    def step(self, offers, quantities=None):
         """
+        Compute the next market state given a set of offers.
+
+        This function will update each of the class attributes ``time``,
+        ``done``, ``done_mask``, ``last_offers`` and ``history``.
+
+        Parameters
+        ----------
+        offers: dict or array_like
+            A dictionary of offers indexed by agent_id, or an array of shape
+            ``(n_agents,)`` with the offer of each slot and ``NaN`` for no
+            offer. Offers of agents that are done are ignored.
+
+        quantities: dict or array_like, optional (default=None)
+            Only used if the market has ``quantities``. The number of units
+            offered, indexed like ``offers``. It is capped by the number of
+            units each agent has left, which is also the default for agents
+            that are left out or ``NaN``.
+
+        Returns
+        -------
+        deals: dict or ndarray
+            If ``offers`` is a dict, a dictionary indexed by agent_id
+            containing the deal price of each succesfully matched market agent.
+            Otherwise an array of shape ``(n_agents,)`` with the deal price of
+            each slot and ``NaN`` for agents that were not matched. Agents
+            that traded several units get their average price, the units are
+            in ``filled``.
+        """
+        as_dict = isinstance(offers, dict)
+        if as_dict and self._tuple_step:
+            return self._step_tuples(offers)
+        if as_dict:
+            # Offers of done agents are ignored, so don't convert them
+            done = self.done
+            if done:
+                offers = {agent_id: offer for agent_id, offer in offers.items()
+                          if agent_id not in done}
+            offers_dict, offers = offers, self.offers_to_array(offers)
+            bid_keys, ask_keys = self._tie_keys(offers_dict)
+        else:
+            bid_keys, ask_keys = self._tie_keys(offers)
+
+        # Offers are written straight into the next row of the history
+        history = self.history
+        row = history.next_row()
+        history.offers[row] = offers
+        offers = history.offers[row]
+        offers[self._done_mask] = np.nan
+        self._last_offers[:] = offers
+
+        n_buyers = self.n_buyers
+        if self.quantities is not None:
+            return self._step_quantities(row, quantities, bid_keys, ask_keys,
+                                         as_dict)
+        if self._list_step:
+            return self._step_lists(row, as_dict)
+        buyer_slots, seller_slots = self._match(offers[:n_buyers],
+                                                offers[n_buyers:],
+                                                bid_keys, ask_keys)
+        seller_slots = seller_slots + n_buyers
+        return self._settle(row, buyer_slots, seller_slots, as_dict)
+
+
+    def _step_tuples(self, offers):
+        """
+        Step with a dict of offers by matching ``(offer, agent_id)`` tuples.
+
+        This is the original implementation of ``step``: the offers are
+        matched with ``match`` and the tuples are kept until ``_sync`` writes
+        them into the arrays.
+        """
+        done = self.done
+        buyers = self.buyers
+        sellers = self.sellers
         bids = []
         asks = []
-
         for agent_id, offer in offers.items():
-            if agent_id in self.done:
+            if agent_id in done or offer != offer:
                 continue
-            elif agent_id in self.buyers:
+            elif agent_id in buyers:
                 bids.append((offer, agent_id))
-            elif agent_id in self.sellers:
+            elif agent_id in sellers:
                 asks.append((offer, agent_id))
             else:
                 raise RuntimeError(f"Received offer from unkown agent {agent_id}")
 
         deals = self.match(bids, asks)
-        self.deal_history.append(deals)
-        self.offer_history.append((bids, asks))
+        self._pending.append((self._history.next_row(), bids, asks, deals))
+        self._stale = True
+        done.update(deals)
+        self._update_stats(len(deals)//2, (
+            len(bids), len(asks),
+            asks[0][0] - bids[0][0] if bids and asks else np.nan
+        ))
+        self._finish_step(len(deals))
+        return deals
+
+
+    def _step_lists(self, row, as_dict):
+        """
+        Match the offers in history row ``row`` on lists and record the deals.
+
+        The offers are matched like in ``match``, with the slots as agent ids,
+        and the deals are written into the history row by row.
+        """
+        history = self._history
+        n_buyers = self.n_buyers
+        values = history.offers[row].tolist()
+        bids = [(bid, slot) for slot, bid in enumerate(values[:n_buyers])
+                if bid == bid]
+        asks = [(ask, slot) for slot, ask in enumerate(values[n_buyers:],
+                                                       n_buyers)
+                if ask == ask]
+        bids.sort(reverse=True)
+        asks.sort()
+
+        ids = self.agent_ids
+        done_mask = self._done_mask
+        deals = dict()
+        prices = [np.nan]*self.n_agents
+        ranks = [-1]*self.n_agents
+        n_deals = 0
+        for (bid, buyer), (ask, seller) in zip(bids, asks):
+            if bid < ask:
+                break
+            price = (bid + ask)/2
+            prices[buyer] = prices[seller] = price
+            ranks[buyer] = ranks[seller] = n_deals
+            done_mask[buyer] = done_mask[seller] = True
+            deals[ids[buyer]] = price
+            deals[ids[seller]] = price
+            n_deals += 1
+        history.deals[row] = prices
+        history.ranks[row] = ranks
+
+        self.done.update(deals)
+        self._update_stats(n_deals, (
+            len(bids), len(asks),
+            asks[0][0] - bids[0][0] if bids and asks else np.nan
+        ))
+        self._finish_step(2*n_deals)
+        if as_dict:
+            return deals
+        return history.deals[row].copy()
+
+
+    def _step_quantities(self, row, quantities, bid_keys, ask_keys, as_dict):
+        """Match the offers in history row ``row`` for several units."""
+        history = self._history
+        offers = history.offers[row]
+        units = self.remaining
+        if quantities is not None:
+            if isinstance(quantities, dict):
+                quantities = self.offers_to_array(quantities)
+            units = np.fmin(units, quantities)
+
+        n_buyers = self.n_buyers
+        buyers, sellers, volumes = match_quantities(
+            offers[:n_buyers], offers[n_buyers:], units[:n_buyers],
+            units[n_buyers:], bid_keys, ask_keys
+        )
+        sellers = sellers + n_buyers
+        prices = (offers[buyers] + offers[sellers])/2
+
+        # Each agent gets its average price and the rank of its first fill
+        n_agents = self.n_agents
+        filled = np.bincount(buyers, volumes, n_agents) \
+            + np.bincount(sellers, volumes, n_agents)
+        values = np.bincount(buyers, volumes*prices, n_agents) \
+            + np.bincount(sellers, volumes*prices, n_agents)
+        matched = filled > 0
+        history.deals[row] = np.nan
+        history.deals[row, matched] = values[matched]/filled[matched]
+        ranks = np.arange(len(volumes))
+        history.ranks[row] = -1
+        history.ranks[row, buyers[::-1]] = ranks[::-1]
+        history.ranks[row, sellers[::-1]] = ranks[::-1]
+
+        self.filled[:] = filled
+        self.remaining -= self.filled
+        done_mask = self._done_mask
+        new_done = np.flatnonzero((self.remaining <= 0) & ~done_mask)
+        done_mask[new_done] = True
+        ids = self.agent_ids
+        self.done.update([ids[slot] for slot in new_done.tolist()])
+        self._update_stats(len(volumes),
+                           self._depth(offers) if self.book_stats else None)
+        self._finish_step(len(new_done), done_mask[:n_buyers].all()
+                          or done_mask[n_buyers:].all())
+        if as_dict:
+            return self._row_deals(row)
+        return history.deals[row].copy()
+
+
+    def _settle(self, row, buyer_slots, seller_slots, as_dict, prices=None,
+                book=None):
+        """
+        Record the deals of the offers in history row ``row`` and advance time.
+
+        The matched buyer and seller slots are given in matching order. The
+        deal prices default to the mid-prices of the matched offers. The
+        number of bids and asks and the spread are computed from the offers
+        for ``book_stats`` unless given in ``book``. The deals are returned
+        like in ``step``.
+        """
+        history = self._history
+        offers = history.offers[row]
+        buyer_slots = np.asarray(buyer_slots, dtype=int)
+        seller_slots = np.asarray(seller_slots, dtype=int)
+        n_deals = len(buyer_slots)
+        if prices is None:
+            prices = (offers[buyer_slots] + offers[seller_slots])/2
+
+        deals = history.deals[row]
+        deals.fill(np.nan)
+        deals[buyer_slots] = prices
+        deals[seller_slots] = prices
+        ranks = history.ranks[row]
+        ranks.fill(-1)
+        ranks[buyer_slots] = np.arange(n_deals)
+        ranks[seller_slots] = np.arange(n_deals)
+
+        self._done_mask[buyer_slots] = True
+        self._done_mask[seller_slots] = True
+        ids = self.agent_ids
+        self.done.update([ids[slot] for slot in buyer_slots.tolist()])
+        self.done.update([ids[slot] for slot in seller_slots.tolist()])
+        if book is None and self.book_stats:
+            book = self._depth(offers)
+        self._update_stats(n_deals, book)
+        # Matched agents could not have been done before this step
+        self._finish_step(2*n_deals)
+
+        if as_dict:
+            return self._pairs_to_dict(buyer_slots, seller_slots,
+                                       deals.tolist())
+        return deals.copy()
+
+
+    def _finish_step(self, n_done, sides_done=None):
+        """
+        Advance time and end the game if it is over.
+
+        ``n_done`` is the number of agents that became done in this step.
+        Unless ``sides_done`` tells whether all buyers or all sellers are done,
+        this is derived from the number of done agents: with a single unit
+        each, buyers and sellers become done in pairs, so one side is done
+        once the smaller side is.
+        """
+        over = self._n_done == self.n_agents
         self.time += 1
+        self._n_done += n_done
+        if over:
+            return
+        if sides_done is None:
+            sides_done = self._n_done >= 2*min(self.n_buyers, self.n_sellers)
+        if sides_done or self.time >= self.max_steps:
+            self.counters['episodes'] += 1
+            self.counters['episode_steps'] += self.time
+            self._n_done = self.n_agents
+            self.done = set(self.agents)
+            if not self._stale:
+                self._done_mask.fill(True)
 
-        for agent_id in deals:
-            self.done.add(agent_id)
 
-        if self.time >= self.max_steps \
-           or self.buyers.issubset(self.done) \
-           or self.sellers.issubset(self.done):
-            self.done = self.agents
+    def _depth(self, offers):
+        """Number of bids and asks and the spread of an array of offers."""
+        bids, asks = offers[:self.n_buyers], offers[self.n_buyers:]
+        n_bids = len(bids) - np.count_nonzero(np.isnan(bids))
+        n_asks = len(asks) - np.count_nonzero(np.isnan(asks))
+        spread = np.nan
+        if n_bids and n_asks:
+            spread = np.fmin.reduce(asks) - np.fmax.reduce(bids)
+        return n_bids, n_asks, spread
 
-        return deals
+
+    def _update_stats(self, n_deals, book=None):
+        """
+        Update the counters and gauges with the deals of a step and, for
+        ``book_stats``, the number of bids and asks and the spread in ``book``.
+        """
+        counters, gauges = self.counters, self.gauges
+        counters['steps'] += 1
+        counters['deals'] += n_deals
+        gauges['deals'] = n_deals
+        if not self.book_stats:
+            return
+        n_bids, n_asks, spread = book
+        counters['bids'] += n_bids
+        counters['asks'] += n_asks
+        if n_bids and n_asks:
+            counters['spread_steps'] += 1
+            counters['spread_sum'] += spread
+        gauges['bids'] = n_bids
+        gauges['asks'] = n_asks
+        gauges['spread'] = spread
+
+
+    def run_episode(self, population, setting=None):
+        """
+        Play a whole game with a population of agents until all are done.
+
+        The market is reset first. If no agent of the population needs
+        observations, the offers of ``EPISODE_ROUNDS`` rounds are computed at
+        once with ``population.get_offers``, otherwise round by round. Only
+        agents that are not done make offers, as a dict if the market matches
+        dicts on lists and as an array otherwise, so that each round costs
+        about as much as a plain loop over ``step``.
+
+        Parameters
+        ----------
+        population: AgentPopulation object
+            The agents to play the game with. All of them must have a slot in
+            this market. Agents of the market outside of the population make
+            no offers.
+
+        setting: InformationSetting object, optional (default=None)
+            Information setting that gives the observations of
+            ``population.other_agents``. It can be omitted if there are none.
+
+        Returns
+        -------
+        prices: ndarray
+            The deal price of each agent in ``population.agents``, ``NaN`` if
+            the agent was not matched. With ``quantities``, the average price
+            of all units the agent traded.
+
+        times: ndarray
+            The round in which each agent was (first) matched, -1 if it was
+            not.
+
+        rewards: ndarray
+            The reward of each agent, i.e., its gain with respect to its
+            reservation price summed over the traded units, 0 if the agent
+            was not matched.
+        """
+        agents = population.agents
+        ids = [agent.name for agent in agents]
+        positions = {agent_id: k for k, agent_id in enumerate(ids)}
+        slots = np.array([self.slots[agent_id] for agent_id in ids], dtype=int)
+        other_ids = [agent.name for agent in population.other_agents]
+        self.reset()
+        population.reset()
+
+        values = [0.0]*len(agents)
+        volumes = [0]*len(agents)
+        times = [-1]*len(agents)
+        active = list(range(len(agents)))
+        rounds = []
+        while len(self.done) < self.n_agents:
+            time = self.time
+            if other_ids:
+                states = setting.get_states(
+                    [agent_id for agent_id in other_ids
+                     if agent_id not in self.done], self
+                )
+                row = population.get_offers(time, [
+                    states.get(agent_id) for agent_id in other_ids
+                ]).tolist()
+            else:
+                if time % EPISODE_ROUNDS == 0:
+                    rounds = population.get_offers(
+                        np.arange(time, time + EPISODE_ROUNDS)
+                    ).tolist()
+                row = rounds[time % EPISODE_ROUNDS]
+
+            if self._tuple_step:
+                deals = self.step({ids[k]: row[k] for k in active})
+                fills = [(agent_id, price, 1)
+                         for agent_id, price in deals.items()]
+            else:
+                offers = np.full(self.n_agents, np.nan)
+                offers[slots] = row
+                deals = self.step(offers)
+                matched = np.flatnonzero(~np.isnan(deals))
+                units = [1]*len(matched) if self.quantities is None \
+                    else self.filled[matched].tolist()
+                fills = list(zip([self.agent_ids[slot] for slot in matched],
+                                 deals[matched].tolist(), units))
+            if fills:
+                for agent_id, price, units in fills:
+                    k = positions.get(agent_id)
+                    if k is not None:
+                        values[k] += price*units
+                        volumes[k] += units
+                        if times[k] < 0:
+                            times[k] = time
+                active = [k for k in active if ids[k] not in self.done]
+
+        volumes = np.array(volumes, dtype=float)
+        with np.errstate(invalid='ignore'):
+            prices = np.array(values)/volumes
+        reservation_prices = np.array(
+            [agent.reservation_price for agent in agents], dtype=float
+        )
+        signs = np.array(
+            [1 if agent.role == 'seller' else -1 for agent in agents]
+        )
+        rewards = np.nan_to_num((prices - reservation_prices)*signs*volumes)
+        return prices, np.array(times), rewards
 
 
     @staticmethod
@@ -146,3 +1384,479 @@ class MarketEngine:
                 break
         return deals
 
+
+
+class OrderBookMarketEngine(MarketEngine):
+    """
+    Market engine with a persistent order book.
+
+    Unlike in ``MarketEngine``, offers stay in the book across steps until
+    they are matched, changed or cancelled, so agents only submit the changes
+    of their offers. Bids and asks are kept in heaps with lazy deletion:
+    changing an offer pushes a new entry and invalidates the old one, which is
+    discarded once it reaches the top. Matching pops crossing offers from the
+    tops of both heaps. The sorting work of a step is therefore proportional
+    to the number of changes and deals rather than to the number of agents;
+    only the vectorized bookkeeping of the history and ``stats`` and an
+    occasional clean up of the heaps still touch every slot.
+
+    Deals are made at the mid-price like in ``MarketEngine``. Equal offers
+    are ordered by ``tie_break``, where ``'arrival'`` gives the usual
+    price-time priority: the offer that was submitted first is matched first,
+    also across steps. An amended offer counts as a new submission.
+
+    Parameters
+    ----------
+    buyers, sellers, max_steps, history_length, tie_break, rng, book_stats:
+        See ``MarketEngine``. The ``matcher`` is always the order book.
+
+    Attributes
+    ----------
+    book: ndarray of shape (n_agents,)
+        The standing offer of each slot, ``NaN`` for no offer.
+    """
+
+    def __init__(self, buyers, sellers, max_steps=30, history_length=None,
+                 tie_break='slot', rng=None, book_stats=True):
+        super().__init__(buyers, sellers, max_steps, history_length,
+                         tie_break=tie_break, rng=rng, book_stats=book_stats)
+        self.matcher = 'book'
+        self._match = None
+
+
+    def reset(self):
+        """Reset the market and empty the order book."""
+        super().reset()
+        self.book = np.full(self.n_agents, np.nan)
+        self._versions = [0]*self.n_agents
+        self._bids = []
+        self._asks = []
+        self._arrivals = 0
+
+
+    def _tie_key(self, slot):
+        """Tie-breaking key of a new offer of ``slot``, lowest first."""
+        if self.tie_break == 'slot':
+            return -slot if slot < self.n_buyers else slot
+        if self.tie_break == 'random':
+            return self.rng.random()
+        self._arrivals += 1
+        return self._arrivals
+
+
+    def _submit(self, slot, offer):
+        """Place, change or, if ``offer`` is NaN, cancel a slot's offer."""
+        self._versions[slot] += 1
+        self.book[slot] = offer
+        if offer != offer:
+            return
+        if slot < self.n_buyers:
+            heapq.heappush(self._bids, (-offer, self._tie_key(slot),
+                                        self._versions[slot], slot))
+        else:
+            heapq.heappush(self._asks, (offer, self._tie_key(slot),
+                                        self._versions[slot], slot))
+
+
+    def _top(self, heap):
+        """The best valid entry of a heap, dropping outdated ones first."""
+        versions = self._versions
+        while heap and heap[0][2] != versions[heap[0][3]]:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+
+    def _compact(self, heap):
+        """Drop all outdated entries of a heap."""
+        versions = self._versions
+        heap[:] = [entry for entry in heap if entry[2] == versions[entry[3]]]
+        heapq.heapify(heap)
+
+
+    def step(self, changes):
+        """
+        Apply the changes of offers and match the book.
+
+        Parameters
+        ----------
+        changes: dict or array_like
+            A dictionary of new offers indexed by agent id, where ``None`` or
+            ``NaN`` cancels the offer of the agent. Or an array of shape
+            ``(n_agents,)`` with the new offer of each slot and ``NaN`` for
+            slots whose offer doesn't change. Changes of agents that are done
+            are ignored.
+
+        Returns
+        -------
+        deals: dict or ndarray
+            The deals of this step, like in ``MarketEngine.step``.
+        """
+        done = self.done_mask
+        as_dict = isinstance(changes, dict)
+        if as_dict:
+            for agent_id, offer in changes.items():
+                slot = self.slots.get(agent_id)
+                if slot is None:
+                    raise RuntimeError(f"Received offer from unkown agent {agent_id}")
+                if not done[slot]:
+                    self._submit(slot, np.nan if offer is None else offer)
+        else:
+            changes = np.asarray(changes, dtype=float)
+            slots = np.flatnonzero(~np.isnan(changes) & ~done)
+            for slot, offer in zip(slots.tolist(), changes[slots].tolist()):
+                self._submit(slot, offer)
+
+        # Outdated entries are only dropped at the top, so long games with
+        # many changes occasionally need a full clean up
+        for heap in (self._bids, self._asks):
+            if len(heap) > 2*self.n_agents:
+                self._compact(heap)
+
+        # The standing book is what gets matched and recorded
+        history = self.history
+        row = history.next_row()
+        history.offers[row] = self.book
+        self.last_offers[:] = self.book
+
+        buyers, sellers = [], []
+        while True:
+            bid = self._top(self._bids)
+            ask = self._top(self._asks)
+            if bid is None or ask is None or -bid[0] < ask[0]:
+                break
+            heapq.heappop(self._bids)
+            heapq.heappop(self._asks)
+            for slot in (bid[3], ask[3]):
+                self._versions[slot] += 1
+                self.book[slot] = np.nan
+            buyers.append(bid[3])
+            sellers.append(ask[3])
+
+        return self._settle_book(row, buyers, sellers, as_dict)
+
+
+    def _settle_book(self, row, buyers, sellers, as_dict, prices=None):
+        """Like ``_settle``, emptying the book if the game is over."""
+        deals = self._settle(row, np.array(buyers, dtype=int),
+                             np.array(sellers, dtype=int), as_dict, prices)
+        if self.done_mask.all():
+            self.book.fill(np.nan)
+            self._bids.clear()
+            self._asks.clear()
+        return deals
+
+
+class ContinuousMarketEngine(OrderBookMarketEngine):
+    """
+    Continuous double auction with price-time priority.
+
+    Where ``MarketEngine`` collects all offers of a round and clears them at
+    once, here the offers of a step arrive one by one and each is matched
+    immediately against the resting book. A bid is matched with the lowest
+    resting ask if that ask is not higher, and an ask with the highest
+    resting bid if that bid is not lower. The deal is made at the price of the
+    resting offer. Offers that are not matched rest in the book, ordered by
+    price and then by time of arrival, until they are matched or replaced by
+    a new offer of the same agent. Inserting and matching an offer both take
+    O(log n) time on the heaps of ``OrderBookMarketEngine``.
+
+    Offers given as a dict arrive in the order of the dict. Offers given as
+    an array arrive in a random order drawn from ``rng``, and ``NaN`` means
+    the agent keeps its resting offer, if any. Deals, ``done`` and the history
+    follow the conventions of ``MarketEngine``, so this engine can be used in
+    place of it, e.g. in ``MultiAgentTrainingEnv``. The offers recorded in the
+    history are all offers that were in the book during the step, including
+    the ones that were matched. Deals are ranked in the order they were made.
+
+    Parameters
+    ----------
+    buyers, sellers, max_steps, history_length, rng, book_stats:
+        See ``MarketEngine``.
+    """
+
+    def __init__(self, buyers, sellers, max_steps=30, history_length=None,
+                 rng=None, book_stats=True):
+        super().__init__(buyers, sellers, max_steps, history_length,
+                         tie_break='arrival', rng=rng, book_stats=book_stats)
+        self.matcher = 'continuous'
+
+
+    def step(self, offers):
+        """
+        Let the offers arrive one by one and match each of them immediately.
+
+        Parameters
+        ----------
+        offers: dict or array_like
+            A dictionary of offers indexed by agent_id, where ``None`` cancels
+            the resting offer of the agent, or an array of shape
+            ``(n_agents,)`` with the offer of each slot and ``NaN`` for no new
+            offer. Offers of agents that are done are ignored.
+
+        Returns
+        -------
+        deals: dict or ndarray
+            The deals of this step, like in ``MarketEngine.step``.
+        """
+        done = self.done_mask
+        as_dict = isinstance(offers, dict)
+        if as_dict:
+            arrivals = []
+            for agent_id, offer in offers.items():
+                slot = self.slots.get(agent_id)
+                if slot is None:
+                    raise RuntimeError(f"Received offer from unkown agent {agent_id}")
+                arrivals.append((slot, np.nan if offer is None else offer))
+        else:
+            offers = np.asarray(offers, dtype=float)
+            slots = self.rng.permutation(np.flatnonzero(~np.isnan(offers)))
+            arrivals = zip(slots.tolist(), offers[slots].tolist())
+
+        # The history records every offer that was in the book in this step
+        history = self.history
+        row = history.next_row()
+        live = history.offers[row]
+        live[:] = self.book
+
+        buyers, sellers, prices = [], [], []
+        n_buyers = self.n_buyers
+        for slot, offer in arrivals:
+            if done[slot]:
+                continue
+            is_buyer = slot < n_buyers
+            best = self._top(self._asks if is_buyer else self._bids)
+            if best is None or offer != offer \
+               or (offer < best[0] if is_buyer else offer > -best[0]):
+                self._submit(slot, offer)
+                live[slot] = offer
+                continue
+
+            # The arriving offer is matched at the price of the resting one
+            other = best[3]
+            heapq.heappop(self._asks if is_buyer else self._bids)
+            live[slot] = offer
+            for matched in (slot, other):
+                self._versions[matched] += 1
+                self.book[matched] = np.nan
+                done[matched] = True
+            buyers.append(slot if is_buyer else other)
+            sellers.append(other if is_buyer else slot)
+            prices.append(abs(best[0]))
+
+        self.last_offers[:] = live
+        return self._settle_book(row, buyers, sellers, as_dict,
+                                 np.array(prices, dtype=float))
+
+
+class BatchMarketEngine:
+    """
+    Vectorized double auction engine running many independent markets at once.
+
+    Every market has the same fixed number of buyer and seller slots. Like in
+    ``MarketEngine``, buyers occupy the first ``n_buyers`` slots and sellers
+    the remaining ones. Offers are passed as float arrays with one row per
+    market, where ``NaN`` means that the agent in that slot makes no offer.
+    Matching in each row gives exactly the same deals as
+    ``MarketEngine.match`` would, with the slot index playing the role of the
+    agent id.
+
+    Parameters
+    ----------
+    n_markets: int
+        Number of independent markets.
+
+    n_buyers: int
+        Number of buyer slots in each market.
+
+    n_sellers: int
+        Number of seller slots in each market.
+
+    max_steps: int (optional, default=30)
+        Number of maximum market rounds.
+
+
+    Attributes
+    -------
+    time: ndarray of shape (n_markets,)
+        The current time step of each market. Starts at 0.
+
+    done_mask: ndarray of shape (n_markets, n_agents)
+        Boolean mask of the agents that are done for this game.
+
+    done: ndarray of shape (n_markets,)
+        Boolean mask of markets in which every agent is done.
+
+    last_offers: ndarray of shape (n_markets, n_agents)
+        Offers of the last round, ``NaN`` where no offer was placed.
+
+    deals: ndarray of shape (n_markets, n_agents)
+        Deal prices of the last round, ``NaN`` for agents not matched.
+
+    deal_prices: ndarray of shape (n_markets, min(n_buyers, n_sellers))
+        Deal prices of the last round in matching order, padded with
+        ``NaN``.
+
+    buyers_done, sellers_done, last_bids, last_asks, bid_deals, ask_deals:
+        Views of the buyer and seller columns of the arrays above.
+    """
+
+    def __init__(self, n_markets, n_buyers, n_sellers, max_steps=30):
+        self.n_markets = n_markets
+        self.n_buyers = n_buyers
+        self.n_sellers = n_sellers
+        self.n_agents = n_buyers + n_sellers
+        self.max_steps = max_steps
+
+        shape = (n_markets, self.n_agents)
+        self.time = np.zeros(n_markets, dtype=int)
+        self.done_mask = np.zeros(shape, dtype=bool)
+        self.done = np.zeros(n_markets, dtype=bool)
+        self.last_offers = np.full(shape, np.nan)
+        self.deals = np.full(shape, np.nan)
+        self.deal_prices = np.full((n_markets, min(n_buyers, n_sellers)),
+                                   np.nan)
+
+    @property
+    def buyers_done(self):
+        return self.done_mask[:, :self.n_buyers]
+
+    @property
+    def sellers_done(self):
+        return self.done_mask[:, self.n_buyers:]
+
+    @property
+    def last_bids(self):
+        return self.last_offers[:, :self.n_buyers]
+
+    @property
+    def last_asks(self):
+        return self.last_offers[:, self.n_buyers:]
+
+    @property
+    def bid_deals(self):
+        return self.deals[:, :self.n_buyers]
+
+    @property
+    def ask_deals(self):
+        return self.deals[:, self.n_buyers:]
+
+
+    def reset(self, markets=None):
+        """
+        Reset markets to their initial unmatched state.
+
+        Parameters
+        ----------
+        markets: array_like, optional (default=None)
+            Boolean mask or indices of the markets to reset. If not given, all
+            markets are reset.
+        """
+        if markets is None:
+            markets = slice(None)
+        self.time[markets] = 0
+        self.done_mask[markets] = False
+        self.done[markets] = False
+        self.last_offers[markets] = np.nan
+        self.deals[markets] = np.nan
+        self.deal_prices[markets] = np.nan
+
+
+    def step(self, bids, asks):
+        """
+        Compute the next state of every market given the offers.
+
+        Offers of agents that are already done are ignored. Markets that are
+        done do not advance in time.
+
+        Parameters
+        ----------
+        bids: array_like of shape (n_markets, n_buyers)
+            Bids per market and buyer slot, ``NaN`` for no bid.
+
+        asks: array_like of shape (n_markets, n_sellers)
+            Asks per market and seller slot, ``NaN`` for no ask.
+
+        Returns
+        -------
+        bid_deals: ndarray of shape (n_markets, n_buyers)
+            Deal price of each buyer, ``NaN`` if the buyer was not matched.
+
+        ask_deals: ndarray of shape (n_markets, n_sellers)
+            Deal price of each seller, ``NaN`` if the seller was not matched.
+        """
+        offers = self.last_offers
+        offers[:, :self.n_buyers] = bids
+        offers[:, self.n_buyers:] = asks
+        offers[self.done_mask] = np.nan
+
+        bid_deals, ask_deals, self.deal_prices = self._match(self.last_bids,
+                                                             self.last_asks)
+        self.deals[:, :self.n_buyers] = bid_deals
+        self.deals[:, self.n_buyers:] = ask_deals
+        self.time += ~self.done
+
+        self.done_mask |= ~np.isnan(self.deals)
+        self.done = (self.time >= self.max_steps) \
+                  | self.buyers_done.all(axis=1) \
+                  | self.sellers_done.all(axis=1)
+        self.done_mask[self.done] = True
+
+        return bid_deals, ask_deals
+
+
+    @staticmethod
+    def _match(bids, asks):
+        """Like ``match``, but also returns the deal prices in order."""
+        bids = np.asarray(bids, dtype=float)
+        asks = np.asarray(asks, dtype=float)
+        n = min(bids.shape[1], asks.shape[1])
+
+        # A stable ascending sort reversed puts ties in descending slot order
+        bid_order = np.argsort(np.where(np.isnan(bids), -np.inf, bids),
+                               axis=1, kind='stable')[:, ::-1][:, :n]
+        ask_order = np.argsort(np.where(np.isnan(asks), np.inf, asks),
+                               axis=1, kind='stable')[:, :n]
+        sorted_bids = np.take_along_axis(bids, bid_order, axis=1)
+        sorted_asks = np.take_along_axis(asks, ask_order, axis=1)
+
+        # Comparisons with NaN are False, so missing offers stop matching
+        matched = np.logical_and.accumulate(sorted_bids >= sorted_asks, axis=1)
+        prices = np.where(matched, (sorted_bids + sorted_asks)/2, np.nan)
+
+        bid_deals = np.full(bids.shape, np.nan)
+        ask_deals = np.full(asks.shape, np.nan)
+        np.put_along_axis(bid_deals, bid_order, prices, axis=1)
+        np.put_along_axis(ask_deals, ask_order, prices, axis=1)
+        return bid_deals, ask_deals, prices
+
+
+    @staticmethod
+    def match(bids, asks):
+        """
+        Vectorized version of ``MarketEngine.match`` over rows of markets.
+
+        Bids are sorted in descending and asks in ascending order. Equal offers
+        are ordered like the ``(offer, agent_id)`` tuples of
+        ``MarketEngine.match`` with the slot index as agent id, i.e., the buyer
+        with the higher slot index and the seller with the lower slot index
+        come first. The sorted bids and asks are then matched pairwise up to
+        the first bid that is lower than its ask.
+
+        Parameters
+        ----------
+        bids: ndarray of shape (n_markets, n_buyers)
+            Bids per market, ``NaN`` for no bid.
+
+        asks: ndarray of shape (n_markets, n_sellers)
+            Asks per market, ``NaN`` for no ask.
+
+        Returns
+        -------
+        bid_deals: ndarray of shape (n_markets, n_buyers)
+            Deal price of each buyer, ``NaN`` if not matched.
+
+        ask_deals: ndarray of shape (n_markets, n_sellers)
+            Deal price of each seller, ``NaN`` if not matched.
+        """
+        bid_deals, ask_deals, _ = BatchMarketEngine._match(bids, asks)
+        return bid_deals, ask_deals
@@ -1,8 +1,24 @@
+import ctypes
+import multiprocessing
+from functools import partial
 import numpy as np
 import gym
 from gym.spaces import Discrete, Box
-from dmarket.engine import MarketEngine
-from dmarket.info_settings import TimeInformationWrapper
+from dmarket.agents import AgentPopulation, GymRLAgentGroup, seed_sequence
+from dmarket.engine import MarketEngine, BatchMarketEngine, _sorted_ids
+
+try:
+    from stable_baselines.common.vec_env import VecEnv
+except ImportError:
+    VecEnv = object
+from dmarket.info_settings import (
+    InformationSetting, TimeInformationWrapper, _takes_out
+)
+from dmarket.profiling import StepProfiler, NullProfiler
+
+# Up to this many RL agents, their actions and rewards are converted one by
+# one rather than with the arrays of ``GymRLAgentGroup``
+SCALAR_RL_AGENTS = 8
 
 
 class MultiAgentTrainingEnv(gym.Env):
@@ -24,6 +40,24 @@ class MultiAgentTrainingEnv(gym.Env):
     max_steps: int, optional (default=30)
         Maximum number of rounds before a single market game terminates. This
         is passed on to the market engine.
+    pregenerate: bool, optional (default=False)
+        If True, the random numbers of the fixed agents are drawn for a whole
+        game at once on reset, see ``AgentPopulation``.
+    matcher: str, optional (default='sort')
+        Matching algorithm of the market engine, see ``MarketEngine``.
+    profile: bool, optional (default=False)
+        If True, the wall time of each phase of ``step`` and ``reset`` is
+        recorded in ``profiler``.
+    market_engine: class, optional (default=None)
+        Class of the market engine, e.g. ``ContinuousMarketEngine``. It is
+        created with the buyer and seller ids, ``max_steps`` and
+        ``history_length``. By default a ``MarketEngine`` with ``matcher``.
+    history_length: int, None or 'auto', optional (default='auto')
+        Number of most recent rounds the market keeps in its history, see
+        ``MarketEngine``. ``'auto'`` keeps only as many as ``setting`` needs
+        according to its ``history_length`` attribute, or the full history if
+        it has none. ``None`` keeps the full history, e.g. to inspect
+        ``market.offer_history`` after a game.
 
     Attributes
     ----------
@@ -31,8 +65,18 @@ class MultiAgentTrainingEnv(gym.Env):
         Derived from ``setting`` parameter.
     market: MarketEngine object
         The underlying market engine object.
+    population: AgentPopulation object
+        The fixed agents, grouped to compute their offers together.
+    rl_group: GymRLAgentGroup object
+        The RL agents, grouped to convert their actions and normalize their
+        observations together.
+    profiler: StepProfiler object
+        Time spent in each phase of the environment, see ``StepProfiler``.
+        If ``profile`` is not set, this is a ``NullProfiler``.
     """
-    def __init__(self, rl_agents, fixed_agents, setting, max_steps=30):
+    def __init__(self, rl_agents, fixed_agents, setting, max_steps=30,
+                 pregenerate=False, matcher='sort', profile=False,
+                 market_engine=None, history_length='auto'):
 
         self.rl_agents = {
             rl_agent.name: rl_agent for rl_agent in rl_agents
@@ -67,23 +111,88 @@ class MultiAgentTrainingEnv(gym.Env):
             for agent in self.all_agents.values()
             if agent.role == 'seller'
         ]
-        self.market = MarketEngine(buyer_ids, seller_ids, max_steps)
+        if history_length == 'auto':
+            # Settings that don't state what they need get the full history
+            history_length = getattr(setting, 'history_length', None)
+        if market_engine is None:
+            self.market = MarketEngine(buyer_ids, seller_ids, max_steps,
+                                       history_length=history_length,
+                                       matcher=matcher)
+        else:
+            self.market = market_engine(buyer_ids, seller_ids, max_steps,
+                                        history_length=history_length)
+        self.population = AgentPopulation(
+            self.fixed_agents.values(),
+            pregenerate=(max_steps if pregenerate else None)
+        )
+        self._fixed_slots = np.array([
+            self.market.slots[agent.name] for agent in self.population.agents
+        ], dtype=int)
+        self._other_ids = [
+            agent.name for agent in self.population.other_agents
+        ]
+
+        # Reused buffer for settings in which all agents see the same, only
+        # passed to settings whose get_states takes it
+        self._fixed_obs = np.zeros(self.rl_setting.observation_space.shape)
+        self._get_fixed_states = setting.get_states
+        if _takes_out(setting.get_states):
+            self._get_fixed_states = partial(setting.get_states,
+                                             out=self._fixed_obs)
+
+        # Settings outside of InformationSetting get their states stacked
+        self._get_rl_states = getattr(self.rl_setting, 'get_states_array',
+                                      None)
+        if self._get_rl_states is None:
+            self._get_rl_states = partial(InformationSetting.get_states_array,
+                                          self.rl_setting)
+
+        # Stacked parameters of the RL agents
+        self.rl_group = GymRLAgentGroup(self.rl_agents.values())
+        self._rl_ids = list(self.rl_agents)
+        self._rl_index = {
+            agent_id: i for i, agent_id in enumerate(self.rl_agents)
+        }
+        self._rl_slots = np.array([
+            self.market.slots[agent_id] for agent_id in self.rl_agents
+        ], dtype=int)
+        self.profiler = StepProfiler() if profile else NullProfiler()
+
+
+    def _get_rewards(self, index, deals):
+        """
+        Compute the rewards of RL agents given the deals in the last round.
+
+        The RL agents are given by their position ``index`` in ``rl_agents``
+        and the deal prices ``deals`` are indexed by market slot, with ``NaN``
+        for agents that were not matched.
+        """
+        group = self.rl_group
+        prices = deals[self._rl_slots[index]]
+        rewards = (prices - group.reservation_prices[index])*group.signs[index]
+        rewards[np.isnan(rewards)] = 0
+        return rewards
 
 
-    def _get_rewards(self, agent_ids, deals):
+    def seed(self, seed=None):
         """
-        Compute the reward of each agent given the deals in the last round.
+        Seed the random number generators of the fixed agents.
+
+        The population of fixed agents and every fixed agent outside of its
+        groups get an independent ``numpy.random.Generator`` derived from
+        ``seed``.
+
+        Parameters
+        ----------
+        seed: None, int or SeedSequence, optional (default=None)
+            The seed. If ``None``, fresh entropy is used.
+
+        Returns
+        -------
+        seeds: list
+            The entropy of the seed sequence that was used.
         """
-        result = {}
-        for agent_id in agent_ids:
-            if agent_id in deals:
-                agent = self.all_agents[agent_id]
-                sign = (-1 if agent.role == 'buyer' else +1)
-                res_price = agent.reservation_price
-                result[agent_id] = (deals[agent_id] - res_price)*sign
-            else:
-                result[agent_id] = 0
-        return result
+        return [self.population.seed(seed).entropy]
 
 
     def reset(self):
@@ -95,8 +204,12 @@ class MultiAgentTrainingEnv(gym.Env):
         observations: dict
             Initial observations for all agents.
         """
+        t = self.profiler.clock()
         self.market.reset()
-        return self.rl_setting.get_states(self.rl_agents.keys(), self.market)
+        self.population.reset()
+        obs = self.rl_setting.get_states(self.rl_agents.keys(), self.market)
+        self.profiler.record('reset', t)
+        return obs
 
 
     def step(self, actions):
@@ -120,41 +233,73 @@ class MultiAgentTrainingEnv(gym.Env):
             Contains additionally a string key ``__all__`` to indicate
             whether every agent is done.
         """
-        # Get dict of fixed agents that aren't yet done
-        other_agents = {
-            agent.name: agent for agent in self.fixed_agents.values()
-            if agent.name not in self.market.done
-        }
+        market = self.market
+        profiler = self.profiler
+        t = profiler.clock()
 
-        # First get offers of other fixed agents
-        obs = self.setting.get_states(other_agents.keys(), self.market)
-        offers = {
-            agent.name: agent.get_offer(obs[agent.name])
-            for agent in other_agents.values()
-        }
+        # Only fixed agents outside of the population's groups need
+        # observations, and only if they aren't yet done
+        observations = ()
+        if self._other_ids:
+            other_ids = [
+                agent_id for agent_id in self._other_ids
+                if agent_id not in market.done
+            ]
+            obs = self._get_fixed_states(other_ids, market) if other_ids else {}
+            observations = [obs.get(agent_id) for agent_id in self._other_ids]
+        t = profiler.record('fixed_observations', t)
 
-        # Update offers with RL offers from the actions dict
-        rl_agent_ids = set(actions.keys())
-        for rl_agent_id in rl_agent_ids:
-            offers[rl_agent_id] = self.rl_agents[rl_agent_id].action_to_price(
-                actions[rl_agent_id]
+        # First get offers of fixed agents
+        offers = np.full(market.n_agents, np.nan)
+        offers[self._fixed_slots] = self.population.get_offers(market.time,
+                                                               observations)
+        t = profiler.record('fixed_offers', t)
+
+        # Update offers with RL offers from the actions dict. A few agents are
+        # cheaper to convert one by one than with the arrays of rl_group.
+        rl_agent_ids = list(actions)
+        if rl_agent_ids == self._rl_ids:
+            index = slice(None)
+        else:
+            index = [self._rl_index[rl_agent_id] for rl_agent_id in rl_agent_ids]
+        slots = self._rl_slots[index]
+        scalar = len(rl_agent_ids) <= SCALAR_RL_AGENTS
+        if scalar:
+            rl_agents = [self.rl_agents[rl_agent_id] for rl_agent_id in rl_agent_ids]
+            for rl_agent, rl_agent_id, slot in zip(rl_agents, rl_agent_ids,
+                                                   slots.tolist()):
+                offers[slot] = rl_agent.action_to_price(actions[rl_agent_id])
+        else:
+            offers[slots] = self.rl_group.action_to_price(
+                [actions[rl_agent_id] for rl_agent_id in rl_agent_ids], index
             )
+        t = profiler.record('rl_offers', t)
 
         # Step the market
-        deals = self.market.step(offers)
+        deals = market.step(offers)
+        t = profiler.record('market', t)
 
-        # Obs, done, rewards for RL agents
-        obs = self.rl_setting.get_states(rl_agent_ids, self.market)
-        for rl_agent_id in obs.keys(): # Normalize each observation
-            obs[rl_agent_id] = self.rl_agents[rl_agent_id].normalize(
-                obs[rl_agent_id]
-            )
+        # Obs, done, rewards for RL agents, normalized all at once
+        states = self._get_rl_states(slots, market)
+        if len(rl_agent_ids) == 1:
+            obs = {rl_agent_ids[0]: rl_agents[0].normalize(states[0])}
+        else:
+            obs = dict(zip(rl_agent_ids, self.rl_group.normalize(states, index)))
         done = {
-            rl_agent_id: (rl_agent_id in self.market.done)
+            rl_agent_id: rl_agent_id in market.done
             for rl_agent_id in rl_agent_ids
         }
-        done["__all__"] = (rl_agent_ids.issubset(self.market.done))
-        rew = self._get_rewards(rl_agent_ids, deals)
+        done["__all__"] = all(done.values())
+        t = profiler.record('rl_observations', t)
+        if scalar:
+            rewards = []
+            for rl_agent, price in zip(rl_agents, deals[slots].tolist()):
+                rewards.append(0.0 if price != price else
+                               (price - rl_agent.reservation_price)*rl_agent._s)
+        else:
+            rewards = self._get_rewards(index, deals).tolist()
+        rew = dict(zip(rl_agent_ids, rewards))
+        profiler.record('rewards', t)
         return obs, rew, done, {}
 
 
@@ -177,11 +322,33 @@ class SingleAgentTrainingEnv(MultiAgentTrainingEnv):
     max_steps: int, optional (default=30)
         Maximum number of rounds before a single market game terminates. This
         is passed on to the market engine.
+    pregenerate: bool, optional (default=False)
+        If True, the random numbers of the fixed agents are drawn for a whole
+        game at once on reset, see ``AgentPopulation``.
+    matcher: str, optional (default='sort')
+        Matching algorithm of the market engine, see ``MarketEngine``.
+    profile: bool, optional (default=False)
+        If True, the wall time of each phase of ``step`` and ``reset`` is
+        recorded in ``profiler``.
+    market_engine: class, optional (default=None)
+        Class of the market engine, e.g. ``ContinuousMarketEngine``. It is
+        created with the buyer and seller ids, ``max_steps`` and
+        ``history_length``. By default a ``MarketEngine`` with ``matcher``.
+    history_length: int, None or 'auto', optional (default='auto')
+        Number of most recent rounds the market keeps in its history, see
+        ``MarketEngine``. ``'auto'`` keeps only as many as ``setting`` needs
+        according to its ``history_length`` attribute, or the full history if
+        it has none. ``None`` keeps the full history, e.g. to inspect
+        ``market.offer_history`` after a game.
     """
-    def __init__(self, rl_agent, fixed_agents, setting, max_steps=30):
+    def __init__(self, rl_agent, fixed_agents, setting, max_steps=30,
+                 pregenerate=False, matcher='sort', profile=False,
+                 market_engine=None, history_length='auto'):
         self.rl_agent = rl_agent
         self.action_space = Discrete(rl_agent.discretization)
-        super().__init__([rl_agent], fixed_agents, setting, max_steps)
+        super().__init__([rl_agent], fixed_agents, setting, max_steps,
+                         pregenerate, matcher, profile, market_engine,
+                         history_length)
 
     def reset(self):
         return super().reset()[self.rl_agent.name]
@@ -193,3 +360,501 @@ class SingleAgentTrainingEnv(MultiAgentTrainingEnv):
         return obs[self.rl_agent.name], \
                rew[self.rl_agent.name], \
               done[self.rl_agent.name], _
+
+
+class SingleAgentVecEnv(VecEnv):
+    """
+    Vectorized version of ``SingleAgentTrainingEnv``.
+
+    This environment runs ``n_envs`` copies of the single agent market in
+    lockstep on a ``BatchMarketEngine``, so that a single call to ``step``
+    advances every copy with array operations. Copies in which the RL agent is
+    done are reset automatically. If stable_baselines is installed, this is a
+    ``VecEnv`` and can be used in place of wrapping ``SingleAgentTrainingEnv``
+    in a ``DummyVecEnv``. The copies share their agents and setting, so
+    ``get_attr``, ``set_attr`` and ``env_method`` act on this environment.
+
+    Agents are placed in the same slots as in the ``MarketEngine`` of
+    ``SingleAgentTrainingEnv``, sorted by name within each side, so equal
+    offers are matched in the same order.
+
+    The fixed agents are grouped in an ``AgentPopulation``, so that their
+    offers for all copies are computed with a few array operations.
+
+    Parameters
+    ----------
+    rl_agent: GymRLAgent object
+        The reinforcement learning agent to be trained. The environment derives
+        action space and observation space from this object.
+    fixed_agents: list
+        A list of fixed agents. All instances must implement the ``get_offer``
+        function.
+    setting: InformationSetting object
+        The information setting of the market environment. It must implement
+        ``get_batch_states``.
+    n_envs: int
+        Number of copies of the market to run.
+    max_steps: int, optional (default=30)
+        Maximum number of rounds before a single market game terminates. This
+        is passed on to the market engine.
+    pregenerate: bool, optional (default=False)
+        If True, the random numbers of the fixed agents are drawn for a whole
+        game at once on reset, see ``AgentPopulation``.
+    profile: bool, optional (default=False)
+        If True, the wall time of each phase of ``step`` and ``reset`` is
+        recorded in ``profiler``.
+
+    Attributes
+    ----------
+    num_envs: int
+        Number of copies of the market.
+    observation_space: Box object
+        Derived from ``setting`` parameter.
+    action_space: Discrete object
+        Derived from ``rl_agent``.
+    market: BatchMarketEngine object
+        The underlying batch market engine object.
+    agents: list
+        All agents, ordered by their slot in ``market``.
+    population: AgentPopulation object
+        The fixed agents, grouped to compute their offers together.
+    profiler: StepProfiler object
+        Time spent in each phase of the environment, see ``StepProfiler``.
+    """
+    def __init__(self, rl_agent, fixed_agents, setting, n_envs, max_steps=30,
+                 pregenerate=False, profile=False):
+        self.rl_agent = rl_agent
+        self.num_envs = n_envs
+        self.action_space = Discrete(rl_agent.discretization)
+
+        if isinstance(setting, TimeInformationWrapper):
+            self.rl_setting = setting.base_setting
+        else:
+            self.rl_setting = setting
+        self.setting = setting
+        self.observation_space = Box(
+            low=-np.inf, high=np.inf,
+            shape=self.rl_setting.observation_space.shape
+        )
+
+        agents = {
+            agent.name: agent for agent in [rl_agent] + list(fixed_agents)
+        }
+        buyers = _sorted_ids(
+            name for name, agent in agents.items() if agent.role == 'buyer'
+        )
+        sellers = _sorted_ids(
+            name for name, agent in agents.items() if agent.role == 'seller'
+        )
+        self.agents = [agents[name] for name in buyers + sellers]
+        self.rl_slot = next(
+            slot for slot, agent in enumerate(self.agents) if agent is rl_agent
+        )
+        self.fixed_slots = [
+            slot for slot in range(len(self.agents)) if slot != self.rl_slot
+        ]
+        self.population = AgentPopulation(
+            (self.agents[slot] for slot in self.fixed_slots),
+            pregenerate=(max_steps if pregenerate else None)
+        )
+        other_agents = set(map(id, self.population.other_agents))
+        self._other_slots = [
+            slot for slot in self.fixed_slots
+            if id(self.agents[slot]) in other_agents
+        ]
+        self.market = BatchMarketEngine(n_envs, len(buyers), len(sellers),
+                                        max_steps)
+        self._offers = np.full((n_envs, len(self.agents)), np.nan)
+        shape = (n_envs,) + self.rl_setting.observation_space.shape
+        self._fixed_obs = np.zeros(shape)
+        self._rl_obs = np.zeros(shape)
+        self._sign = (-1 if rl_agent.role == 'buyer' else +1)
+        self.profiler = StepProfiler() if profile else NullProfiler()
+
+
+    def _get_obs(self):
+        obs = self.rl_setting.get_batch_states([self.rl_slot], self.market,
+                                               self._rl_obs)
+        return self.rl_agent.normalize(obs[self.rl_slot])
+
+
+    def seed(self, seed=None):
+        """
+        Seed the random number generators of the fixed agents.
+
+        Since the offers of all copies are drawn from the same generators,
+        the copies are independent of each other and reproducible.
+
+        Parameters
+        ----------
+        seed: None, int or SeedSequence, optional (default=None)
+            The seed. If ``None``, fresh entropy is used.
+
+        Returns
+        -------
+        seeds: list
+            The entropy of the seed sequence that was used.
+        """
+        return [self.population.seed(seed).entropy]
+
+
+    def reset(self):
+        """
+        Reset all copies of the market.
+
+        Returns
+        -------
+        observations: ndarray of shape (n_envs, *observation_space.shape)
+            Initial observations of the RL agent in each copy.
+        """
+        t = self.profiler.clock()
+        self.market.reset()
+        self.population.reset(self.num_envs)
+        obs = self._get_obs()
+        self.profiler.record('reset', t)
+        return obs
+
+
+    def step(self, actions):
+        """
+        Parameters
+        ----------
+        actions: array_like of shape (n_envs,)
+            The action of the RL agent in each copy.
+
+        Returns
+        -------
+        observations: ndarray of shape (n_envs, *observation_space.shape)
+            Observations of the RL agent. For copies that were reset, this is
+            the initial observation of the new game.
+        rewards: ndarray of shape (n_envs,)
+            Reward of the RL agent in each copy.
+        dones: ndarray of shape (n_envs,)
+            Whether the RL agent was done in each copy. These copies are reset.
+        infos: list of dicts
+            For copies that were reset, the info dict contains the last
+            observation of the finished game under ``terminal_observation``.
+        """
+        market = self.market
+        offers = self._offers
+        n_buyers = market.n_buyers
+        profiler = self.profiler
+        t = profiler.clock()
+
+        # First get offers of fixed agents, then of the RL agent. Only fixed
+        # agents outside of the population's groups need observations.
+        observations = ()
+        if self._other_slots:
+            obs = self.setting.get_batch_states(self._other_slots, market,
+                                                self._fixed_obs)
+            observations = [obs[slot] for slot in self._other_slots]
+        t = profiler.record('fixed_observations', t)
+        offers[:, self.fixed_slots] = self.population.get_offers(
+            market.time, observations
+        )
+        t = profiler.record('fixed_offers', t)
+        offers[:, self.rl_slot] = self.rl_agent.action_to_price(
+            np.asarray(actions)
+        )
+        t = profiler.record('rl_offers', t)
+
+        # Step the markets
+        market.step(offers[:, :n_buyers], offers[:, n_buyers:])
+        t = profiler.record('market', t)
+
+        # Obs, done, rewards for the RL agent
+        deals = market.deals[:, self.rl_slot]
+        res_price = self.rl_agent.reservation_price
+        rewards = np.nan_to_num((deals - res_price)*self._sign)
+        dones = market.done_mask[:, self.rl_slot].copy()
+        t = profiler.record('rewards', t)
+        obs = self._get_obs()
+        infos = [{} for _ in range(self.num_envs)]
+        t = profiler.record('rl_observations', t)
+        if dones.any():
+            for i in np.flatnonzero(dones):
+                infos[i]['terminal_observation'] = obs[i]
+            market.reset(dones)
+            self.population.reset(self.num_envs, dones)
+            obs = self._get_obs()
+            profiler.record('reset', t)
+        return obs, rewards, dones, infos
+
+
+    def step_async(self, actions):
+        self._actions = actions
+
+
+    def step_wait(self):
+        return self.step(self._actions)
+
+
+    def _indices(self, indices):
+        if indices is None:
+            return range(self.num_envs)
+        if isinstance(indices, int):
+            return [indices]
+        return indices
+
+
+    def get_attr(self, attr_name, indices=None):
+        return [getattr(self, attr_name) for _ in self._indices(indices)]
+
+
+    def set_attr(self, attr_name, value, indices=None):
+        setattr(self, attr_name, value)
+
+
+    def env_method(self, method_name, *method_args, indices=None,
+                   **method_kwargs):
+        result = getattr(self, method_name)(*method_args, **method_kwargs)
+        return [result for _ in self._indices(indices)]
+
+
+    def close(self):
+        pass
+
+
+def _shared_array(shape, dtype):
+    """Allocate a shared memory buffer for an array of given shape and dtype."""
+    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return multiprocessing.RawArray(ctypes.c_char, max(size, 1)), shape, dtype
+
+
+def _as_array(buffer):
+    """Numpy view of a buffer allocated by ``_shared_array``."""
+    raw, shape, dtype = buffer
+    size = int(np.prod(shape))
+    return np.frombuffer(raw, dtype=dtype, count=size).reshape(shape)
+
+
+def _multi_agent_worker(conn, env_fn, copies, buffers):
+    """
+    Worker process of ``ParallelMultiAgentEnv``.
+
+    Runs the environment copies in ``copies`` and exchanges actions and
+    results with the main process through the shared ``buffers``. Only short
+    commands are sent over ``conn``.
+    """
+    actions, obs, rewards, dones, terminal_obs = map(_as_array, buffers)
+    envs = [env_fn() for _ in copies]
+    agent_ids = [list(env.rl_agents) for env in envs]
+
+    def write_obs(i, copy, env_obs):
+        for j, agent_id in enumerate(agent_ids[i]):
+            obs[copy, j] = env_obs[agent_id]
+
+    while True:
+        command, arg = conn.recv()
+        if command == 'seed':
+            for env, seed in zip(envs, arg):
+                env.seed(seed)
+        elif command == 'reset':
+            for i, (copy, env) in enumerate(zip(copies, envs)):
+                write_obs(i, copy, env.reset())
+        elif command == 'step':
+            for i, (copy, env) in enumerate(zip(copies, envs)):
+                env_obs, env_rew, env_done, _ = env.step({
+                    agent_id: int(actions[copy, j])
+                    for j, agent_id in enumerate(agent_ids[i])
+                })
+                for j, agent_id in enumerate(agent_ids[i]):
+                    rewards[copy, j] = env_rew[agent_id]
+                    dones[copy, j] = env_done[agent_id]
+                dones[copy, -1] = env_done['__all__']
+                write_obs(i, copy, env_obs)
+                if env_done['__all__']:
+                    terminal_obs[copy] = obs[copy]
+                    write_obs(i, copy, env.reset())
+        elif command == 'close':
+            conn.close()
+            break
+        conn.send(True)
+
+
+class ParallelMultiAgentEnv:
+    """
+    Runs copies of ``MultiAgentTrainingEnv`` in parallel worker processes.
+
+    The copies are divided evenly over the worker processes. Actions and
+    results are exchanged through shared memory arrays, so no observations are
+    pickled between processes. The interface is the same as the one of
+    ``MultiAgentTrainingEnv``, except that every value is an array over the
+    copies. Copies in which all RL agents are done are reset automatically.
+
+    RL agents are identified by their position in the environment, so the
+    agent ids of the first environment are used as keys, even if ``env_fn``
+    creates agents with random names.
+
+    Parameters
+    ----------
+    env_fn: callable
+        Function without arguments that creates a ``MultiAgentTrainingEnv``.
+        It is called once for every copy inside the worker processes, and must
+        be picklable if the start method is not ``fork``.
+    n_copies: int
+        Total number of environment copies.
+    n_workers: int, optional (default=None)
+        Number of worker processes. Defaults to the number of CPUs, but never
+        more than ``n_copies``.
+    start_method: str, optional (default=None)
+        Multiprocessing start method, see ``multiprocessing.get_context``.
+
+    Attributes
+    ----------
+    agent_ids: list
+        The ids of the RL agents, used as keys of the returned dicts.
+    observation_space: Box object
+        Observation space of a single agent in a single copy.
+    """
+    def __init__(self, env_fn, n_copies, n_workers=None, start_method=None):
+        env = env_fn()
+        self.agent_ids = list(env.rl_agents)
+        self.observation_space = env.observation_space
+        self.n_copies = n_copies
+        n_agents = len(self.agent_ids)
+        obs_shape = (n_copies, n_agents) + env.observation_space.shape
+
+        buffers = [
+            _shared_array((n_copies, n_agents), np.int64),
+            _shared_array(obs_shape, np.float64),
+            _shared_array((n_copies, n_agents), np.float64),
+            _shared_array((n_copies, n_agents + 1), np.bool_),
+            _shared_array(obs_shape, np.float64),
+        ]
+        self._actions, self._obs, self._rewards, self._dones, \
+            self._terminal_obs = map(_as_array, buffers)
+
+        n_workers = min(n_workers or multiprocessing.cpu_count(), n_copies)
+        ctx = multiprocessing.get_context(start_method)
+        self._conns = []
+        self._processes = []
+        self._copies = []
+        for copies in np.array_split(np.arange(n_copies), n_workers):
+            conn, worker_conn = ctx.Pipe()
+            process = ctx.Process(
+                target=_multi_agent_worker,
+                args=(worker_conn, env_fn, copies.tolist(), buffers),
+                daemon=True
+            )
+            process.start()
+            worker_conn.close()
+            self._conns.append(conn)
+            self._processes.append(process)
+            self._copies.append(copies.tolist())
+        self.closed = False
+
+
+    def _run(self, command, args=None):
+        args = args or [None] * len(self._conns)
+        for conn, arg in zip(self._conns, args):
+            conn.send((command, arg))
+        for conn in self._conns:
+            conn.recv()
+
+
+    def seed(self, seed=None):
+        """
+        Seed every copy with an independent seed derived from ``seed``.
+
+        Parameters
+        ----------
+        seed: None, int or SeedSequence, optional (default=None)
+            The seed. If ``None``, fresh entropy is used.
+
+        Returns
+        -------
+        seeds: list
+            The entropy of the seed sequence that was used.
+        """
+        seed = seed_sequence(seed)
+        seeds = seed.spawn(self.n_copies)
+        self._run('seed', [
+            [seeds[copy] for copy in copies] for copies in self._copies
+        ])
+        return [seed.entropy]
+
+
+    def _get_obs(self):
+        return {
+            agent_id: self._obs[:, j].copy()
+            for j, agent_id in enumerate(self.agent_ids)
+        }
+
+
+    def reset(self):
+        """
+        Reset all copies.
+
+        Returns
+        -------
+        observations: dict
+            Initial observations of all copies per agent, each of shape
+            ``(n_copies, *observation_space.shape)``.
+        """
+        self._run('reset')
+        return self._get_obs()
+
+
+    def step(self, actions):
+        """
+        Parameters
+        ----------
+        actions: dict
+            A dictionary of actions per agent, indexed by agent id. Each entry
+            is an array of shape ``(n_copies,)``. Every RL agent must be
+            present; actions of agents that are done are ignored.
+
+        Returns
+        -------
+        observations: dict
+            Observations per agent of shape ``(n_copies, *obs_shape)``. For
+            copies that were reset, these are the initial observations.
+        rewards: dict
+            Reward per agent of shape ``(n_copies,)``.
+        done: dict
+            Boolean arrays of shape ``(n_copies,)`` per agent and under the key
+            ``__all__``. Copies where ``__all__`` is set have been reset.
+        info: dict
+            Contains the last observations of the finished games under
+            ``terminal_observation``, in the same form as ``observations``.
+        """
+        for j, agent_id in enumerate(self.agent_ids):
+            self._actions[:, j] = actions[agent_id]
+        self._run('step')
+
+        rew = {
+            agent_id: self._rewards[:, j].copy()
+            for j, agent_id in enumerate(self.agent_ids)
+        }
+        done = {
+            agent_id: self._dones[:, j].copy()
+            for j, agent_id in enumerate(self.agent_ids)
+        }
+        done['__all__'] = self._dones[:, -1].copy()
+        info = {
+            'terminal_observation': {
+                agent_id: self._terminal_obs[:, j].copy()
+                for j, agent_id in enumerate(self.agent_ids)
+            }
+        }
+        return self._get_obs(), rew, done, info
+
+
+    def close(self):
+        """Stop the worker processes."""
+        if self.closed:
+            return
+        for conn in self._conns:
+            conn.send(('close', None))
+        for process in self._processes:
+            process.join()
+        self.closed = True
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,332 @@
+import copy
+import multiprocessing
+import numpy as np
+from dmarket.agents import AgentPopulation, seed_sequence
+from dmarket.engine import MarketEngine, BatchMarketEngine
+
+class RunningMoments:
+    """
+    Streaming mean and variance of arrays.
+
+    Batches of values are combined with the parallel form of Welford's
+    algorithm, so that the values themselves never have to be stored and
+    partial results, e.g. of different processes, can be merged.
+
+    Parameters
+    ----------
+    shape: tuple or int, optional (default=())
+        Shape of a single value.
+
+    Attributes
+    ----------
+    count: int
+        Number of values seen.
+    mean: ndarray
+        Mean of the values seen, 0 if there are none.
+    """
+    def __init__(self, shape=()):
+        self.count = 0
+        self.mean = np.zeros(shape)
+        self._m2 = np.zeros(shape)
+
+    @property
+    def variance(self):
+        """Sample variance of the values seen, ``NaN`` for less than two."""
+        if self.count < 2:
+            return np.full(self.mean.shape, np.nan)
+        return self._m2/(self.count - 1)
+
+    @property
+    def std(self):
+        """Sample standard deviation of the values seen."""
+        return np.sqrt(self.variance)
+
+    def update(self, values):
+        """
+        Add a batch of values.
+
+        Parameters
+        ----------
+        values: array_like
+            A single value or a batch of values along the first axis.
+        """
+        values = np.asarray(values, dtype=float)
+        values = values.reshape((-1,) + self.mean.shape)
+        if len(values):
+            mean = values.mean(axis=0)
+            m2 = ((values - mean)**2).sum(axis=0)
+            self._combine(len(values), mean, m2)
+        return self
+
+    def merge(self, other):
+        """Add the values seen by another ``RunningMoments`` object."""
+        if other.count:
+            self._combine(other.count, other.mean, other._m2)
+        return self
+
+    def _combine(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta*(count/total)
+        self._m2 = self._m2 + m2 + delta**2*(self.count*count/total)
+        self.count = total
+
+
+class GameStatistics:
+    """
+    Streaming per-agent statistics of market games.
+
+    Parameters
+    ----------
+    agent_names: list
+        The names of the agents, in the order of the arrays passed to
+        ``update``.
+    max_steps: int
+        Maximum number of rounds of a game, which is the number of bins of
+        the deal time histograms.
+
+    Attributes
+    ----------
+    rewards: RunningMoments object
+        Mean and variance of the reward of each agent.
+    n_deals: ndarray
+        Number of games in which each agent was matched.
+    deal_times: ndarray of shape (n_agents, max_steps)
+        Histogram of the round in which each agent was matched.
+    price_sums: ndarray
+        Sum of the deal prices of each agent.
+    """
+    def __init__(self, agent_names, max_steps):
+        self.agent_names = list(agent_names)
+        self.max_steps = max_steps
+        n_agents = len(self.agent_names)
+        self.rewards = RunningMoments(n_agents)
+        self.n_deals = np.zeros(n_agents, dtype=int)
+        self.deal_times = np.zeros((n_agents, max_steps), dtype=int)
+        self.price_sums = np.zeros(n_agents)
+
+    @property
+    def n_games(self):
+        return self.rewards.count
+
+    def update(self, prices, times, rewards):
+        """
+        Add the outcome of one or more games, see ``MarketEngine.run_episode``.
+
+        Parameters
+        ----------
+        prices, times, rewards: array_like
+            Deal prices, deal times and rewards of each agent, with the games
+            along the first axis if there are several.
+        """
+        times = np.atleast_2d(times)
+        matched = times >= 0
+        self.rewards.update(rewards)
+        self.n_deals += matched.sum(axis=0)
+        games, agents = np.nonzero(matched)
+        np.add.at(self.deal_times, (agents, times[games, agents]), 1)
+        self.price_sums += np.nansum(np.atleast_2d(prices), axis=0)
+        return self
+
+    def merge(self, other):
+        """Add the games seen by another ``GameStatistics`` object."""
+        self.rewards.merge(other.rewards)
+        self.n_deals += other.n_deals
+        self.deal_times += other.deal_times
+        self.price_sums += other.price_sums
+        return self
+
+    def summary(self):
+        """
+        Summarize the statistics of each agent.
+
+        Returns
+        -------
+        summary: dict
+            A dictionary indexed by agent name. Each entry is a dict with the
+            mean and standard deviation of the reward, the fraction of games
+            with a deal, and the mean deal price and deal time of the games
+            with a deal (``NaN`` if there were none).
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            deal_rates = self.n_deals/self.n_games
+            mean_prices = self.price_sums/self.n_deals
+            mean_times = self.deal_times @ np.arange(self.max_steps) \
+                / self.n_deals
+        columns = zip(self.rewards.mean.tolist(), self.rewards.std.tolist(),
+                      deal_rates.tolist(), mean_prices.tolist(),
+                      mean_times.tolist())
+        return {
+            name: {
+                'reward_mean': reward_mean,
+                'reward_std': reward_std,
+                'deal_rate': deal_rate,
+                'deal_price_mean': price,
+                'deal_time_mean': time,
+            }
+            for name, (reward_mean, reward_std, deal_rate, price, time)
+            in zip(self.agent_names, columns)
+        }
+
+
+def _play_batch(market, population, setting, n_games):
+    """
+    Play ``n_games`` games at once in a batch market until all are done.
+
+    Returns the deal prices, deal times and rewards of the agents in
+    ``population.agents`` as arrays of shape ``(n_games, n_agents)``.
+    """
+    batch = BatchMarketEngine(n_games, market.n_buyers, market.n_sellers,
+                              market.max_steps)
+    slots = np.array([market.slots[agent.name] for agent in population.agents],
+                     dtype=int)
+    other_slots = [market.slots[agent.name]
+                   for agent in population.other_agents]
+    population.reset(n_games)
+
+    n_buyers = market.n_buyers
+    offers = np.full((n_games, market.n_agents), np.nan)
+    prices = np.full((n_games, market.n_agents), np.nan)
+    times = np.full((n_games, market.n_agents), -1)
+    while not batch.done.all():
+        observations = ()
+        if other_slots:
+            states = setting.get_batch_states(other_slots, batch)
+            observations = [states[slot] for slot in other_slots]
+        offers[:, slots] = population.get_offers(batch.time, observations)
+        time = batch.time.copy()
+        batch.step(offers[:, :n_buyers], offers[:, n_buyers:])
+        matched = ~np.isnan(batch.deals)
+        prices[matched] = batch.deals[matched]
+        times[matched] = np.broadcast_to(time[:, None], times.shape)[matched]
+
+    prices, times = prices[:, slots], times[:, slots]
+    reservation_prices = np.array(
+        [agent.reservation_price for agent in population.agents], dtype=float
+    )
+    signs = np.array(
+        [1 if agent.role == 'seller' else -1 for agent in population.agents]
+    )
+    rewards = np.nan_to_num((prices - reservation_prices)*signs)
+    return prices, times, rewards
+
+
+def _private_copies(agents):
+    """
+    Copies of the agents that can be seeded without touching the originals.
+
+    Models are shared with the originals instead of copied.
+    """
+    memo = {
+        id(agent.model): agent.model for agent in agents
+        if getattr(agent, 'model', None) is not None
+    }
+    return copy.deepcopy(list(agents), memo)
+
+
+def _evaluate_games(agents, setting, n_games, max_steps, batch_size,
+                    pregenerate, seed, keep_games):
+    """Play ``n_games`` games in this process, see ``evaluate``."""
+    # Seeding replaces the generators of the agents, which belong to the caller
+    agents = _private_copies(agents)
+    buyer_ids = [agent.name for agent in agents if agent.role == 'buyer']
+    seller_ids = [agent.name for agent in agents if agent.role == 'seller']
+    history_length = 0
+    if setting is not None:
+        history_length = getattr(setting, 'history_length', None)
+    market = MarketEngine(buyer_ids, seller_ids, max_steps,
+                          history_length=history_length)
+    population = AgentPopulation(
+        agents, pregenerate=(max_steps if pregenerate else None)
+    )
+    population.seed(seed)
+    stats = GameStatistics([agent.name for agent in population.agents],
+                           max_steps)
+
+    games = []
+    for start in range(0, n_games, batch_size or 1):
+        if batch_size:
+            game = _play_batch(market, population, setting,
+                               min(batch_size, n_games - start))
+        else:
+            game = market.run_episode(population, setting)
+        stats.update(*game)
+        if keep_games:
+            games.append(np.reshape(game, (3, -1, len(agents))))
+    if keep_games:
+        games = np.concatenate(games, axis=1) if games \
+            else np.zeros((3, 0, len(agents)))
+    return stats, games
+
+
+def _evaluate_worker(args):
+    return _evaluate_games(*args)
+
+
+def evaluate(agents, setting=None, n_games=100, max_steps=30, batch_size=None,
+             n_workers=None, pregenerate=False, seed=None, keep_games=False):
+    """
+    Play many games of a fixed set of agents and collect their statistics.
+
+    The statistics are aggregated while playing, see ``GameStatistics``, so
+    no per-game tables are built unless ``keep_games`` is set.
+
+    Parameters
+    ----------
+    agents: list
+        The agents of the market, e.g., fixed agents together with trained
+        ``GymRLAgent`` objects. Agents that share a model are evaluated with
+        a single prediction per round, see ``AgentPopulation``.
+    setting: InformationSetting object, optional (default=None)
+        The information setting that gives the observations of agents that
+        use them. It can be omitted if no agent needs observations.
+    n_games: int, optional (default=100)
+        Number of games to play.
+    max_steps: int, optional (default=30)
+        Maximum number of rounds per game.
+    batch_size: int, optional (default=None)
+        If given, games are played ``batch_size`` at a time in a
+        ``BatchMarketEngine``. Otherwise, each game is played with
+        ``MarketEngine.run_episode``.
+    n_workers: int, optional (default=None)
+        If larger than 1, the games are split over this many processes, whose
+        statistics are merged afterwards. The agents and the setting need to
+        be picklable.
+    pregenerate: bool, optional (default=False)
+        If True, the random numbers of the agents are drawn for a whole game
+        at once, see ``AgentPopulation``.
+    seed: None, int or SeedSequence, optional (default=None)
+        Seed of the random generators of the agents. Every process gets an
+        independent seed derived from it. The games are played with copies of
+        the agents, so their own generators are left untouched.
+    keep_games: bool, optional (default=False)
+        If True, also return the outcome of every game.
+
+    Returns
+    -------
+    stats: GameStatistics object
+        The aggregated statistics, see ``GameStatistics.summary``.
+    games: ndarray of shape (3, n_games, n_agents)
+        Only returned if ``keep_games`` is set. The deal prices, deal times
+        and rewards of each game and agent, in the order of ``agents``.
+    """
+    n_workers = min(n_workers or 1, max(n_games, 1))
+    seeds = seed_sequence(seed).spawn(n_workers)
+    chunks = [len(chunk) for chunk in np.array_split(range(n_games), n_workers)]
+    args = [
+        (agents, setting, chunk, max_steps, batch_size, pregenerate, seed,
+         keep_games)
+        for chunk, seed in zip(chunks, seeds)
+    ]
+    if n_workers > 1:
+        with multiprocessing.Pool(n_workers) as pool:
+            results = pool.map(_evaluate_worker, args)
+    else:
+        results = [_evaluate_worker(arg) for arg in args]
+
+    stats = results[0][0]
+    for other, _ in results[1:]:
+        stats.merge(other)
+    if keep_games:
+        return stats, np.concatenate([games for _, games in results], axis=1)
+    return stats
@@ -1,6 +1,32 @@
+import inspect
 import numpy as np
 from gym.spaces import Discrete, Box, Tuple
 
+def _sorted_head(values, n, reverse=False):
+    """
+    The first ``n`` values in increasing order, or decreasing order if
+    ``reverse`` is set, ignoring NaN.
+    """
+    if len(values) <= 64:
+        # Sorting a short list is cheaper than the array functions below
+        values = [value for value in values.tolist() if value == value]
+        return sorted(values, reverse=reverse)[0:n]
+    if reverse:
+        return -_sorted_head(-values, n)
+    values = values[~np.isnan(values)]
+    if len(values) > n:
+        values = np.partition(values, n - 1)[0:n]
+    return np.sort(values)
+
+
+def _takes_out(get_states):
+    """Whether a ``get_states`` method accepts the ``out`` buffer."""
+    try:
+        return 'out' in inspect.signature(get_states).parameters
+    except (TypeError, ValueError):
+        return False
+
+
 class InformationSetting:
     """
     Abstract information setting class.
@@ -9,12 +35,21 @@ class InformationSetting:
     ----------
     observation_space: gym.spaces object
         The specification of the observation space under this setting.
+
+    history_length: int or None
+        Number of most recent market steps the setting reads from the market
+        history. ``None`` means the full history may be needed, and 0 that
+        only the last step is read through ``last_offers`` or the ``last_*``
+        views of the history, which the market keeps anyway. The environments
+        use this to pick the smallest sufficient history to keep in the market
+        engine.
     """
+    history_length = None
 
     def __init__(self):
         pass
 
-    def get_states(self, agent_ids, market):
+    def get_states(self, agent_ids, market, out=None):
         """
         Compute the observations of agents given the market object.
 
@@ -26,17 +61,85 @@ class InformationSetting:
         market: MarketEngine object
             The current market object.
 
+        out: ndarray, optional (default=None)
+            Buffer of shape ``observation_space.shape`` that settings in which
+            every agent gets the same observation write into, so that no new
+            array is allocated. The returned observations then refer to
+            ``out``. Other settings ignore it, and subclasses may leave it out
+            of their signature, in which case it is never passed.
+
         Returns
         -------
         states: dict
             A dictionary of observations for each agent id. Each observation
             should be an element of the ``observation_space``.
         """
-        pass
+        raise NotImplementedError
+
+    def get_states_array(self, agent_slots, market, out=None):
+        """
+        Compute the observations of agents stacked into a single array.
+
+        Parameters
+        ----------
+        agent_slots: list
+            A list of market slots of the agents to compute the observations
+            for.
+
+        market: MarketEngine object
+            The current market object.
+
+        out: ndarray, optional (default=None)
+            Buffer of shape ``(len(agent_slots), *observation_space.shape)``
+            to write the observations into.
+
+        Returns
+        -------
+        states: ndarray
+            The observations of the agents along the first axis. For tuple
+            observation spaces, a tuple of such arrays. By default, these are
+            the observations of ``get_states`` stacked, so subclasses only
+            need to override this to avoid building the dict.
+        """
+        agent_ids = [market.agent_ids[slot] for slot in agent_slots]
+        states = self.get_states(agent_ids, market)
+        states = [states[agent_id] for agent_id in agent_ids]
+        if states and isinstance(states[0], tuple):
+            return tuple(np.array(part) for part in zip(*states))
+        if out is None:
+            out = np.zeros((len(states),) + self.observation_space.shape)
+        if states:
+            out[:] = states
+        return out
 
     def get_state(self, agent_id, market):
         return self.get_states([agent_id], market)[agent_id]
 
+    def get_batch_states(self, agent_slots, market, out=None):
+        """
+        Compute the observations of agents in a batch of markets.
+
+        Parameters
+        ----------
+        agent_slots: list
+            A list of agent slots to compute the observations for.
+
+        market: BatchMarketEngine object
+            The current batch market object.
+
+        out: ndarray, optional (default=None)
+            Buffer of shape ``(n_markets, *observation_space.shape)``, used
+            like in ``get_states``.
+
+        Returns
+        -------
+        states: dict
+            A dictionary of observations for each agent slot. Each observation
+            is a batch of elements of the ``observation_space`` along the first
+            axis, one for each market.
+        """
+        raise NotImplementedError
+
 
 class BlackBoxSetting(InformationSetting):
     """
@@ -47,27 +150,30 @@ class BlackBoxSetting(InformationSetting):
     observation_space: Box object
         Represents the last offer of the agent. Each element is a numpy array
         with a single entry. If there was no offer, it will be ``[0]``.
+
+    The observations are read from the ``last_offers`` array of the market
+    engine, so no offers need to be looked up in the history.
     """
+    history_length = 0
+
     def __init__(self):
         self.observation_space = Box(low=0, high=np.infty, shape=[1])
 
-    def get_states(self, agent_ids, market):
-        if not market.offer_history:
-            return {agent_id: np.array([0]) for agent_id in agent_ids}
+    def get_states(self, agent_ids, market, out=None):
+        slots = [market.slots[agent_id] for agent_id in agent_ids]
+        return dict(zip(agent_ids, self.get_states_array(slots, market)))
 
-        bids, asks = market.offer_history[-1]
-        # This might be a bit slow
-        bids = {agent_id: val for val, agent_id in bids}
-        asks = {agent_id: val for val, agent_id in asks}
-        result = {}
-        for agent_id in agent_ids:
-            if agent_id in bids:
-                result[agent_id] = np.array([bids[agent_id]])
-            elif agent_id in asks:
-                result[agent_id] = np.array([asks[agent_id]])
-            else:
-                result[agent_id] = np.array([0])
-        return result
+    def get_states_array(self, agent_slots, market, out=None):
+        if out is None:
+            out = np.zeros(shape=(len(agent_slots), 1))
+        offers = market.last_offers[agent_slots]
+        out[:, 0] = offers
+        out[np.isnan(offers)] = 0
+        return out
+
+    def get_batch_states(self, agent_slots, market, out=None):
+        offers = np.nan_to_num(market.last_offers)
+        return {slot: offers[:, slot:slot+1] for slot in agent_slots}
 
 
 class OfferInformationSetting(InformationSetting):
@@ -87,29 +193,61 @@ class OfferInformationSetting(InformationSetting):
         contains the bids and second row the asks. No offers will be
         represented by 0.
     """
+    history_length = 0
+
     def __init__(self, n_offers=5):
         self.n_offers = n_offers
         self.observation_space = Box(low=0, high=np.infty, shape=[2, n_offers])
 
-    def get_states(self, agent_ids, market):
+    def _write_states(self, market, out):
+        """Write the observation of the last round into ``out``."""
+        out.fill(0)
+        if not market.history.n_steps:
+            return out
         n = self.n_offers
-        offers = np.zeros(shape=(2, n))
-        if not market.offer_history:
-            return {agent_id: offers for agent_id in agent_ids}
+        offers = market.history.last_offers
+        bids = _sorted_head(offers[:market.n_buyers], n, reverse=True)
+        asks = _sorted_head(offers[market.n_buyers:], n)
+        out[0, 0:len(bids)] = bids
+        out[1, 0:len(asks)] = asks
+        return out
 
-        bids, asks = market.offer_history[-1]
-        for i, (bid, agent_id) in enumerate(bids[0:n]): offers[0][i] = bid
-        for i, (ask, agent_id) in enumerate(asks[0:n]): offers[1][i] = ask
+    def get_states(self, agent_ids, market, out=None):
+        if out is None:
+            out = np.zeros(shape=(2, self.n_offers))
+        offers = self._write_states(market, out)
         # The information each agent gets is the same
         return {agent_id: offers for agent_id in agent_ids}
 
+    def get_states_array(self, agent_slots, market, out=None):
+        if out is None:
+            out = np.zeros(shape=(len(agent_slots), 2, self.n_offers))
+        if len(out):
+            out[1:] = self._write_states(market, out[0])
+        return out
+
+    def get_batch_states(self, agent_slots, market, out=None):
+        n = self.n_offers
+        if out is None:
+            out = np.zeros(shape=(market.n_markets, 2, n))
+        # Sorting puts NaN (no offer) last, in both directions
+        bids = -np.sort(-market.last_bids, axis=1)[:, 0:n]
+        asks = np.sort(market.last_asks, axis=1)[:, 0:n]
+        out.fill(0)
+        out[:, 0, 0:bids.shape[1]] = bids
+        out[:, 1, 0:asks.shape[1]] = asks
+        np.nan_to_num(out, copy=False)
+        return {slot: out for slot in agent_slots}
+
 
 class DealInformationSetting(InformationSetting):
     """
     The agent is aware of N deals of the last round.
 
     Note: the N deals need not be sorted on deal price. It depends the order
-    the matcher matches deals, see ``MarketEngine.matcher``.
+    the matcher matches deals, see ``MarketEngine.matcher``. In markets with
+    ``quantities``, each matched buyer shows its average price once, in the
+    order of its first fill.
 
     Parameters
     ----------
@@ -122,22 +260,50 @@ class DealInformationSetting(InformationSetting):
         Each element is a numpy array of shape ``(n_offers,)``. No deals will
         be represented by 0.
     """
+    history_length = 0
+
     def __init__(self, n_deals=5):
         self.n_deals = n_deals
         self.observation_space = Box(low=0, high=np.infty, shape=[n_deals])
 
-    def get_states(self, agent_ids, market):
-        n = self.n_deals
-        if market.deal_history:
-            # Here we exploit that deal_history contains the same deal twice
-            # in a row, once for the buyer and once for the seller. Since
-            # Python >= 3.6 dicts preserve the order of insertion, we can
-            # rely on this to obtain the distinct deals that happened.
-            deals = list(market.deal_history[-1].values())[0:2*n:2]
-            deals = np.pad(deals, (0, n-len(deals))) # Pad it with zeros
-        else: deals = np.zeros(n)
+    def _write_states(self, market, out):
+        """Write the observation of the last round into ``out``."""
+        out.fill(0)
+        if not market.history.n_steps:
+            return out
+        # The buyer and seller of a deal share the same rank, which is the
+        # order in which the matcher matched them. With quantities a buyer
+        # may fill several deals but keeps the rank of its first, so the
+        # matched buyers are sorted by rank rather than placed at it.
+        n_buyers = market.n_buyers
+        ranks = market.history.last_ranks[:n_buyers]
+        buyers = np.flatnonzero(ranks >= 0)
+        buyers = buyers[np.argsort(ranks[buyers])][0:self.n_deals]
+        out[0:len(buyers)] = market.history.last_deals[buyers]
+        return out
+
+    def get_states(self, agent_ids, market, out=None):
+        if out is None:
+            out = np.zeros(self.n_deals)
+        deals = self._write_states(market, out)
         return {agent_id: deals for agent_id in agent_ids}
 
+    def get_states_array(self, agent_slots, market, out=None):
+        if out is None:
+            out = np.zeros(shape=(len(agent_slots), self.n_deals))
+        if len(out):
+            out[1:] = self._write_states(market, out[0])
+        return out
+
+    def get_batch_states(self, agent_slots, market, out=None):
+        n = self.n_deals
+        if out is None:
+            out = np.zeros(shape=(market.n_markets, n))
+        prices = market.deal_prices[:, 0:n]
+        out.fill(0)
+        out[:, 0:prices.shape[1]] = np.nan_to_num(prices)
+        return {slot: out for slot in agent_slots}
+
 
 class TimeInformationWrapper(InformationSetting):
     """
@@ -158,12 +324,26 @@ class TimeInformationWrapper(InformationSetting):
     def __init__(self, base_setting, max_steps=30):
         self.base_setting = base_setting
         self.max_steps = max_steps
+        self.history_length = getattr(base_setting, 'history_length', None)
         self.observation_space = Tuple((base_setting.observation_space,
                                         Discrete(max_steps)))
+        self._base_takes_out = _takes_out(base_setting.get_states)
 
-    def get_states(self, agent_ids, market):
-        base_obs = self.base_setting.get_states(agent_ids, market)
+    def get_states(self, agent_ids, market, out=None):
+        if self._base_takes_out:
+            base_obs = self.base_setting.get_states(agent_ids, market, out)
+        else:
+            base_obs = self.base_setting.get_states(agent_ids, market)
         result = {}
         for agent_id, obs in base_obs.items():
             result[agent_id] = (obs, market.time)
         return result
+
+    def get_states_array(self, agent_slots, market, out=None):
+        base_obs = self.base_setting.get_states_array(agent_slots, market, out)
+        return base_obs, np.full(len(agent_slots), market.time)
+
+    def get_batch_states(self, agent_slots, market, out=None):
+        base_obs = self.base_setting.get_batch_states(agent_slots, market, out)
+        time = market.time.copy()
+        return {slot: (obs, time) for slot, obs in base_obs.items()}
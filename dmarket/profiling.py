@@ -0,0 +1,109 @@
+from time import perf_counter
+
+class StepProfiler:
+    """
+    Records the wall time spent in the phases of environment steps.
+
+    The environments mark the end of each phase with ``record``, passing the
+    time the phase started. This returns the current time, which is the
+    start of the next phase::
+
+        t = profiler.clock()
+        ...  # first phase
+        t = profiler.record('first', t)
+        ...  # second phase
+        profiler.record('second', t)
+
+    Attributes
+    ----------
+    times: dict
+        Total wall time in seconds spent in each phase, indexed by name.
+    counts: dict
+        Number of times each phase was recorded, indexed by name.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.times = {}
+        self.counts = {}
+
+    def clock(self):
+        """The current time, to be passed to ``record``."""
+        return perf_counter()
+
+    def record(self, phase, start):
+        """
+        Add the time elapsed since ``start`` to ``phase``.
+
+        Parameters
+        ----------
+        phase: str
+            Name of the phase.
+        start: float
+            The time the phase started, from ``clock`` or ``record``.
+
+        Returns
+        -------
+        now: float
+            The current time.
+        """
+        now = perf_counter()
+        self.times[phase] = self.times.get(phase, 0.0) + now - start
+        self.counts[phase] = self.counts.get(phase, 0) + 1
+        return now
+
+    def clear(self):
+        """Forget all recorded times."""
+        self.times.clear()
+        self.counts.clear()
+
+    def as_dict(self):
+        """
+        Export the recorded times, e.g. for logging.
+
+        Returns
+        -------
+        phases: dict
+            A dictionary indexed by phase name. Each entry is a dict with the
+            total ``time`` in seconds, the number of ``calls``, the ``mean``
+            time per call and the ``fraction`` of the total time of all
+            phases.
+        """
+        total = sum(self.times.values())
+        return {
+            phase: {
+                'time': time,
+                'calls': self.counts[phase],
+                'mean': time/self.counts[phase],
+                'fraction': time/total if total else 0.0,
+            }
+            for phase, time in self.times.items()
+        }
+
+    def report(self):
+        """A table of the recorded phases, slowest first, as a string."""
+        phases = sorted(self.as_dict().items(), key=lambda item: -item[1]['time'])
+        lines = [f"{'phase':<20} {'calls':>8} {'total (s)':>10} "
+                 f"{'mean (us)':>10} {'share':>6}"]
+        for phase, stats in phases:
+            lines.append(
+                f"{phase:<20} {stats['calls']:>8} {stats['time']:>10.3f} "
+                f"{stats['mean']*1e6:>10.1f} {stats['fraction']:>6.1%}"
+            )
+        return "\n".join(lines)
+
+
+class NullProfiler(StepProfiler):
+    """
+    Profiler that records nothing, used when profiling is disabled.
+
+    Its ``clock`` and ``record`` methods return immediately, so that
+    instrumented code costs only a few method calls per step.
+    """
+    enabled = False
+
+    def clock(self):
+        return 0.0
+
+    def record(self, phase, start):
+        return 0.0
@@ -1,4 +1,5 @@
 import pytest
+import numpy as np
 from dmarket.agents import *
 
 def test_random_agent():
@@ -44,3 +45,192 @@ def test_linear_agent():
     assert b.get_offer((None, 0)) < b.get_offer((None, 1))
     assert s.get_offer((None, 0)) > s.get_offer((None, 1))
 
+
+
+def test_batch_offers():
+    obs = np.zeros((3, 1))
+    np.testing.assert_array_equal(
+        ConstantAgent('buyer', 100).get_offers(obs), [100, 100, 100]
+    )
+    offers = UniformRandomAgent('seller', 100).get_offers(obs)
+    assert offers.shape == (3,) and (offers > 100).all()
+
+    # Time dependent agents get a batch of times along with the observations
+    b = TimeLinearAgent('buyer', 100, noise=0)
+    offers = b.get_offers((obs, np.array([0, 1, 2])))
+    np.testing.assert_array_equal(
+        offers, [b.get_offer((None, t)) for t in range(3)]
+    )
+
+
+def test_population():
+    agents = [
+        TimeLinearAgent('seller', 100, noise=0),
+        ConstantAgent('buyer', 90),
+        UniformRandomAgent('buyer', 100),
+        GymRLAgent('seller', 100),
+        TimeLinearAgent('buyer', 80, noise=0),
+    ]
+    population = AgentPopulation(agents)
+
+    # Only agents that need observations are handled individually
+    assert population.other_agents == [agents[3]]
+
+    # Offers are the same as those of the individual agents
+    offers = population.get_offers(3, [None])
+    assert offers.shape == (5,)
+    assert offers[0] == agents[0].get_offer((None, 3))
+    assert offers[1] == 90
+    assert 50 <= offers[2] <= 100
+    assert np.isnan(offers[3])
+    assert offers[4] == agents[4].get_offer((None, 3))
+
+    # A batch of times gives a batch of offers
+    offers = population.get_offers(np.array([0, 1]), [None])
+    assert offers.shape == (2, 5)
+    np.testing.assert_array_equal(
+        offers[:, 0], [agents[0].get_offer((None, t)) for t in [0, 1]]
+    )
+
+
+def test_agent_rng():
+    # Agents with equally seeded generators make the same offers
+    a = UniformRandomAgent('buyer', 100, rng=np.random.default_rng(1))
+    b = UniformRandomAgent('buyer', 100, rng=np.random.default_rng(1))
+    assert a.name == b.name
+    assert a.get_offer(None) == b.get_offer(None)
+
+    # Seeding a population gives reproducible and independent offers
+    population = AgentPopulation([
+        UniformRandomAgent('buyer', 100),
+        TimeLinearAgent('seller', 100),
+        UniformRandomAgent('seller', 100),
+    ])
+    population.seed(42)
+    first = population.get_offers(np.arange(5))
+    population.seed(42)
+    np.testing.assert_array_equal(population.get_offers(np.arange(5)), first)
+    population.seed(43)
+    assert (population.get_offers(np.arange(5)) != first).all()
+
+
+def test_population_agent_rng():
+    # Agents with their own generator keep drawing from it
+    agents = [
+        UniformRandomAgent('buyer', 100, rng=np.random.default_rng(1)),
+        TimeLinearAgent('seller', 100, rng=np.random.default_rng(2)),
+        UniformRandomAgent('seller', 100),
+    ]
+    population = AgentPopulation(agents, rng=np.random.default_rng(0))
+    assert population.other_agents == []
+    offers = population.get_offers(3)
+    expected = [
+        UniformRandomAgent('buyer', 100, rng=np.random.default_rng(1)),
+        TimeLinearAgent('seller', 100, rng=np.random.default_rng(2)),
+    ]
+    assert offers[0] == expected[0].get_offer(None)
+    assert offers[1] == expected[1].get_offer((None, 3))
+
+    offers = population.get_offers(np.arange(4))
+    assert offers.shape == (4, 3)
+    assert len(set(offers[:, 0])) == 4
+
+
+def test_population_pregenerate():
+    agents = [UniformRandomAgent('buyer', 100), TimeLinearAgent('seller', 100)]
+    population = AgentPopulation(agents, rng=np.random.default_rng(0),
+                                 pregenerate=10)
+
+    # Random numbers are drawn on reset and looked up by time
+    population.reset()
+    first = population.get_offers(3)
+    np.testing.assert_array_equal(population.get_offers(3), first)
+    population.reset()
+    assert (population.get_offers(3) != first).all()
+
+    # For a batch, only the given markets get new numbers
+    population.reset(batch_size=3)
+    time = np.array([1, 2, 3])
+    first = population.get_offers(time)
+    population.reset(batch_size=3, markets=[False, True, False])
+    offers = population.get_offers(time)
+    np.testing.assert_array_equal(offers[[0, 2]], first[[0, 2]])
+    assert (offers[1] != first[1]).all()
+
+
+def test_normalize_observations():
+    agents = [GymRLAgent('buyer', 100), GymRLAgent('seller', 50)]
+    observations = np.array([[[0, 120], [90, 80]], [[60, 0], [40, 55]]])
+    result = normalize_observations(
+        observations,
+        np.array([agent.reservation_price for agent in agents]),
+        np.array([-1, 1]),
+    )
+    for agent, obs, normalized in zip(agents, observations, result):
+        np.testing.assert_array_equal(normalized, agent.normalize(obs))
+
+
+def test_rl_agent_group():
+    agents = [
+        GymRLAgent('buyer', 100),
+        GymRLAgent('seller', 50, discretization=10, max_factor=0.2),
+        GymRLAgent('buyer', 80, max_factor=0.9),
+    ]
+    group = GymRLAgentGroup(agents)
+
+    # Actions of all agents are converted at once
+    actions = np.array([3, 7, 19])
+    np.testing.assert_allclose(
+        group.action_to_price(actions),
+        [agent.action_to_price(a) for agent, a in zip(agents, actions)]
+    )
+
+    # Or of a subset of the agents
+    np.testing.assert_allclose(
+        group.action_to_price([1, 2], [2, 0]),
+        [agents[2].action_to_price(1), agents[0].action_to_price(2)]
+    )
+
+    observations = np.array([[0, 120], [60, 40], [70, 90]])
+    np.testing.assert_allclose(
+        group.normalize(observations),
+        [agent.normalize(obs) for agent, obs in zip(agents, observations)]
+    )
+
+
+class CountingModel:
+    """Model that always picks action 3 and counts its predict calls."""
+    def __init__(self):
+        self.calls = 0
+
+    def predict(self, observations):
+        self.calls += 1
+        return np.full(len(observations), 3), None
+
+
+def test_population_shared_model():
+    model = CountingModel()
+    agents = [
+        GymRLAgent('buyer', 100, model=model),
+        ConstantAgent('seller', 50),
+        GymRLAgent('seller', 60, model=model, discretization=10),
+        GymRLAgent('buyer', 90, model=model),
+    ]
+    population = AgentPopulation(agents)
+    rl_agents = [agents[0], agents[2], agents[3]]
+    expected = [agent.action_to_price(3) for agent in rl_agents]
+
+    observations = [np.array([80.]), np.array([70.]), None]
+    offers = population.get_offers(0, observations)
+    assert model.calls == 1
+    np.testing.assert_allclose(offers[[0, 2]], expected[0:2])
+    assert np.isnan(offers[3])
+    assert offers[1] == 50
+
+    # A batch of markets still takes a single prediction
+    observations = [np.ones((4, 1)), np.ones((4, 1)), np.ones((4, 1))]
+    offers = population.get_offers(np.zeros(4, dtype=int), observations)
+    assert model.calls == 2
+    assert offers.shape == (4, 4)
+    np.testing.assert_allclose(offers[:, [0, 2, 3]],
+                               np.tile(expected, (4, 1)))
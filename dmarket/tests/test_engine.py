@@ -1,5 +1,12 @@
+import subprocess
+import sys
 import pytest
 import numpy as np
+from dmarket.engine import (
+    MarketEngine, BatchMarketEngine, OrderBookMarketEngine,
+    ContinuousMarketEngine, match_sort, match_partial, match_numba,
+    match_quantities, _match_kernel
+)
 
 def test_market_step(market):
     m = market(1,1)
@@ -41,3 +48,617 @@ def test_market_done(market):
     for i in range(m.max_steps): m.step({})
     assert m.done == {0, 1, 2, 3}
 
+
+
+def test_batch_match_same_as_match():
+    rng = np.random.default_rng(0)
+    n_buyers, n_sellers = 6, 4
+    # Integer offers to get plenty of ties, NaN for missing offers
+    bids = rng.integers(90, 110, size=(200, n_buyers)).astype(float)
+    asks = rng.integers(90, 110, size=(200, n_sellers)).astype(float)
+    bids[rng.random(bids.shape) < 0.2] = np.nan
+    asks[rng.random(asks.shape) < 0.2] = np.nan
+
+    bid_deals, ask_deals = BatchMarketEngine.match(bids, asks)
+    for row in range(bids.shape[0]):
+        deals = MarketEngine.match(
+            [(b, i) for i, b in enumerate(bids[row]) if not np.isnan(b)],
+            [(a, n_buyers + i) for i, a in enumerate(asks[row])
+             if not np.isnan(a)],
+        )
+        expected_bids = [deals.get(i, np.nan) for i in range(n_buyers)]
+        expected_asks = [deals.get(n_buyers + i, np.nan)
+                         for i in range(n_sellers)]
+        np.testing.assert_array_equal(bid_deals[row], expected_bids)
+        np.testing.assert_array_equal(ask_deals[row], expected_asks)
+
+
+def test_batch_market_done():
+    m = BatchMarketEngine(2, 1, 2, max_steps=3)
+    nan = np.nan
+
+    # Only the first market matches, which finishes it since its buyer is done
+    bid_deals, ask_deals = m.step([[100], [90]], [[100, 110], [nan, 110]])
+    np.testing.assert_array_equal(bid_deals, [[100], [nan]])
+    np.testing.assert_array_equal(ask_deals, [[100, nan], [nan, nan]])
+    np.testing.assert_array_equal(m.done, [True, False])
+    assert m.sellers_done.all(axis=1).tolist() == [True, False]
+
+    # Done markets ignore offers and stop advancing in time
+    bid_deals, _ = m.step([[120], [90]], [[80, 80], [nan, 110]])
+    assert np.isnan(bid_deals[0, 0])
+    np.testing.assert_array_equal(m.time, [1, 2])
+
+    # Everyone is done after max_steps
+    m.step([[nan], [nan]], [[nan, nan], [nan, nan]])
+    assert m.done.all()
+
+    # Resetting a single market leaves the other untouched
+    m.reset([1])
+    np.testing.assert_array_equal(m.time, [1, 0])
+    np.testing.assert_array_equal(m.done, [True, False])
+
+
+def test_market_step_array(market):
+    m = market(2, 2)
+    assert m.agent_ids == [0, 1, 2, 3]
+
+    # Arrays are indexed by slot and NaN means no offer
+    deals = m.step(np.array([100, np.nan, 90, 95]))
+    np.testing.assert_array_equal(deals, [95, np.nan, 95, np.nan])
+    np.testing.assert_array_equal(m.done_mask, [True, False, True, False])
+    assert m.done == {0, 2}
+    assert m.deal_history[-1] == {0: 95, 2: 95}
+
+    # Offers of agents that are done are ignored
+    deals = m.step({0: 120, 1: 80, 3: 90})
+    assert deals == {}
+    assert m.offer_history[-1] == ([(80, 1)], [(90, 3)])
+
+
+def test_market_unknown_agent(market):
+    m = market(1, 1)
+    with pytest.raises(RuntimeError):
+        m.step({'unknown': 100})
+
+
+def test_market_history(market):
+    m = market(2, 2)
+    m.step({0: 100, 1: 90, 2: 95, 3: 110})
+    m.step({1: 120, 3: 110})
+
+    # Columnar history has one row per step and slot
+    assert len(m.history) == 2
+    nan = np.nan
+    np.testing.assert_array_equal(m.history.last_offers, [nan, 120, nan, 110])
+    np.testing.assert_array_equal(m.history.last_deals, [nan, 115, nan, 115])
+    np.testing.assert_array_equal(m.history.matched,
+                                  [[True, False, True, False],
+                                   [False, True, False, True]])
+
+    # The list of tuples format is still available
+    assert m.offer_history == [
+        ([(100, 0), (90, 1)], [(95, 2), (110, 3)]),
+        ([(120, 1)], [(110, 3)]),
+    ]
+    assert m.deal_history == [{0: 97.5, 2: 97.5}, {1: 115, 3: 115}]
+
+    # Reset reuses the allocated arrays
+    offers = m.history.offers
+    m.reset()
+    assert m.offer_history == []
+    m.step({})
+    assert m.history.offers is offers
+
+
+def test_market_history_retention():
+    # Only the last two steps are kept in a ring buffer
+    m = MarketEngine([0], [1], max_steps=10, history_length=2)
+    for price in [90, 95, 100]:
+        m.step({0: price})
+    assert m.offer_history == [([(95, 0)], []), ([(100, 0)], [])]
+    assert m.history.offers.shape == (2, 2)
+
+    # Without history, the last step can still be read
+    m = MarketEngine([0], [1], max_steps=10, history_length=0)
+    m.step({0: 90, 1: 80})
+    assert m.offer_history == []
+    np.testing.assert_array_equal(m.history.last_deals, [85, 85])
+
+
+@pytest.mark.parametrize("history_length", [None, 2])
+def test_market_dict_steps_same_as_arrays(history_length):
+    # Small books stepped with dicts only fill in the arrays when read, the
+    # partial matcher always works on the arrays
+    rng = np.random.default_rng(0)
+    buyers, sellers = ['b%d' % i for i in range(6)], ['s%d' % i for i in range(4)]
+    lists = MarketEngine(buyers, sellers, max_steps=8,
+                         history_length=history_length)
+    arrays = MarketEngine(buyers, sellers, max_steps=8,
+                          history_length=history_length, matcher='partial')
+    slots = MarketEngine(buyers, sellers, max_steps=8,
+                         history_length=history_length)
+    for game in range(20):
+        lists.reset()
+        arrays.reset()
+        slots.reset()
+        while not arrays.done_mask.all():
+            offers = {
+                agent_id: float(rng.integers(90, 110))
+                for agent_id in buyers + sellers if rng.random() < 0.7
+            }
+            deals = arrays.step(offers)
+            assert lists.step(offers) == deals
+            np.testing.assert_array_equal(
+                slots.step(slots.offers_to_array(offers)),
+                slots.offers_to_array(deals)
+            )
+            assert lists.done == arrays.done
+            # Several steps may pass before the arrays are read
+            if game % 2:
+                np.testing.assert_array_equal(lists.done_mask,
+                                              arrays.done_mask)
+                np.testing.assert_array_equal(lists.last_offers,
+                                              arrays.last_offers)
+        assert lists.offer_history == arrays.offer_history
+        assert lists.deal_history == arrays.deal_history
+        np.testing.assert_array_equal(lists.history.ranks, arrays.history.ranks)
+        assert lists.done_mask.all() and slots.done_mask.all()
+    assert lists.stats() == pytest.approx(arrays.stats(), nan_ok=True)
+
+
+@pytest.mark.parametrize("n_buyers,n_sellers", [(0, 3), (5, 5), (40, 25)])
+def test_match_partial_same_as_sort(n_buyers, n_sellers):
+    rng = np.random.default_rng(n_buyers)
+    for _ in range(100):
+        # Small integer range to get ties, NaN for missing offers
+        bids = rng.integers(90, 110, size=n_buyers).astype(float)
+        asks = rng.integers(95, 115, size=n_sellers).astype(float)
+        bids[rng.random(n_buyers) < 0.1] = np.nan
+        asks[rng.random(n_sellers) < 0.1] = np.nan
+        for expected, result in zip(match_sort(bids, asks),
+                                    match_partial(bids, asks, k=2)):
+            np.testing.assert_array_equal(expected, result)
+
+
+def uncompiled_match_numba(bids, asks):
+    return _match_kernel(bids, asks, -np.arange(len(bids)),
+                         np.arange(len(asks)))
+
+
+@pytest.mark.parametrize("matcher", [match_numba, uncompiled_match_numba])
+def test_match_numba_same_as_match(matcher):
+    rng = np.random.default_rng(1)
+    for _ in range(200):
+        n_buyers, n_sellers = rng.integers(0, 20, size=2)
+        bids = rng.integers(90, 110, size=n_buyers).astype(float)
+        asks = rng.integers(95, 115, size=n_sellers).astype(float)
+        bids[rng.random(n_buyers) < 0.1] = np.nan
+        asks[rng.random(n_sellers) < 0.1] = np.nan
+
+        # Sellers get the ids after the buyers, like the market slots
+        expected = MarketEngine.match(
+            [(b, i) for i, b in enumerate(bids) if not np.isnan(b)],
+            [(a, n_buyers + j) for j, a in enumerate(asks) if not np.isnan(a)]
+        )
+        buyers, sellers = matcher(bids, asks)
+        prices = (bids[buyers] + asks[sellers])/2
+        deals = dict(zip(buyers.tolist(), prices))
+        deals.update(zip((n_buyers + sellers).tolist(), prices))
+        assert deals == expected
+
+
+def test_match_numba_large_books():
+    # Large books are sorted differently, with ties, signed zeros and keys
+    rng = np.random.default_rng(3)
+    for n_offers in [300, 3000]:
+        bids = rng.uniform(-10, 110, size=n_offers).round(1)
+        asks = rng.uniform(-10, 110, size=n_offers).round(1)
+        bids[0:5] = 0.0
+        asks[0:5] = -0.0
+        bids[rng.random(n_offers) < 0.1] = np.nan
+        keys = rng.permutation(n_offers).astype(float)
+        for matcher_keys in [(), (keys, keys[::-1])]:
+            expected = match_sort(bids, asks, *matcher_keys)
+            result = match_numba(bids, asks, *matcher_keys)
+            for slots, expected_slots in zip(result, expected):
+                np.testing.assert_array_equal(slots, expected_slots)
+
+
+def test_numba_imported_lazily():
+    # Only match_numba pays for importing Numba, in a fresh interpreter
+    code = "import sys, dmarket.environments; print('numba' in sys.modules)"
+    result = subprocess.run([sys.executable, '-c', code], check=True,
+                            capture_output=True, text=True)
+    assert result.stdout.strip() == 'False'
+
+
+@pytest.mark.parametrize("matcher", [match_partial, match_numba])
+def test_match_tie_keys(matcher):
+    rng = np.random.default_rng(2)
+    for _ in range(100):
+        bids = rng.integers(90, 110, size=12).astype(float)
+        asks = rng.integers(95, 115, size=9).astype(float)
+        bids[rng.random(12) < 0.1] = np.nan
+        bid_keys = rng.permutation(12)
+        ask_keys = rng.permutation(9)
+        expected = match_sort(bids, asks, bid_keys, ask_keys)
+        result = matcher(bids, asks, bid_keys, ask_keys)
+        for slots, expected_slots in zip(result, expected):
+            np.testing.assert_array_equal(slots, expected_slots)
+
+    # Among equal offers, the lowest key goes first
+    buyers, sellers = match_sort(np.array([100., 100.]), np.array([90., 90.]),
+                                 np.array([1, 0]), np.array([1, 0]))
+    assert buyers.tolist() == [1, 0]
+    assert sellers.tolist() == [1, 0]
+
+
+def test_market_tie_break():
+    offers = {'b': 100, 'a': 100, 'd': 90, 'c': 90, 'e': 95}
+    m = MarketEngine(['a', 'b'], ['c', 'd', 'e'])
+    assert m.step(offers) == {'b': 95, 'c': 95, 'a': 95, 'd': 95}
+
+    m = MarketEngine(['a', 'b'], ['c', 'd', 'e'], tie_break='arrival')
+    deals = m.step(offers)
+    assert deals == {'b': 95, 'd': 95, 'a': 95, 'c': 95}
+    assert list(deals) == ['b', 'd', 'a', 'c']
+
+    # Random tie-breaking is reproducible with a seeded generator
+    offers = dict.fromkeys(range(13), 100)
+    results = []
+    for _ in range(2):
+        m = MarketEngine(list(range(10)), [10, 11, 12], tie_break='random',
+                         rng=np.random.default_rng(3))
+        results.append(list(m.step(offers)))
+    assert results[0] == results[1]
+    assert len(results[0]) == 6
+
+    with pytest.raises(ValueError):
+        MarketEngine([0], [1], tie_break='unknown')
+
+
+def test_market_partial_matcher():
+    m = MarketEngine([0, 1, 2], [3, 4, 5], matcher='partial')
+    deals = m.step({0: 100, 1: 90, 2: 95, 3: 110, 4: 100, 5: 90})
+    assert deals == {0: 95, 5: 95}
+    deals = m.step({1: 105, 2: 105, 3: 110, 4: 100})
+    assert deals == {2: 102.5, 4: 102.5}
+
+    m = MarketEngine([0, 1, 2], [3, 4, 5], matcher='numba')
+    deals = m.step({0: 100, 1: 90, 2: 95, 3: 110, 4: 100, 5: 90})
+    assert deals == {0: 95, 5: 95}
+
+    with pytest.raises(ValueError):
+        MarketEngine([0], [1], matcher='unknown')
+
+
+def test_market_last_offers(market):
+    m = market(2, 2)
+    assert np.isnan(m.last_offers).all()
+
+    # Offers of done agents are not kept
+    m.step({0: 100, 2: 90, 3: 120})
+    np.testing.assert_array_equal(m.last_offers, [100, np.nan, 90, 120])
+    m.step({0: 100, 1: 80})
+    np.testing.assert_array_equal(m.last_offers, [np.nan, 80, np.nan, np.nan])
+
+    m.reset()
+    assert np.isnan(m.last_offers).all()
+
+
+class ConstantModel:
+    """Model for offer observations that always picks action 5."""
+    def predict(self, observation):
+        return np.full(np.shape(observation)[:-2], 5), None
+
+
+@pytest.mark.parametrize("matcher", ['sort', 'partial'])
+def test_market_run_episode(matcher):
+    from dmarket.agents import AgentPopulation, ConstantAgent, GymRLAgent
+    from dmarket.info_settings import OfferInformationSetting
+
+    agents = [
+        ConstantAgent('buyer', 100, name='b1'),
+        ConstantAgent('buyer', 80, name='b2'),
+        GymRLAgent('buyer', 110, name='rl', model=ConstantModel()),
+        ConstantAgent('seller', 90, name='s1'),
+        ConstantAgent('seller', 95, name='s2'),
+    ]
+    m = MarketEngine(['b1', 'b2', 'rl'], ['s1', 's2'], max_steps=5,
+                     matcher=matcher)
+    setting = OfferInformationSetting()
+    prices, times, rewards = m.run_episode(AgentPopulation(agents), setting)
+    assert m.done_mask.all()
+
+    # Same game played with dicts of offers, round by round
+    m.reset()
+    expected = {}
+    deal_times = {}
+    while not m.done_mask.all():
+        states = setting.get_states(m.agents, m)
+        deals = m.step({
+            agent.name: agent.get_offer(states[agent.name])
+            for agent in agents if agent.name not in m.done
+        })
+        deal_times.update(dict.fromkeys(deals, m.time - 1))
+        expected.update(deals)
+
+    for agent, price, time, reward in zip(agents, prices, times, rewards):
+        if agent.name in expected:
+            assert price == expected[agent.name]
+            assert time == deal_times[agent.name]
+            gain = expected[agent.name] - agent.reservation_price
+            assert reward == (gain if agent.role == 'seller' else -gain)
+        else:
+            assert np.isnan(price) and time == -1 and reward == 0
+    assert np.isnan(prices[1])
+
+
+@pytest.mark.parametrize("pregenerate", [None, 40])
+def test_market_run_episode_without_observations(pregenerate):
+    from dmarket.agents import AgentPopulation, TimeLinearAgent
+
+    # Offers are drawn for several rounds at once, over more than one draw
+    agents = [
+        TimeLinearAgent('buyer', 130, name='b1', max_steps=40, noise=0),
+        TimeLinearAgent('buyer', 80, name='b2', max_steps=40, noise=0),
+        TimeLinearAgent('seller', 100, name='s1', max_steps=40, noise=0),
+    ]
+    m = MarketEngine(['b1', 'b2'], ['s1'], max_steps=40)
+    population = AgentPopulation(agents, pregenerate=pregenerate)
+    prices, times, rewards = m.run_episode(population)
+    assert m.done_mask.all()
+
+    m.reset()
+    while not m.done_mask.all():
+        deals = m.step({
+            agent.name: agent.get_offer((None, m.time))
+            for agent in agents if agent.name not in m.done
+        })
+        if deals:
+            time = m.time - 1
+            break
+    assert times.tolist() == [time, -1, time]
+    assert prices[0] == prices[2] == deals['b1']
+    assert rewards[0] == 130 - deals['b1']
+
+
+def test_market_run_episode_quantities():
+    from dmarket.agents import AgentPopulation, ConstantAgent, TimeLinearAgent
+
+    # b1 buys one unit from s1 right away and one from s2 later on
+    agents = [
+        ConstantAgent('buyer', 100, name='b1'),
+        ConstantAgent('buyer', 80, name='b2'),
+        ConstantAgent('seller', 90, name='s1'),
+        TimeLinearAgent('seller', 95, name='s2', max_steps=5, noise=0),
+    ]
+    m = MarketEngine(['b1', 'b2'], ['s1', 's2'], max_steps=10,
+                     quantities={'b1': 2, 's2': 2})
+    prices, times, rewards = m.run_episode(AgentPopulation(agents))
+
+    # The same game played step by step
+    m.reset()
+    values = dict.fromkeys(m.agent_ids, 0.0)
+    units = dict.fromkeys(m.agent_ids, 0)
+    first = {}
+    while not m.done_mask.all():
+        deals = m.step({
+            agent.name: agent.get_offer((None, m.time))
+            for agent in agents if agent.name not in m.done
+        })
+        for agent_id, price in deals.items():
+            filled = m.filled[m.slots[agent_id]]
+            values[agent_id] += price*filled
+            units[agent_id] += filled
+            first.setdefault(agent_id, m.time - 1)
+    assert units['b1'] == 2 and first['b1'] == 0
+
+    for agent, price, time, reward in zip(agents, prices, times, rewards):
+        if units[agent.name]:
+            average = values[agent.name]/units[agent.name]
+            assert price == pytest.approx(average)
+            assert time == first[agent.name]
+            sign = 1 if agent.role == 'seller' else -1
+            assert reward == pytest.approx(
+                sign*(values[agent.name]
+                      - units[agent.name]*agent.reservation_price)
+            )
+        else:
+            assert np.isnan(price) and time == -1 and reward == 0
+
+
+def test_market_stats():
+    m = MarketEngine([0, 1, 2], [3, 4], max_steps=3)
+    stats = m.stats()
+    assert stats['steps'] == 0 and np.isnan(stats['deals_per_step'])
+
+    m.step({0: 100, 1: 90, 3: 95, 4: 110})
+    stats = m.stats()
+    assert stats['last_deals'] == 1
+    assert stats['last_bid_depth'] == 2 and stats['last_ask_depth'] == 2
+    assert stats['last_spread'] == -5
+    assert stats['done_fraction'] == 2/5
+
+    m.step({1: 90, 2: 80})
+    m.step({1: 90, 4: 100})
+    stats = m.stats()
+    assert stats['steps'] == 3 and stats['episodes'] == 1
+    assert stats['deals'] == 1 and stats['deals_per_step'] == 1/3
+    assert stats['mean_bid_depth'] == 5/3
+    assert stats['mean_spread'] == (-5 + 10)/2
+    assert stats['last_spread'] == 10
+    assert stats['mean_episode_length'] == 3
+    assert stats['done_fraction'] == 1
+
+    # Counters are kept across games, but not the gauges of the game
+    m.reset()
+    m.step({0: 100, 3: 90})
+    stats = m.stats()
+    assert stats['episodes'] == 1 and stats['steps'] == 4
+    assert stats['deals'] == 2
+    assert stats['done_fraction'] == 2/5
+
+    m.reset_stats()
+    assert m.stats()['steps'] == 0
+
+
+@pytest.mark.parametrize("matcher", ['sort', 'partial'])
+def test_market_stats_without_book(matcher, monkeypatch):
+    m = MarketEngine([0, 1, 2], [3, 4], max_steps=3, matcher=matcher,
+                     book_stats=False)
+    # The offers are not counted again after matching
+    monkeypatch.setattr(m, '_depth', None)
+    m.step({0: 100, 1: 90, 3: 95, 4: 110})
+    m.step(np.array([np.nan, 90, 80, np.nan, 100]))
+    stats = m.stats()
+    assert stats['steps'] == 2 and stats['deals'] == 1
+    assert stats['last_deals'] == 0
+    for name in ['mean_bid_depth', 'mean_ask_depth', 'mean_spread',
+                 'last_bid_depth', 'last_ask_depth', 'last_spread']:
+        assert np.isnan(stats[name])
+
+
+def test_order_book_persistent_offers():
+    m = OrderBookMarketEngine(['b1', 'b2'], ['s1', 's2'], max_steps=10)
+    assert m.step({'b1': 90, 's1': 100}) == {}
+
+    # Offers stay in the book until they are changed
+    assert m.step({'s1': 98}) == {}
+    np.testing.assert_array_equal(m.last_offers, [90, np.nan, 98, np.nan])
+    assert m.step({'b1': 100}) == {'b1': 99, 's1': 99}
+    assert m.done == {'b1', 's1'}
+    np.testing.assert_array_equal(m.book, [np.nan]*4)
+
+    # Cancelled offers can't be matched
+    m.step({'b2': 95})
+    m.step({'b2': None})
+    assert m.step({'s2': 90}) == {}
+    assert m.step(np.array([np.nan, 95, np.nan, np.nan])).tolist()[1] == 92.5
+    assert m.done_mask.all()
+
+    with pytest.raises(RuntimeError):
+        m.step({'unknown': 10})
+
+
+def test_order_book_arrival_priority():
+    m = OrderBookMarketEngine([0, 1, 2], [3], max_steps=10,
+                              tie_break='arrival')
+    m.step({1: 100})
+    m.step({0: 100, 2: 100})
+    assert m.step({3: 90}) == {1: 95, 3: 95}
+
+    # An amended offer loses its place in the queue
+    m = OrderBookMarketEngine([0, 1], [2], max_steps=10, tie_break='arrival')
+    m.step({0: 100, 1: 100})
+    m.step({0: 100})
+    assert m.step({2: 90}) == {1: 95, 2: 95}
+
+
+def test_order_book_same_as_resubmitting():
+    rng = np.random.default_rng(4)
+    buyers, sellers = list(range(6)), list(range(6, 10))
+    book = OrderBookMarketEngine(buyers, sellers, max_steps=5)
+    market = MarketEngine(buyers, sellers, max_steps=5)
+    for _ in range(20):
+        book.reset()
+        market.reset()
+        while not market.done_mask.all():
+            offers = {
+                agent_id: float(rng.integers(90, 110))
+                for agent_id in market.agent_ids
+                if agent_id not in market.done and rng.random() < 0.8
+            }
+            # Agents without offer cancel their standing one
+            changes = dict.fromkeys(market.agent_ids)
+            changes.update(offers)
+            assert book.step(changes) == market.step(offers)
+        assert book.done_mask.all()
+        assert book.deal_history == market.deal_history
+
+    # Outdated heap entries don't pile up
+    book = OrderBookMarketEngine(buyers, sellers, max_steps=100)
+    for price in range(50):
+        book.step({0: 50 + price % 3})
+    assert len(book._bids) <= 2*book.n_agents
+
+
+def test_continuous_market():
+    m = ContinuousMarketEngine(['b1', 'b2', 'b3'], ['s1', 's2', 's3'],
+                               max_steps=10)
+    # Each arriving offer trades at the price of the best resting offer
+    deals = m.step({'s1': 100, 'b1': 95, 's2': 98, 'b2': 101, 'b3': 99})
+    assert deals == {'b2': 98, 's2': 98}
+    assert list(deals) == ['b2', 's2']
+    np.testing.assert_array_equal(m.last_offers, [95, 101, 99, 100, 98, np.nan])
+    assert m.done == {'b2', 's2'}
+
+    # Resting offers keep their place: b3 rests at 99 since the last step
+    deals = m.step({'b1': 99, 's3': 90})
+    assert deals == {'b3': 99, 's3': 99}
+
+    # Price-time priority among equal prices across steps
+    m = ContinuousMarketEngine([0, 1], [2, 3], max_steps=10)
+    m.step({1: 100})
+    m.step({0: 100})
+    assert m.step({2: 95}) == {1: 100, 2: 100}
+
+    # Array offers arrive in random order, NaN keeps the resting offer
+    m = ContinuousMarketEngine([0, 1], [2, 3], rng=np.random.default_rng(0))
+    m.step(np.array([90, np.nan, np.nan, np.nan]))
+    deals = m.step(np.array([np.nan, np.nan, 85, np.nan]))
+    np.testing.assert_array_equal(deals, [90, np.nan, 90, np.nan])
+
+
+def test_match_quantities():
+    bids = np.array([100., 95, np.nan])
+    asks = np.array([90., 97, 99])
+    buyers, sellers, volumes = match_quantities(
+        bids, asks, np.array([3, 5, 2]), np.array([2, 4, 1])
+    )
+    # Buyer 0 takes both units of seller 0 and one of seller 1, buyer 1's
+    # bid is below the remaining asks
+    assert buyers.tolist() == [0, 0]
+    assert sellers.tolist() == [0, 1]
+    assert volumes.tolist() == [2, 1]
+
+    # With single units it's the same as match_sort
+    rng = np.random.default_rng(5)
+    for _ in range(50):
+        bids = rng.integers(90, 110, size=8).astype(float)
+        asks = rng.integers(95, 115, size=6).astype(float)
+        bids[rng.random(8) < 0.2] = np.nan
+        buyers, sellers, volumes = match_quantities(
+            bids, asks, np.ones(8), np.ones(6)
+        )
+        expected = match_sort(bids, asks)
+        np.testing.assert_array_equal(buyers, expected[0])
+        np.testing.assert_array_equal(sellers, expected[1])
+        assert (volumes == 1).all()
+
+
+def test_market_quantities():
+    m = MarketEngine(['b1', 'b2'], ['s1', 's2'], max_steps=5,
+                     quantities={'b1': 3, 's1': 2})
+    np.testing.assert_array_equal(m.quantities, [3, 1, 2, 1])
+
+    # b1 buys 2 units at 95 from s1 and 1 at 97 from s2
+    deals = m.step({'b1': 100, 'b2': 92, 's1': 90, 's2': 94})
+    assert deals == {'b1': pytest.approx((2*95 + 97)/3), 's1': 95, 's2': 97}
+    np.testing.assert_array_equal(m.filled, [3, 0, 2, 1])
+    # All sellers are done, so the game is over
+    assert m.done_mask.all()
+    assert m.deal_history[-1] == deals
+
+    # Partial fills leave the rest for later steps
+    m.reset()
+    np.testing.assert_array_equal(m.remaining, [3, 1, 2, 1])
+    deals = m.step({'b1': 100, 's1': 90}, quantities={'b1': 1})
+    assert deals == {'b1': 95, 's1': 95}
+    np.testing.assert_array_equal(m.remaining, [2, 1, 1, 1])
+    assert m.done == set()
+    deals = m.step(np.array([100, np.nan, 96, np.nan]))
+    np.testing.assert_array_equal(deals, [98, np.nan, 98, np.nan])
+    assert m.done == {'s1'}
+    assert m.stats()['done_fraction'] == 1/4
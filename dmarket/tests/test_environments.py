@@ -1,8 +1,16 @@
 import pytest
 import numpy as np
-from dmarket.environments import SingleAgentTrainingEnv, MultiAgentTrainingEnv
-from dmarket.info_settings import BlackBoxSetting, TimeInformationWrapper
-from dmarket.agents import ConstantAgent, GymRLAgent, TimeLinearAgent
+from gym.spaces import Box
+from dmarket.environments import (
+    SingleAgentTrainingEnv, MultiAgentTrainingEnv, SingleAgentVecEnv,
+    ParallelMultiAgentEnv
+)
+from dmarket.info_settings import (
+    InformationSetting, BlackBoxSetting, TimeInformationWrapper
+)
+from dmarket.agents import (
+    ConstantAgent, GymRLAgent, TimeLinearAgent, UniformRandomAgent
+)
 
 
 def test_single_env():
@@ -18,6 +26,9 @@ def test_single_env():
     obs = env.reset()
     assert env.observation_space.contains(obs)
 
+    # The market only keeps the history needed by the setting
+    assert env.market.history.retention == 0
+
     # The step function and action_space sampler should work
     obs, reward, done, _ = env.step(env.action_space.sample())
 
@@ -89,7 +100,257 @@ def test_multi_time_env():
 
     # Seller offers 100
     obs,  rew, done, _ = env.step({'A': 0})
-    print(env.market.offer_history[-1])
+    print(env.market.history.last_offers)
     assert obs == {'A': np.array([0.])}
     assert rew == {'A': 15}
     assert done == {'A': True, '__all__': True}
+
+
+@pytest.mark.parametrize("pregenerate", [False, True])
+def test_single_vec_env(pregenerate):
+    rl_agent = GymRLAgent('buyer', 100)
+    fixed_agents = [
+        ConstantAgent('seller', 91),
+        ConstantAgent('seller', 96.1),
+        TimeLinearAgent('seller', 100, max_steps=10, noise=0),
+        ConstantAgent('buyer', 85),
+    ]
+    setting = TimeInformationWrapper(BlackBoxSetting())
+    n_envs = 4
+    vec_env = SingleAgentVecEnv(rl_agent, fixed_agents, setting, n_envs,
+                                pregenerate=pregenerate)
+    envs = [
+        SingleAgentTrainingEnv(rl_agent, fixed_agents, setting)
+        for _ in range(n_envs)
+    ]
+
+    # It should behave exactly like separate environments with auto-reset
+    obs = vec_env.reset()
+    assert obs.shape == (n_envs, 1)
+    for i, env in enumerate(envs):
+        np.testing.assert_array_equal(obs[i], env.reset())
+
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        actions = rng.integers(0, 20, size=n_envs)
+        obs, rewards, dones, infos = vec_env.step(actions)
+        for i, env in enumerate(envs):
+            env_obs, env_reward, env_done, _ = env.step(actions[i])
+            assert rewards[i] == env_reward
+            assert dones[i] == env_done
+            if env_done:
+                np.testing.assert_array_equal(
+                    infos[i]['terminal_observation'], env_obs
+                )
+                env_obs = env.reset()
+            np.testing.assert_array_equal(obs[i], env_obs)
+
+
+def test_single_vec_env_slots():
+    rl_agent = GymRLAgent('buyer', 100, name='rl')
+    fixed_agents = [
+        ConstantAgent('seller', 90, name='s2'),
+        ConstantAgent('seller', 90, name='s1'),
+    ]
+    setting = BlackBoxSetting()
+    vec_env = SingleAgentVecEnv(rl_agent, fixed_agents, setting, 2)
+    env = SingleAgentTrainingEnv(rl_agent, fixed_agents, setting)
+
+    # Equal offers are matched in the same order as in the market engine
+    assert [agent.name for agent in vec_env.agents] == env.market.agent_ids
+    offers = np.array([100., 90., 90.])
+    vec_env.market.step(offers[None, :1], offers[None, 1:])
+    env.market.step(dict(zip(env.market.agent_ids, offers)))
+    deals = env.market.history.last_deals
+    assert np.isnan(deals[env.market.slots['s2']])
+    np.testing.assert_array_equal(vec_env.market.deals[0], deals)
+
+    vec_env.reset()
+    vec_env.step_async(np.zeros(2, dtype=int))
+    obs, rewards, dones, infos = vec_env.step_wait()
+    assert obs.shape == (2, 1)
+    assert vec_env.get_attr('rl_agent', [0, 1]) == [rl_agent, rl_agent]
+    assert vec_env.env_method('seed', 0, indices=0) == [[0]]
+
+
+class RLOnlySetting(BlackBoxSetting):
+    """Setting with batch states only for the RL agent."""
+    rl_slot = None
+
+    def get_batch_states(self, agent_slots, market, out=None):
+        if list(agent_slots) != [self.rl_slot]:
+            raise NotImplementedError
+        return super().get_batch_states(agent_slots, market, out)
+
+
+def test_single_vec_env_grouped_agents():
+    rl_agent = GymRLAgent('buyer', 100)
+    fixed_agents = [
+        ConstantAgent('seller', 90),
+        UniformRandomAgent('seller', 80),
+    ]
+    setting = RLOnlySetting()
+    vec_env = SingleAgentVecEnv(rl_agent, fixed_agents, setting, 2)
+    setting.rl_slot = vec_env.rl_slot
+
+    # Grouped fixed agents ignore observations, so none are computed
+    vec_env.reset()
+    obs, rewards, dones, infos = vec_env.step(np.zeros(2, dtype=int))
+    assert obs.shape == (2, 1)
+
+
+def make_multi_env():
+    rl_agents = [
+        GymRLAgent('buyer',  110,  'A'),
+        GymRLAgent('seller', 90,   'B'),
+    ]
+    fixed_agents = [
+        ConstantAgent('buyer',   1, 'B1'),
+        ConstantAgent('buyer', 105, 'B105'),
+        ConstantAgent('seller', 95, 'S95'),
+    ]
+    return MultiAgentTrainingEnv(rl_agents, fixed_agents, BlackBoxSetting())
+
+
+def test_parallel_multi_env():
+    with ParallelMultiAgentEnv(make_multi_env, 3, n_workers=2) as env:
+        obs = env.reset()
+        assert obs['A'].shape == (3, 1)
+
+        # Same scenario as test_multi_env in every copy
+        obs, rew, done, info = env.step({'A': [20] * 3, 'B': [1] * 3})
+        np.testing.assert_array_equal(obs['A'], [[0.5]] * 3)
+        np.testing.assert_array_equal(obs['B'], [[0.025]] * 3)
+        np.testing.assert_array_equal(rew['B'], [8.625] * 3)
+        np.testing.assert_array_equal(done['B'], [True] * 3)
+        assert not done['__all__'].any()
+
+        # Finished copies are reset
+        obs, rew, done, info = env.step({'A': [0, 20, 0], 'B': [0] * 3})
+        np.testing.assert_array_equal(rew['A'], [7.5, 0, 7.5])
+        np.testing.assert_array_equal(done['__all__'], [True, False, True])
+        np.testing.assert_array_equal(info['terminal_observation']['A'][0],
+                                      [0])
+        np.testing.assert_array_equal(obs['A'], [[0], [0.5], [0]])
+    assert env.closed
+
+
+def test_env_seed():
+    fixed_agents = [
+        UniformRandomAgent('seller', 90),
+        TimeLinearAgent('seller', 100),
+    ]
+    env = SingleAgentTrainingEnv(GymRLAgent('buyer', 100), fixed_agents,
+                                 TimeInformationWrapper(BlackBoxSetting()))
+
+    def rollout(seed):
+        env.seed(seed)
+        env.reset()
+        env.step(0)
+        return env.market.history.last_offers.copy()
+
+    # The same seed should give the same offers
+    np.testing.assert_array_equal(rollout(0), rollout(0))
+    assert not np.array_equal(rollout(0), rollout(1))
+
+
+def test_env_profile():
+    rl_agent = GymRLAgent('buyer', 100)
+    fixed_agents = [ConstantAgent('seller', 90), ConstantAgent('seller', 95)]
+    env = SingleAgentTrainingEnv(rl_agent, fixed_agents, BlackBoxSetting())
+    assert not env.profiler.enabled
+    env.reset()
+    env.step(0)
+    assert env.profiler.as_dict() == {}
+
+    env = SingleAgentTrainingEnv(rl_agent, fixed_agents, BlackBoxSetting(),
+                                 profile=True)
+    env.reset()
+    for _ in range(3):
+        env.step(0)
+    phases = env.profiler.as_dict()
+    assert phases['reset']['calls'] == 1
+    assert phases['market']['calls'] == 3
+    assert set(phases) == {'reset', 'fixed_observations', 'fixed_offers',
+                           'rl_offers', 'market', 'rl_observations', 'rewards'}
+    assert sum(phase['fraction'] for phase in phases.values()) \
+        == pytest.approx(1)
+    assert 'market' in env.profiler.report()
+
+    env = SingleAgentVecEnv(rl_agent, fixed_agents, BlackBoxSetting(), 4,
+                            profile=True)
+    env.reset()
+    env.step(np.zeros(4, dtype=int))
+    assert env.profiler.counts['market'] == 1
+
+
+def test_multi_env_continuous_market():
+    from dmarket.engine import ContinuousMarketEngine
+    rl_agents = [GymRLAgent('buyer', 100, name='rl')]
+    fixed_agents = [ConstantAgent('seller', 90), ConstantAgent('seller', 95)]
+    env = MultiAgentTrainingEnv(rl_agents, fixed_agents, BlackBoxSetting(),
+                                market_engine=ContinuousMarketEngine)
+    assert isinstance(env.market, ContinuousMarketEngine)
+    env.reset()
+    # Whatever the order of arrival, the bid of 90 trades with the ask of 90
+    obs, rew, done, _ = env.step({'rl': 4})
+    assert rew == {'rl': 10}
+    assert done['rl']
+
+
+class TwoArgumentSetting(InformationSetting):
+    """Setting with only the ``get_states`` signature without ``out``."""
+    history_length = 0
+    observation_space = Box(low=0, high=np.inf, shape=[1])
+
+    def get_states(self, agent_ids, market):
+        return {agent_id: np.array([1.0]) for agent_id in agent_ids}
+
+
+class ObservingAgent(ConstantAgent):
+    """Constant agent that is not grouped, so it gets observations."""
+    def get_offer(self, observation):
+        assert observation is not None
+        return super().get_offer(observation)
+
+
+@pytest.mark.parametrize("wrap", [False, True])
+def test_env_two_argument_setting(wrap):
+    setting = TwoArgumentSetting()
+    if wrap:
+        setting = TimeInformationWrapper(setting)
+    env = MultiAgentTrainingEnv([GymRLAgent('buyer', 100, 'A')],
+                                [ObservingAgent('seller', 90, 'S')], setting)
+    env.reset()
+    obs, rew, done, _ = env.step({'A': 0})
+    assert done['A'] and rew['A'] == 5
+
+
+class PlainSetting:
+    """Setting that doesn't derive from ``InformationSetting``."""
+    observation_space = Box(low=0, high=np.inf, shape=[1])
+
+    def get_states(self, agent_ids, market):
+        return {agent_id: np.array([1.0]) for agent_id in agent_ids}
+
+
+def test_env_history_length():
+    rl_agents = [GymRLAgent('buyer', 100, 'A')]
+    fixed_agents = [ConstantAgent('seller', 90, 'S')]
+
+    # Without a history_length attribute the market keeps the full history
+    env = MultiAgentTrainingEnv(rl_agents, fixed_agents, PlainSetting())
+    env.reset()
+    env.step({'A': 0})
+    assert len(env.market.offer_history) == 1
+
+    # Settings that need no history can still be given the full history
+    env = MultiAgentTrainingEnv(rl_agents, fixed_agents, BlackBoxSetting())
+    env.reset()
+    env.step({'A': 0})
+    assert len(env.market.offer_history) == 0
+    env = SingleAgentTrainingEnv(rl_agents[0], fixed_agents,
+                                 BlackBoxSetting(), history_length=None)
+    env.reset()
+    env.step(0)
+    assert len(env.market.offer_history) == 1
@@ -0,0 +1,88 @@
+import pytest
+import numpy as np
+from dmarket.agents import ConstantAgent, UniformRandomAgent, GymRLAgent
+from dmarket.info_settings import OfferInformationSetting
+from dmarket.evaluate import RunningMoments, GameStatistics, evaluate
+
+
+def test_running_moments():
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=(50, 3))
+    moments = RunningMoments(3)
+    moments.update(values[0])
+    moments.update(values[1:20])
+    other = RunningMoments(3).update(values[20:])
+    moments.merge(other)
+    assert moments.count == 50
+    np.testing.assert_allclose(moments.mean, values.mean(axis=0))
+    np.testing.assert_allclose(moments.variance, values.var(axis=0, ddof=1))
+    assert np.isnan(RunningMoments().variance)
+
+
+def test_game_statistics():
+    stats = GameStatistics(['a', 'b'], max_steps=3)
+    stats.update([10, np.nan], [1, -1], [2, 0])
+    stats.update([[12, 20], [np.nan, 30]], [[1, 0], [-1, 2]], [[4, 1], [0, 3]])
+    np.testing.assert_array_equal(stats.n_deals, [2, 2])
+    np.testing.assert_array_equal(stats.deal_times, [[0, 2, 0], [1, 0, 1]])
+    summary = stats.summary()
+    assert summary['a']['deal_rate'] == pytest.approx(2/3)
+    assert summary['a']['deal_price_mean'] == 11
+    assert summary['b']['deal_time_mean'] == 1
+    assert summary['a']['reward_mean'] == 2
+
+
+class ConstantModel:
+    """Model for offer observations that always picks action 5."""
+    def predict(self, observation):
+        return np.full(np.shape(observation)[:-2], 5), None
+
+
+@pytest.fixture
+def agents():
+    return [
+        ConstantAgent('buyer', 100, name='b1'),
+        UniformRandomAgent('buyer', 90, name='b2'),
+        GymRLAgent('buyer', 110, name='rl', model=ConstantModel()),
+        ConstantAgent('seller', 90, name='s1'),
+        UniformRandomAgent('seller', 80, name='s2'),
+    ]
+
+
+def test_evaluate(agents):
+    setting = OfferInformationSetting()
+    stats, games = evaluate(agents, setting, n_games=20, seed=1,
+                            keep_games=True)
+    assert stats.n_games == 20
+    assert games.shape == (3, 20, 5)
+    np.testing.assert_allclose(stats.rewards.mean, games[2].mean(axis=0))
+    np.testing.assert_array_equal(stats.n_deals, (games[1] >= 0).sum(axis=0))
+
+    # The same seed gives the same games
+    _, same_games = evaluate(agents, setting, n_games=20, seed=1,
+                             keep_games=True)
+    np.testing.assert_array_equal(games, same_games)
+
+    # The constant agents always trade with each other first
+    assert stats.summary()['b1']['deal_rate'] == 1
+
+
+def test_evaluate_keeps_agent_rng(agents):
+    rng = np.random.default_rng(0)
+    agents[1] = UniformRandomAgent('buyer', 90, name='b2', rng=rng)
+    model = agents[2].model
+    evaluate(agents, OfferInformationSetting(), n_games=5, seed=1)
+    assert agents[1].rng is rng
+    assert agents[2].model is model
+    assert agents[0].rng is np.random
+
+
+@pytest.mark.parametrize("batch_size,n_workers", [(8, None), (None, 2)])
+def test_evaluate_batched(agents, batch_size, n_workers):
+    setting = OfferInformationSetting()
+    agents = [agents[0], agents[2], agents[3]]
+    stats = evaluate(agents, setting, n_games=20, batch_size=batch_size,
+                     n_workers=n_workers)
+    expected = evaluate(agents, setting, n_games=20)
+    assert stats.n_games == 20
+    np.testing.assert_equal(stats.summary(), expected.summary())
@@ -1,6 +1,7 @@
 import pytest
 
 from dmarket.info_settings import *
+from dmarket.engine import MarketEngine, BatchMarketEngine
 
 
 def test_blackbox(market):
@@ -14,6 +15,26 @@ def test_blackbox(market):
     m.step({0: 100, 1: 150})
     assert b.get_states([0,1, 2], m) == {0: [100], 1: [150], 2: [0]}
 
+    # The offers come from the engine, even if it keeps no history
+    m = MarketEngine(range(10), range(10, 20), history_length=0)
+    m.step({0: 100, 10: 120})
+    assert m.offer_history == []
+    assert b.get_states([0, 10], m) == {0: [100], 10: [120]}
+
+
+@pytest.mark.parametrize('n_agents', [20, 200])
+def test_offer_info_book_size(n_agents):
+    # Small and large books are sorted differently
+    rng = np.random.default_rng(0)
+    m = MarketEngine(range(n_agents // 2), range(n_agents // 2, n_agents))
+    offers = rng.uniform(80, 120, size=n_agents)
+    offers[::3] = np.nan
+    m.step(offers)
+    bids = np.sort(offers[:n_agents // 2][~np.isnan(offers[:n_agents // 2])])
+    asks = np.sort(offers[n_agents // 2:][~np.isnan(offers[n_agents // 2:])])
+    states = OfferInformationSetting(5).get_states_array([0], m)
+    np.testing.assert_array_equal(states[0], [bids[::-1][:5], asks[:5]])
+
 
 def test_offer_info(market):
     m = market(10,10)
@@ -62,6 +83,18 @@ def test_deal_info(market):
     )
 
 
+def test_deal_info_quantities():
+    # A buyer filled by two sellers shows its average price once, without
+    # leaving a gap before the next buyer
+    m = MarketEngine(range(10), range(10, 20), quantities={0: 2})
+    m.step({0: 110, 1: 96, 10: 90, 11: 94, 12: 95})
+    setting = DealInformationSetting(5)
+    np.testing.assert_array_equal(setting.get_states([0], m)[0],
+                                  [101, 95.5, 0, 0, 0])
+    np.testing.assert_array_equal(setting.get_states_array([0, 1], m),
+                                  [[101, 95.5, 0, 0, 0]]*2)
+
+
 @pytest.mark.parametrize("base_setting", [
     BlackBoxSetting(),
     OfferInformationSetting(5),
@@ -82,3 +115,109 @@ def test_time_wrapper(market, base_setting):
     m.step({0: 100, 1:100})
     next_state = setting.get_states([0], m)[0]
     assert next_state[1] == 1
+
+
+def test_history_length():
+    # The settings only look at the last step, which needs no history
+    assert BlackBoxSetting().history_length == 0
+    assert OfferInformationSetting().history_length == 0
+    assert DealInformationSetting().history_length == 0
+    assert TimeInformationWrapper(BlackBoxSetting()).history_length == 0
+    assert InformationSetting().history_length is None
+
+
+@pytest.mark.parametrize("setting", [
+    BlackBoxSetting(),
+    OfferInformationSetting(3),
+    DealInformationSetting(3),
+    TimeInformationWrapper(DealInformationSetting(3)),
+])
+def test_batch_states(market, setting):
+    # Batched observations should equal those of separate markets
+    offers = np.array([
+        [100, 96, 94, np.nan, 90, 95, 110, 93],
+        [np.nan, np.nan, np.nan, np.nan, 120, 130, 140, 150],
+    ])
+    batch = BatchMarketEngine(2, 4, 4)
+    batch.step(offers[:, :4], offers[:, 4:])
+    result = setting.get_batch_states([0, 5], batch)
+    for row in range(2):
+        m = market(4, 4)
+        m.step(offers[row])
+        expected = setting.get_states([0, 5], m)
+        for slot in [0, 5]:
+            if isinstance(setting, TimeInformationWrapper):
+                assert result[slot][1][row] == expected[slot][1]
+                np.testing.assert_array_equal(result[slot][0][row],
+                                              expected[slot][0])
+            else:
+                np.testing.assert_array_equal(result[slot][row],
+                                              expected[slot])
+
+
+@pytest.mark.parametrize("setting", [
+    OfferInformationSetting(2),
+    DealInformationSetting(2),
+])
+def test_output_buffers(market, setting):
+    m = market(3, 3)
+    m.step({0: 110, 1: 96, 2: 80, 3: 90, 4: 94, 5: 120})
+    expected = setting.get_state(0, m)
+
+    # Observations are written into the given buffer
+    out = np.full(setting.observation_space.shape, -1.0)
+    states = setting.get_states([0, 3], m, out)
+    assert states[0] is out and states[3] is out
+    np.testing.assert_array_equal(out, expected)
+
+    # The stacked form has one observation per agent
+    out = np.full((2,) + setting.observation_space.shape, -1.0)
+    assert setting.get_states_array([0, 3], m, out) is out
+    np.testing.assert_array_equal(out, [expected, expected])
+
+
+@pytest.mark.parametrize("setting", [
+    BlackBoxSetting(),
+    OfferInformationSetting(3),
+    DealInformationSetting(3),
+])
+def test_states_array(market, setting):
+    m = market(3, 3)
+    m.step({0: 110, 1: 96, 2: 80, 3: 90, 4: 94, 5: 120})
+
+    # Rows of the stacked form are the observations of the dict form
+    states = setting.get_states_array([0, 2, 4], m)
+    assert states.shape == (3,) + setting.observation_space.shape
+    expected = setting.get_states([0, 2, 4], m)
+    for row, agent_id in enumerate([0, 2, 4]):
+        np.testing.assert_array_equal(states[row], expected[agent_id])
+
+    # The time wrapper adds an array of times
+    states, time = TimeInformationWrapper(setting).get_states_array([0, 1], m)
+    assert states.shape[0] == 2
+    np.testing.assert_array_equal(time, [1, 1])
+
+
+class DictSetting(InformationSetting):
+    """Setting that only implements ``get_states``."""
+    def __init__(self):
+        self.observation_space = Box(low=0, high=np.infty, shape=[2])
+
+    def get_states(self, agent_ids, market):
+        return {agent_id: np.array([agent_id, 1]) for agent_id in agent_ids}
+
+
+def test_states_array_fallback(market):
+    m = market(2, 2)
+
+    # The stacked form defaults to stacking the dict form
+    setting = DictSetting()
+    np.testing.assert_array_equal(setting.get_states_array([3, 1], m),
+                                  [[3, 1], [1, 1]])
+    assert setting.get_states_array([], m).shape == (0, 2)
+    states, time = TimeInformationWrapper(setting).get_states_array([2], m)
+    np.testing.assert_array_equal(states, [[2, 1]])
+
+    with pytest.raises(NotImplementedError):
+        InformationSetting().get_states_array([0], m)
+